@@ -0,0 +1,60 @@
+"""
+Helpers shared by the benchmark scripts. Importing this module puts the
+repository root on sys.path so the scripts can be run from anywhere.
+"""
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+def write_config(directory, **settings):
+    """
+    Writes a config file for create_app that keeps its SQLite database in
+    `directory`. Extra settings are written as given.
+    """
+    path = os.path.join(directory, 'config_benchmark.py')
+    values = {
+        'DATABASE': 'sqlite:///%s' % os.path.join(directory, 'benchmark.db'),
+        'SECRET_KEY': 'benchmark',
+        'CSRF_ENABLED': False
+    }
+    values.update(settings)
+    with open(path, 'w') as cfg:
+        for name, value in sorted(values.items()):
+            cfg.write('%s = %r\n' % (name, value))
+    return path
+
+SAMPLE_SOURCES = {
+    'python': "def fib(n):\n    return n if n < 2 else fib(n - 1) + fib(n - 2)\n",
+    'cpp': "template <typename T>\nT add(T a, T b) { return a + b; }\n",
+    'haskell': "fib :: Int -> Int\nfib n = if n < 2 then n else fib (n-1) + fib (n-2)\n",
+    'html': "<div class='box'><p>Hello <b>world</b></p></div>\n"
+}
+
+def make_source(lang, size, serial=0):
+    """
+    Roughly `size` characters of source in the given language, made
+    unique by `serial` so content-addressed renders aren't shared.
+    """
+    sample = SAMPLE_SOURCES.get(lang, SAMPLE_SOURCES['python'])
+    lines = []
+    length = 0
+    while length < size:
+        line = '%s# %d.%d\n' % (sample, serial, len(lines))
+        lines.append(line)
+        length += len(line)
+    return ''.join(lines)
+
+def percentile(values, fraction):
+    """
+    Nearest-rank percentile of an already sorted list.
+    """
+    if not values:
+        return 0.0
+    index = int(round(fraction * (len(values) - 1)))
+    return values[index]
+
+def peak_rss_kb():
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
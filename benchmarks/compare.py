@@ -0,0 +1,42 @@
+"""
+Compares two JSON reports written by benchmarks/routes.py.
+
+    python benchmarks/compare.py before.json after.json
+"""
+import sys
+import json
+
+METRICS = ('p50_ms', 'p95_ms', 'p99_ms', 'req_per_sec')
+
+def change(before, after):
+    if not before:
+        return '     n/a'
+    return '%+7.1f%%' % ((after - before) / before * 100)
+
+def main():
+    if len(sys.argv) != 3:
+        sys.exit(__doc__.strip())
+    with open(sys.argv[1]) as f:
+        before = json.load(f)
+    with open(sys.argv[2]) as f:
+        after = json.load(f)
+    print('%s -> %s' % (before.get('revision'), after.get('revision')))
+    print('%-12s %-13s %-12s %10s %10s %9s' % ('driver', 'route', 'metric',
+                                               'before', 'after', 'change'))
+    for driver in sorted(after['results']):
+        for route in sorted(after['results'][driver]):
+            old = before['results'].get(driver, {}).get(route)
+            if old is None:
+                continue
+            new = after['results'][driver][route]
+            for metric in METRICS:
+                print('%-12s %-13s %-12s %10.2f %10.2f %9s' % (
+                    driver, route, metric, old[metric], new[metric],
+                    change(old[metric], new[metric])))
+    print('%-39s %10d %10d %9s' % ('peak_rss_kb', before['peak_rss_kb'],
+                                   after['peak_rss_kb'],
+                                   change(before['peak_rss_kb'],
+                                          after['peak_rss_kb'])))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+"""
+Renders per second for each offered language, highlighting with a lexer
+and formatter built for every render (what snippets did before the
+registry in pasteapp.highlighting) against the registry's reused ones.
+Small snippets show the construction cost best.
+
+    python benchmarks/lexers.py --renders 200 --size 500
+"""
+import time
+import argparse
+
+from common import make_source
+
+from pasteapp import highlighting
+from pasteapp.highlighting import LANGUAGES, FORMATTER_OPTIONS
+
+def fresh_render(snippet_raw, snippet_lang):
+    from pygments import highlight
+    from pygments.lexers import get_lexer_by_name
+    from pygments.formatters import HtmlFormatter
+    from pygments.util import ClassNotFound
+    try:
+        lexer = get_lexer_by_name(snippet_lang.lower())
+    except ClassNotFound:
+        lexer = get_lexer_by_name('text')
+    return highlight(snippet_raw, lexer, HtmlFormatter(**FORMATTER_OPTIONS))
+
+def pooled_render(snippet_raw, snippet_lang):
+    return highlighting.render(snippet_raw, snippet_lang)[0]
+
+def rate(render, source, lang, renders):
+    start = time.time()
+    for i in range(renders):
+        render(source, lang)
+    return renders / max(time.time() - start, 1e-9)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--renders', type=int, default=200)
+    parser.add_argument('--size', type=int, default=500,
+                        help='characters of source per snippet')
+    args = parser.parse_args()
+
+    highlighting.preload()
+    print('%-12s %12s %12s %8s' % ('language', 'fresh/s', 'pooled/s',
+                                   'speedup'))
+    for lang, label in LANGUAGES:
+        source = make_source(lang, args.size).decode('utf-8')
+        # Once each first, so neither side pays for imports.
+        fresh_render(source, lang)
+        pooled_render(source, lang)
+        fresh = rate(fresh_render, source, lang, args.renders)
+        pooled = rate(pooled_render, source, lang, args.renders)
+        print('%-12s %12.0f %12.0f %7.2fx' % (lang, fresh, pooled,
+                                              pooled / fresh))
+    # What guessing adds to plain text snippets.
+    source = make_source('python', args.size).decode('utf-8')
+    plain = rate(pooled_render, source, 'text', args.renders)
+    highlighting.configure(guess=True)
+    guessed = rate(pooled_render, source, 'text', args.renders)
+    highlighting.configure()
+    print('\ntext snippets: %.0f/s, %.0f/s with guessing' % (plain, guessed))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+"""
+Measures how much data the index and dashboard pull out of the database
+when the snippets are large, comparing full Snippet rows (the old
+behaviour) with the lightweight projection the list pages now use.
+
+    python benchmarks/list_pages.py --snippets 200 --size 200000
+"""
+import time
+import shutil
+import argparse
+import tempfile
+
+from common import write_config
+
+from sqlalchemy.orm import undefer_group, joinedload
+
+from pasteapp import create_app
+from pasteapp.database import (
+    db_session, init_db, User, Snippet, SnippetBlob, snippet_summaries,
+    recount_snippets, RENDER_DONE
+)
+from pasteapp.highlighting import render
+
+SOURCE_LINE = "def handler(request, *args):  # %d\n    return request.args\n"
+
+def seed(count, size):
+    user = User('bench', 'bench@example.com', 'password')
+    db_session.add(user)
+    db_session.flush()
+    lines = size // len(SOURCE_LINE % 0) + 1
+    raw = ''.join(SOURCE_LINE % i for i in range(lines))
+    formatted, elapsed = render(raw, 'python')
+    for i in range(count):
+        blob = SnippetBlob('%040d' % i, formatted)
+        snippet = Snippet('Snippet %d' % i, 'python', user.id, raw)
+        snippet.blob = blob
+        snippet.render_state = RENDER_DONE
+        db_session.add(snippet)
+    recount_snippets(db_session)
+    db_session.commit()
+    return user.id
+
+def row_bytes(query):
+    """
+    Size of the values as the database returns them, before the
+    CompressedText columns are inflated.
+    """
+    compiled = query.with_labels().statement.compile(bind=db_session.bind)
+    cursor = db_session.connection().connection.cursor()
+    cursor.execute(unicode(compiled),
+                   [compiled.params[name] for name in compiled.positiontup])
+    total = 0
+    for row in cursor.fetchall():
+        for value in row:
+            if isinstance(value, (buffer, str, unicode)):
+                total += len(value)
+            elif value is not None:
+                total += len(unicode(value))
+    return total
+
+def time_query(query, repeat):
+    start = time.time()
+    for i in range(repeat):
+        db_session.execute(query.with_labels().statement).fetchall()
+    return (time.time() - start) / repeat * 1000
+
+def time_route(client, path, repeat):
+    start = time.time()
+    for i in range(repeat):
+        client.get(path)
+    return (time.time() - start) / repeat * 1000
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--snippets', type=int, default=200)
+    parser.add_argument('--size', type=int, default=200000,
+                        help='approximate bytes of source per snippet')
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    try:
+        app = create_app(write_config(directory))
+        with app.test_request_context():
+            init_db()
+            user_id = seed(args.snippets, args.size)
+
+            full = Snippet.query.options(undefer_group('body'),
+                                         joinedload('blob'))
+            light = snippet_summaries(db_session)
+            queries = [
+                ('index', lambda q: q.order_by(Snippet.id.desc()).limit(20)),
+                ('dashboard', lambda q: q.filter(Snippet.author_id == user_id)
+                                         .order_by(Snippet.id.desc())
+                                         .limit(10))
+            ]
+            print('%-10s %-6s %14s %10s' % ('page', 'rows', 'bytes', 'ms'))
+            for name, build in queries:
+                for label, query in (('full', full), ('light', light)):
+                    query = build(query)
+                    print('%-10s %-6s %14d %10.2f' % (
+                        name, label, row_bytes(query),
+                        time_query(query, args.repeat)))
+
+        client = app.test_client()
+        client.post('/login', data={'username': 'bench',
+                                    'password': 'password'})
+        print('')
+        print('%-20s %10s' % ('route', 'ms'))
+        for path in ('/', '/dashboard'):
+            print('%-20s %10.2f' % (path, time_route(client, path,
+                                                     args.repeat)))
+    finally:
+        shutil.rmtree(directory)
+
+if __name__ == '__main__':
+    main()
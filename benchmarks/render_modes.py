@@ -0,0 +1,68 @@
+"""
+Compares eager rendering (highlight on create) with lazy rendering
+(highlight on first view) for a write-heavy, read-sparse workload: every
+snippet is created, but only a fraction of them is ever viewed.
+
+    python benchmarks/render_modes.py --snippets 300 --view-ratio 0.1
+"""
+import time
+import random
+import shutil
+import argparse
+import tempfile
+
+from common import write_config, SAMPLE_SOURCES
+
+from pasteapp import create_app
+from pasteapp.database import db_session, init_db, User
+
+def run(mode, snippets, view_ratio, lines):
+    directory = tempfile.mkdtemp()
+    try:
+        app = create_app(write_config(directory, RENDER_MODE=mode,
+                                      RENDER_PROCESSES=0))
+        with app.test_request_context():
+            init_db()
+            db_session.add(User('bench', 'bench@example.com', 'password'))
+            db_session.commit()
+        client = app.test_client()
+        client.post('/login', data={'username': 'bench',
+                                    'password': 'password'})
+        languages = sorted(SAMPLE_SOURCES)
+        rng = random.Random(1)
+        start = time.time()
+        for i in range(snippets):
+            lang = languages[i % len(languages)]
+            source = ''.join('%s# %d\n' % (SAMPLE_SOURCES[lang], j)
+                             for j in range(lines))
+            client.post('/snippet/new', data={'title': 'Snippet %d' % i,
+                                              'language': lang,
+                                              'raw_content': source})
+        created = time.time() - start
+        viewed = rng.sample(range(1, snippets + 1),
+                            int(snippets * view_ratio))
+        start = time.time()
+        for snippet_id in viewed:
+            client.get('/snippet/view/%d' % snippet_id)
+        views = time.time() - start
+        return created, views, len(viewed)
+    finally:
+        shutil.rmtree(directory)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--snippets', type=int, default=300)
+    parser.add_argument('--view-ratio', type=float, default=0.1)
+    parser.add_argument('--lines', type=int, default=50,
+                        help='copies of the sample source per snippet')
+    args = parser.parse_args()
+
+    print('%-6s %12s %12s %12s' % ('mode', 'create s', 'view s', 'total s'))
+    for mode in ('eager', 'lazy'):
+        created, views, count = run(mode, args.snippets, args.view_ratio,
+                                    args.lines)
+        print('%-6s %12.2f %12.2f %12.2f' % (mode, created, views,
+                                             created + views))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,269 @@
+"""
+Load test for every route in the frontend blueprint. Seeds a SQLite
+database, then drives index, dashboard, view_snippet, new_snippet and
+login through the Flask test client and/or a real WSGI server, reporting
+p50/p95/p99 latency, requests per second and peak RSS as JSON.
+
+    python benchmarks/routes.py --users 10 --snippets 2000 \
+        --languages python:2000,cpp:20000,html:5000 --output before.json
+    python benchmarks/compare.py before.json after.json
+"""
+import sys
+import json
+import time
+import random
+import shutil
+import urllib
+import urllib2
+import argparse
+import tempfile
+import threading
+import cookielib
+import subprocess
+from SocketServer import ThreadingMixIn
+from wsgiref.simple_server import make_server, WSGIServer, WSGIRequestHandler
+
+from common import write_config, make_source, percentile, peak_rss_kb
+
+from pasteapp import create_app
+from pasteapp.bulk import Importer
+from pasteapp.database import db_session, init_db, User
+
+ROUTES = ('index', 'dashboard', 'view_snippet', 'new_snippet', 'login')
+PASSWORD = 'benchmark-password'
+
+def parse_languages(value):
+    """
+    'python:2000,cpp:20000' -> [('python', 2000), ('cpp', 20000)], the
+    number being the approximate paste size in characters.
+    """
+    languages = []
+    for item in value.split(','):
+        lang, size = item.split(':')
+        languages.append((lang, int(size)))
+    return languages
+
+def seed(users, snippets, languages):
+    for i in range(users):
+        db_session.add(User('user%d' % i, 'user%d@example.com' % i,
+                            PASSWORD))
+    db_session.commit()
+    records = []
+    for i in range(snippets):
+        lang, size = languages[i % len(languages)]
+        records.append(json.dumps({
+            'title': 'Snippet %d' % i,
+            'language': lang,
+            'author': 'user%d' % (i % users),
+            'raw': make_source(lang, size, i)
+        }))
+    Importer(db_session, batch_size=500).run(records)
+
+def make_request(route, rng, snippets, serial):
+    """
+    Returns (method, path, form data) for one request to the route.
+    """
+    if route == 'index':
+        return 'GET', '/', None
+    if route == 'dashboard':
+        return 'GET', '/dashboard', None
+    if route == 'view_snippet':
+        return 'GET', '/snippet/view/%d' % rng.randint(1, snippets), None
+    if route == 'new_snippet':
+        return 'POST', '/snippet/new', {
+            'title': 'Benchmark %d' % serial,
+            'language': 'python',
+            'raw_content': make_source('python', 2000, serial)
+        }
+    if route == 'login':
+        return 'POST', '/login', {'username': 'user0', 'password': PASSWORD}
+    raise ValueError(route)
+
+class TestClientDriver(object):
+
+    name = 'test_client'
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, data):
+        if method == 'GET':
+            rv = self.client.get(path)
+        else:
+            rv = self.client.post(path, data=data)
+        rv.data
+        return rv.status_code
+
+class QuietHandler(WSGIRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+class ServerDriver(object):
+    """
+    Serves the app from wsgiref in a background thread and talks to it
+    over HTTP, so the numbers include the socket and WSGI layers.
+    """
+
+    name = 'wsgi_server'
+
+    def __init__(self, app):
+        self.server = make_server('127.0.0.1', 0, app,
+                                  server_class=ThreadingWSGIServer,
+                                  handler_class=QuietHandler)
+        self.url = 'http://127.0.0.1:%d' % self.server.server_port
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.local = threading.local()
+
+    @property
+    def opener(self):
+        # One cookie jar per client thread, like separate browsers.
+        if not hasattr(self.local, 'opener'):
+            self.local.opener = urllib2.build_opener(
+                urllib2.HTTPCookieProcessor(cookielib.CookieJar()))
+        return self.local.opener
+
+    def request(self, method, path, data):
+        body = urllib.urlencode(data) if data is not None else None
+        try:
+            response = self.opener.open(self.url + path, body)
+            response.read()
+            return response.getcode()
+        except urllib2.HTTPError as e:
+            return e.code
+
+    def close(self):
+        self.server.shutdown()
+
+def run_route(driver, route, requests, concurrency, snippets):
+    latencies = []
+    spans = []
+    statuses = {}
+    lock = threading.Lock()
+
+    def worker(serials):
+        rng = random.Random(serials[0])
+        driver.request('POST', '/login', {'username': 'user0',
+                                          'password': PASSWORD})
+        for serial in serials:
+            method, path, data = make_request(route, rng, snippets, serial)
+            start = time.time()
+            status = driver.request(method, path, data)
+            elapsed = time.time() - start
+            with lock:
+                latencies.append(elapsed)
+                spans.append((start, start + elapsed))
+                statuses[status] = statuses.get(status, 0) + 1
+
+    serials = [range(i, requests, concurrency) for i in range(concurrency)]
+    threads = [threading.Thread(target=worker, args=(chunk,))
+               for chunk in serials if chunk]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # Measured from the first request to the last response, so the logins
+    # done by each client thread beforehand don't count.
+    wall = 0.0
+    if spans:
+        wall = max(end for start, end in spans) - min(start for start, end in spans)
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'statuses': dict((str(code), count) for code, count in statuses.items()),
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p95_ms': percentile(latencies, 0.95) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'req_per_sec': len(latencies) / wall if wall else 0.0,
+        'peak_rss_kb': peak_rss_kb()
+    }
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD']).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--users', type=int, default=10)
+    parser.add_argument('--snippets', type=int, default=1000)
+    parser.add_argument('--languages', type=parse_languages,
+                        default=parse_languages('python:2000,cpp:10000,'
+                                                'html:5000,haskell:3000'))
+    parser.add_argument('--database', choices=('file', 'memory'),
+                        default='file',
+                        help='memory only works with the test client')
+    parser.add_argument('--drivers', default='test_client,wsgi_server')
+    parser.add_argument('--routes', default=','.join(ROUTES))
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=1,
+                        help='client threads for the WSGI server driver')
+    parser.add_argument('--output', help='write the JSON report here')
+    args = parser.parse_args()
+
+    drivers = args.drivers.split(',')
+    if args.database == 'memory' and 'wsgi_server' in drivers:
+        parser.error('an in-memory database is private to one thread; '
+                     'use --database file with the WSGI server')
+
+    directory = tempfile.mkdtemp()
+    try:
+        # Every login comes from one address, which the throttle would
+        # otherwise turn away after the first few.
+        settings = {'RENDER_PROCESSES': 0, 'LOGIN_ATTEMPTS_PER_IP': 10 ** 9}
+        if args.database == 'memory':
+            settings['DATABASE'] = 'sqlite:///:memory:'
+        app = create_app(write_config(directory, **settings))
+        start = time.time()
+        with app.test_request_context():
+            init_db()
+            seed(args.users, args.snippets, args.languages)
+        report = {
+            'revision': git_revision(),
+            'settings': {
+                'users': args.users,
+                'snippets': args.snippets,
+                'languages': dict(args.languages),
+                'database': args.database,
+                'requests': args.requests,
+                'concurrency': args.concurrency
+            },
+            'seed_seconds': time.time() - start,
+            'results': {}
+        }
+        for name in drivers:
+            if name == 'wsgi_server':
+                driver = ServerDriver(app)
+                concurrency = args.concurrency
+            else:
+                driver = TestClientDriver(app)
+                concurrency = 1
+            results = report['results'][name] = {}
+            for route in args.routes.split(','):
+                results[route] = run_route(driver, route, args.requests,
+                                           concurrency, args.snippets)
+                sys.stderr.write('%-12s %-13s p50 %7.2fms  p99 %7.2fms  '
+                                 '%7.1f req/s\n' % (
+                                     name, route, results[route]['p50_ms'],
+                                     results[route]['p99_ms'],
+                                     results[route]['req_per_sec']))
+            if name == 'wsgi_server':
+                driver.close()
+        report['peak_rss_kb'] = peak_rss_kb()
+        output = json.dumps(report, indent=2, sort_keys=True)
+        if args.output:
+            with open(args.output, 'w') as out:
+                out.write(output + '\n')
+        else:
+            print(output)
+    finally:
+        shutil.rmtree(directory)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,191 @@
+"""
+Compares the sync gunicorn deployment with gevent workers running
+pasteapp.green on the read-heavy routes, under many slow clients. Each
+client sends its request headers in two parts, `--client-delay` seconds
+apart, the way a slow mobile connection would, which holds a sync worker
+for the whole time.
+
+    python benchmarks/serving.py --clients 500 --duration 20 \\
+        --output serving.json
+
+Needs gunicorn on PATH; the gevent deployment is skipped if gevent isn't
+installed.
+"""
+import sys
+import json
+import time
+import random
+import socket
+import shutil
+import argparse
+import tempfile
+import threading
+import subprocess
+
+from common import ROOT, write_config, percentile
+
+from pasteapp import create_app
+from pasteapp.database import db_session, init_db
+from routes import seed, parse_languages
+
+DEPLOYMENTS = {
+    'sync': ['-w', '{workers}', 'pasteapp:create_app("{config}")'],
+    'gevent': ['-k', 'gevent', '-w', '{workers}',
+               '--worker-connections', '{connections}',
+               'pasteapp.green:create_green_app("{config}")']
+}
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+def wait_for(port, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), 1).close()
+            return
+        except socket.error:
+            time.sleep(0.1)
+    raise RuntimeError('gunicorn did not start listening on %d' % port)
+
+def random_path(rng, snippets):
+    choice = rng.random()
+    snippet_id = rng.randint(1, snippets)
+    if choice < 0.2:
+        return '/'
+    if choice < 0.7:
+        return '/snippet/view/%d' % snippet_id
+    if choice < 0.9:
+        return '/snippet/raw/%d' % snippet_id
+    return '/search?q=fib'
+
+def slow_request(port, path, delay, timeout):
+    """
+    Sends one GET in two parts and reads the response, returning the
+    status code.
+    """
+    sock = socket.create_connection(('127.0.0.1', port), timeout)
+    try:
+        sock.sendall('GET %s HTTP/1.0\r\n' % path)
+        time.sleep(delay)
+        sock.sendall('Host: 127.0.0.1\r\n\r\n')
+        response = []
+        while True:
+            data = sock.recv(65536)
+            if not data:
+                break
+            response.append(data)
+        status_line = ''.join(response).split('\r\n', 1)[0]
+        return int(status_line.split()[1])
+    finally:
+        sock.close()
+
+def drive(port, clients, duration, delay, timeout, snippets):
+    latencies = []
+    statuses = {}
+    lock = threading.Lock()
+    deadline = time.time() + duration
+
+    def client(serial):
+        rng = random.Random(serial)
+        while time.time() < deadline:
+            start = time.time()
+            try:
+                status = slow_request(port, random_path(rng, snippets),
+                                      delay, timeout)
+            except (socket.error, ValueError, IndexError):
+                status = 'error'
+            elapsed = time.time() - start
+            with lock:
+                latencies.append(elapsed)
+                statuses[status] = statuses.get(status, 0) + 1
+
+    threads = [threading.Thread(target=client, args=(i,))
+               for i in range(clients)]
+    start = time.time()
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.time() - start
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'statuses': dict((str(code), count) for code, count in statuses.items()),
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'req_per_sec': len(latencies) / wall
+    }
+
+def has_gevent():
+    try:
+        import gevent
+    except ImportError:
+        return False
+    return True
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--users', type=int, default=10)
+    parser.add_argument('--snippets', type=int, default=1000)
+    parser.add_argument('--languages', type=parse_languages,
+                        default=parse_languages('python:2000,cpp:10000'))
+    parser.add_argument('--deployments', default='sync,gevent')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--connections', type=int, default=2000,
+                        help='worker connections for gevent workers')
+    parser.add_argument('--clients', type=int, default=200)
+    parser.add_argument('--client-delay', type=float, default=0.5)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--timeout', type=float, default=60)
+    parser.add_argument('--output', help='write the JSON report here')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    try:
+        config = write_config(directory, RENDER_PROCESSES=0)
+        app = create_app(config)
+        with app.test_request_context():
+            init_db()
+            seed(args.users, args.snippets, args.languages)
+        db_session.remove()
+        report = {'settings': dict(vars(args), languages=dict(args.languages)),
+                  'results': {}}
+        for name in args.deployments.split(','):
+            if name == 'gevent' and not has_gevent():
+                sys.stderr.write('gevent is not installed, skipping\n')
+                continue
+            port = free_port()
+            command = ['gunicorn', '-b', '127.0.0.1:%d' % port,
+                       '--timeout', str(int(args.timeout))]
+            command += [part.format(workers=args.workers, config=config,
+                                    connections=args.connections)
+                        for part in DEPLOYMENTS[name]]
+            server = subprocess.Popen(command, cwd=ROOT)
+            try:
+                wait_for(port)
+                result = drive(port, args.clients, args.duration,
+                               args.client_delay, args.timeout, args.snippets)
+            finally:
+                server.terminate()
+                server.wait()
+            report['results'][name] = result
+            sys.stderr.write('%-7s p50 %8.1fms  p99 %8.1fms  %7.1f req/s\n' % (
+                name, result['p50_ms'], result['p99_ms'],
+                result['req_per_sec']))
+        output = json.dumps(report, indent=2, sort_keys=True)
+        if args.output:
+            with open(args.output, 'w') as out:
+                out.write(output + '\n')
+        else:
+            print(output)
+    finally:
+        shutil.rmtree(directory)
+
+if __name__ == '__main__':
+    main()
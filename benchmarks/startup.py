@@ -0,0 +1,107 @@
+"""
+Measures worker start-up in fresh interpreters: the time to import
+pasteapp, to build the app, and to serve the first requests, with and
+without the PRELOAD warm-up that `gunicorn --preload` runs in the master.
+
+    python benchmarks/startup.py --runs 10 --output startup.json
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+from common import ROOT, write_config, make_source
+
+MODES = {
+    'cold': {'PRELOAD': False},
+    'preloaded': {'PRELOAD': True}
+}
+FIRST_REQUESTS = (
+    ('index', '/'),
+    # Formatter options force a highlight on demand.
+    ('view_python', '/snippet/view/1?linenos=0'),
+    ('view_cpp', '/snippet/view/2?linenos=0'),
+    ('view_python_again', '/snippet/view/1?linenos=0')
+)
+
+def child(cfg_file):
+    """
+    Runs in the fresh interpreter and prints its timings as JSON.
+    """
+    start = time.time()
+    import pasteapp
+    timings = {'import': time.time() - start}
+    start = time.time()
+    app = pasteapp.create_app(cfg_file)
+    timings['create_app'] = time.time() - start
+    client = app.test_client()
+    for name, path in FIRST_REQUESTS:
+        start = time.time()
+        rv = client.get(path)
+        rv.data
+        timings[name] = time.time() - start
+    timings['modules'] = len(sys.modules)
+    print(json.dumps(timings))
+
+def seed(directory):
+    from pasteapp import create_app
+    from pasteapp.database import db_session, init_db, User, Snippet
+    app = create_app(write_config(directory, RENDER_PROCESSES=0))
+    with app.test_request_context():
+        init_db()
+        db_session.add(User('user', 'user@example.com', 'password'))
+        db_session.add(Snippet('Python', 'python', 1,
+                               make_source('python', 5000)))
+        db_session.add(Snippet('C++', 'cpp', 1, make_source('cpp', 5000)))
+        db_session.commit()
+        db_session.remove()
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--output', help='write the JSON report here')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        return child(args.child)
+
+    directory = tempfile.mkdtemp()
+    try:
+        seed(directory)
+        report = {'runs': args.runs, 'results': {}}
+        for mode, settings in sorted(MODES.items()):
+            cfg_file = write_config(directory, RENDER_PROCESSES=0,
+                                    RENDER_MODE='lazy', **settings)
+            runs = []
+            for i in range(args.runs):
+                output = subprocess.check_output(
+                    [sys.executable, os.path.abspath(__file__),
+                     '--child', cfg_file], cwd=ROOT)
+                runs.append(json.loads(output.strip().splitlines()[-1]))
+            result = dict((name, median([run[name] for run in runs]))
+                          for name in runs[0])
+            report['results'][mode] = result
+            sys.stderr.write('%-9s import %6.1fms  create_app %6.1fms  '
+                             'first view %6.1fms\n' % (
+                                 mode, result['import'] * 1000,
+                                 result['create_app'] * 1000,
+                                 result['view_python'] * 1000))
+        output = json.dumps(report, indent=2, sort_keys=True)
+        if args.output:
+            with open(args.output, 'w') as out:
+                out.write(output + '\n')
+        else:
+            print(output)
+    finally:
+        shutil.rmtree(directory)
+
+if __name__ == '__main__':
+    main()
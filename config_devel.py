@@ -1,3 +1,83 @@
+import os
+
 DEBUG = True
 DATABASE = 'sqlite:///snippets.db'
 SECRET_KEY = 'some secret key for development'
+RENDER_PROCESSES = 2
+CACHE_TYPE = 'lru'
+# 'lazy' skips the render queue and highlights snippets on first view.
+RENDER_MODE = 'eager'
+# On-demand renders kept in each worker, in bytes.
+RENDER_CACHE_BYTES = 32 * 1024 * 1024
+# Highlight 'Plain Text' snippets as whichever offered language they
+# recognisably are (a shebang line, <?php, ...).
+GUESS_TEXT_LANGUAGE = True
+# Longer snippets are refused; request bodies are capped at
+# MAX_CONTENT_LENGTH, which defaults to four times this. Snippets over
+# SNIPPET_CHUNK_THRESHOLD characters are highlighted a page of
+# SNIPPET_LINES_PER_PAGE lines at a time when viewed.
+SNIPPET_MAX_LENGTH = 1000000
+SNIPPET_CHUNK_THRESHOLD = 200000
+SNIPPET_LINES_PER_PAGE = 2000
+# Records of rendered snippets kept in each worker, in bytes.
+SNIPPET_CACHE_BYTES = 16 * 1024 * 1024
+# Views are counted in memory and written out this often.
+VIEW_COUNT_FLUSH_SECONDS = 30
+# Most snippets one API request can create or fetch.
+API_BATCH_LIMIT = 100
+# What happens when a new snippet is within NEAR_DUPLICATE_DISTANCE bits
+# (at most 3) of an existing one in the same language: 'allow' records it
+# in duplicate_of, 'redirect' sends the author to the existing snippet
+# and 'reject' refuses it.
+NEAR_DUPLICATES = 'allow'
+NEAR_DUPLICATE_DISTANCE = 3
+# The recent snippets on the home page and in the feeds. 'local' lists are
+# refilled from the database every FEED_TIMEOUT seconds; 'redis' ones are
+# shared between workers (see FEED_OPTIONS for the host/port).
+FEED_BACKEND = 'local'
+FEED_SIZE = 20
+FEED_TIMEOUT = 60
+# Expired snippets are deleted, and with ARCHIVE_AFTER_DAYS set rendered
+# ones older than that with at most ARCHIVE_MAX_VIEWS views are moved to
+# archived_snippets, by `manage.py reap_snippets`: REAPER_BATCH_SIZE at a
+# time with a pause of REAPER_PAUSE_SECONDS between batches, stopping after
+# REAPER_MAX_BATCHES (None for no limit).
+REAPER_BATCH_SIZE = 500
+REAPER_PAUSE_SECONDS = 0.1
+REAPER_MAX_BATCHES = None
+ARCHIVE_AFTER_DAYS = None
+ARCHIVE_MAX_VIEWS = 0
+# Assets are served from their plain names until `manage.py build_assets`
+# has been run. Absolute, so it doesn't depend on the working directory.
+ASSET_BUILD_DIR = os.path.join(os.path.dirname(__file__), 'pasteapp', 'build')
+PYGMENTS_STYLE = 'default'
+# Server-Timing headers, /metrics and sampled cProfile dumps; see
+# pasteapp/profiling.py.
+INSTRUMENTATION = True
+PROFILE_DIR = 'profiles'
+PROFILE_SAMPLE_RATE = 0.1
+PROFILE_SLOW_SECONDS = 0.5
+BCRYPT_ROUNDS = 12
+HASH_WORKERS = 2
+HASH_QUEUE_LIMIT = 8
+# Reverse proxies in front of the app, so the rate limits and login
+# throttle see the client's address from X-Forwarded-For rather than
+# the proxy's. 0 when the app is reached directly.
+PROXY_COUNT = 0
+# Per minute.
+LOGIN_ATTEMPTS_PER_IP = 30
+LOGIN_FAILURES_PER_USERNAME = 10
+# 'local' counts login attempts in each worker; 'redis' counts them
+# across all of them (see LOGIN_THROTTLE_OPTIONS).
+LOGIN_THROTTLE_BACKEND = 'local'
+# Token buckets for the expensive endpoints (see pasteapp/limits.py):
+# {request class: {scope: (tokens per second, burst)}}. 'local' buckets
+# are per worker; 'redis' ones are shared (see RATE_LIMIT_OPTIONS).
+RATE_LIMIT_BACKEND = 'local'
+RATE_LIMITS = {
+    'create': {'user': (0.2, 10), 'ip': (0.5, 20), 'global': (10, 100)},
+    'read': {'user': (10, 100), 'ip': (5, 100), 'global': (500, 2000)}
+}
+# Limited requests one worker handles at once before shedding the rest
+# with a 503 (None for no limit).
+MAX_IN_FLIGHT = None
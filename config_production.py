@@ -2,4 +2,104 @@ import os
 
 DEBUG = False
 DATABASE = os.environ['DATABASE_URL']
+# Per worker process. Ignored for SQLite apart from the recycle time.
+DATABASE_POOL_SIZE = 5
+DATABASE_MAX_OVERFLOW = 5
+DATABASE_POOL_TIMEOUT = 10
+DATABASE_POOL_RECYCLE = 1800
+DATABASE_PRE_PING = True
+# GET requests read from the replica when one is set; anyone who has just
+# made a change reads from the primary for REPLICA_PIN_SECONDS.
+DATABASE_REPLICA = os.environ.get('DATABASE_REPLICA_URL')
+REPLICA_PIN_SECONDS = 10
 SECRET_KEY = <SOME PRIVATE KEY SHOULD GO HERE>
+RENDER_PROCESSES = 4
+# Warm up Pygments and the templates in create_app; run gunicorn with
+# --preload so that happens once in the master.
+PRELOAD = True
+# Filled by `manage.py build_assets`; served with far-future cache headers.
+ASSET_BUILD_DIR = os.path.join(os.path.dirname(__file__), 'pasteapp', 'build')
+PYGMENTS_STYLE = 'default'
+# 'redis' shares the cache between workers; see CACHE_OPTIONS for the
+# RedisCache host/port. 'lru' caches are per worker, and creating a
+# snippet only clears the home page cached by the worker that handled it,
+# so the other workers can show a home page up to INDEX_CACHE_TIMEOUT
+# seconds old. With 'redis' it can be raised to CACHE_DEFAULT_TIMEOUT.
+CACHE_TYPE = 'lru'
+CACHE_DEFAULT_TIMEOUT = 300
+INDEX_CACHE_TIMEOUT = 10
+RENDER_MODE = 'eager'
+# On-demand renders kept in each worker, in bytes.
+RENDER_CACHE_BYTES = 64 * 1024 * 1024
+# Highlight 'Plain Text' snippets as whichever offered language they
+# recognisably are (a shebang line, <?php, ...).
+GUESS_TEXT_LANGUAGE = True
+# Longer snippets are refused; request bodies are capped at
+# MAX_CONTENT_LENGTH, which defaults to four times this. Snippets over
+# SNIPPET_CHUNK_THRESHOLD characters are highlighted a page of
+# SNIPPET_LINES_PER_PAGE lines at a time when viewed.
+SNIPPET_MAX_LENGTH = 1000000
+SNIPPET_CHUNK_THRESHOLD = 200000
+SNIPPET_LINES_PER_PAGE = 2000
+# Records of rendered snippets kept in each worker, in bytes.
+SNIPPET_CACHE_BYTES = 64 * 1024 * 1024
+# Views are counted in memory and written out this often.
+VIEW_COUNT_FLUSH_SECONDS = 30
+# Most snippets one API request can create or fetch.
+API_BATCH_LIMIT = 100
+# What happens when a new snippet is within NEAR_DUPLICATE_DISTANCE bits
+# (at most 3) of an existing one in the same language: 'allow' records it
+# in duplicate_of, 'redirect' sends the author to the existing snippet
+# and 'reject' refuses it.
+NEAR_DUPLICATES = 'redirect'
+NEAR_DUPLICATE_DISTANCE = 3
+# The recent snippets on the home page and in the feeds. 'local' lists are
+# refilled from the database every FEED_TIMEOUT seconds; 'redis' ones are
+# shared between workers (see FEED_OPTIONS for the host/port).
+FEED_BACKEND = 'local'
+FEED_SIZE = 20
+# Kept as short as INDEX_CACHE_TIMEOUT, since the home page lists these.
+FEED_TIMEOUT = 10
+# Expired snippets are deleted, and with ARCHIVE_AFTER_DAYS set rendered
+# ones older than that with at most ARCHIVE_MAX_VIEWS views are moved to
+# archived_snippets, by `manage.py reap_snippets`: REAPER_BATCH_SIZE at a
+# time with a pause of REAPER_PAUSE_SECONDS between batches, stopping after
+# REAPER_MAX_BATCHES (None for no limit).
+REAPER_BATCH_SIZE = 500
+REAPER_PAUSE_SECONDS = 1.0
+REAPER_MAX_BATCHES = None
+ARCHIVE_AFTER_DAYS = 365
+ARCHIVE_MAX_VIEWS = 0
+# Server-Timing headers and /metrics (keep it off the public proxy); set
+# PROFILE_DIR to also sample cProfile dumps of slow requests.
+INSTRUMENTATION = False
+PROFILE_SAMPLE_RATE = 0.01
+PROFILE_SLOW_SECONDS = 1.0
+BCRYPT_ROUNDS = 12
+# At most HASH_WORKERS + HASH_QUEUE_LIMIT password hashes run or wait at
+# once; with --preload that is counted across all the workers.
+HASH_WORKERS = 2
+HASH_QUEUE_LIMIT = 8
+# Reverse proxies in front of the app, so the rate limits and login
+# throttle see the client's address from X-Forwarded-For rather than
+# the proxy's. 0 when the app is reached directly.
+PROXY_COUNT = 1
+# Per minute.
+LOGIN_ATTEMPTS_PER_IP = 30
+LOGIN_FAILURES_PER_USERNAME = 10
+# 'local' counts login attempts in each worker; 'redis' counts them
+# across all of them (see LOGIN_THROTTLE_OPTIONS).
+LOGIN_THROTTLE_BACKEND = 'local'
+# Token buckets for the expensive endpoints (see pasteapp/limits.py):
+# {request class: {scope: (tokens per second, burst)}}. 'local' buckets
+# are per worker; 'redis' ones are shared (see RATE_LIMIT_OPTIONS).
+RATE_LIMIT_BACKEND = 'local'
+RATE_LIMITS = {
+    'create': {'user': (0.2, 10), 'ip': (0.5, 20), 'global': (10, 100)},
+    'read': {'user': (10, 100), 'ip': (5, 100), 'global': (500, 2000)}
+}
+# Limited requests one worker handles at once before shedding the rest
+# with a 503 (None for no limit).
+MAX_IN_FLIGHT = 32
+# Database connections per gevent worker (see pasteapp/green.py).
+GREEN_POOL_SIZE = 20
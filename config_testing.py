@@ -3,3 +3,8 @@ TESTING = True
 DATABASE = 'sqlite:///:memory:'
 SECRET_KEY = 'some_secret_key_for_testing'
 CSRF_ENABLED = False
+RENDER_PROCESSES = 0
+CACHE_TYPE = 'lru'
+RENDER_MODE = 'eager'
+INSTRUMENTATION = True
+BCRYPT_ROUNDS = 4
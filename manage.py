@@ -1,9 +1,27 @@
+import sys
+import time
 from os.path import abspath
+from multiprocessing import cpu_count
 
 from flask import current_app
 from flask.ext.script import Manager
 from pasteapp import create_app
-from pasteapp.database import init_db, clear_db
+from pasteapp.database import (
+    init_db, clear_db, db_session, recount_snippets, compress_legacy_rows,
+    Snippet, SnippetBlob, User, RENDER_PENDING, add_missing_columns,
+    migrate_legacy_renders
+)
+from pasteapp.render_queue import render_queue, pending_snippets
+from pasteapp import bulk, database
+from pasteapp.assets import build_assets as build_asset_files
+from pasteapp.search import rebuild_index, search_backend
+from pasteapp.similarity import backfill_fingerprints
+from pasteapp.feed import recent_feed
+from pasteapp.archive import reap
+from pasteapp.cache import cache
+from pasteapp.views.frontend import (
+    CHUNK_THRESHOLD, INDEX_CACHE_KEY, MOST_VIEWED_CACHE_KEY
+)
 
 manager = Manager(create_app)
 manager.add_option('-c', '--config', type=abspath, dest='cfg_file',
@@ -19,5 +37,172 @@ def drop_db():
     with current_app.app_context():
         clear_db()
 
+@manager.command
+def render_backlog():
+    with current_app.app_context():
+        pending = Snippet.query.filter(Snippet.render_state == RENDER_PENDING)
+        oldest = pending.order_by(Snippet.id).first()
+        print('Pending renders: %d' % pending.count())
+        if oldest:
+            print('Oldest pending: %s' % oldest.created_date)
+
+@manager.command
+def requeue_pending():
+    with current_app.app_context():
+        count = 0
+        for snippet in pending_snippets():
+            render_queue.submit(snippet)
+            count += 1
+        render_queue.join()
+        print('Requeued %d snippets' % count)
+
+@manager.command
+def recount_user_snippets():
+    with current_app.app_context():
+        recount_snippets(db_session)
+        db_session.commit()
+
+@manager.command
+def compress_snippets(batch_size=500):
+    with current_app.app_context():
+        add_missing_columns(database.db_engine)
+        raw = compress_legacy_rows(db_session, Snippet.__table__,
+                                   'snippet_raw', 'raw_size',
+                                   int(batch_size))
+        formatted = compress_legacy_rows(db_session, SnippetBlob.__table__,
+                                         'formatted', 'size', int(batch_size))
+        print('Compressed %d snippets and %d rendered blobs' %
+              (raw, formatted))
+
+@manager.command
+def export_snippets(path='-', batch_size=500):
+    with current_app.app_context():
+        out = sys.stdout if path == '-' else open(path, 'w')
+        try:
+            count = bulk.export_snippets(db_session, out, int(batch_size))
+        finally:
+            if out is not sys.stdout:
+                out.close()
+        sys.stderr.write('Exported %d snippets\n' % count)
+
+@manager.command
+def import_snippets(path='-', batch_size=500, transaction_size=5000,
+                    workers=None, author=None):
+    with current_app.app_context():
+        if workers is None:
+            workers = current_app.config.get('RENDER_PROCESSES') or cpu_count()
+        lazy = current_app.config.get('RENDER_MODE', 'eager') == 'lazy'
+        importer = bulk.Importer(db_session,
+                                 batch_size=int(batch_size),
+                                 commit_every=int(transaction_size),
+                                 processes=int(workers),
+                                 default_author=author,
+                                 render=not lazy,
+                                 chunk_threshold=current_app.config.get(
+                                     'SNIPPET_CHUNK_THRESHOLD',
+                                     CHUNK_THRESHOLD))
+        lines = sys.stdin if path == '-' else open(path)
+        start = time.time()
+        try:
+            count = importer.run(lines)
+        finally:
+            if lines is not sys.stdin:
+                lines.close()
+        # The feeds are refilled from the database on their next use.
+        recent_feed.clear()
+        elapsed = time.time() - start
+        print('Imported %d snippets (%d skipped) in %.1fs: %.0f snippets/sec' %
+              (count, importer.skipped, elapsed, count / max(elapsed, 1e-6)))
+
+@manager.command
+def rebuild_search_index(batch_size=500):
+    with current_app.app_context():
+        # Creates the index tables on databases from before search existed.
+        init_db()
+        start = time.time()
+        count = rebuild_index(db_session, int(batch_size))
+        print('Indexed %d snippets with %s in %.1fs' %
+              (count, search_backend(db_session), time.time() - start))
+
+@manager.command
+def upgrade_db():
+    with current_app.app_context():
+        added = add_missing_columns(database.db_engine)
+        if 'users.snippet_count' in added:
+            recount_snippets(db_session)
+            db_session.commit()
+        print('Added %s' % ', '.join(added) if added else 'Up to date')
+        migrated = migrate_legacy_renders(db_session)
+        if migrated:
+            print('Moved %d rendered snippets into snippet_blobs' % migrated)
+
+@manager.command
+def fingerprint_snippets(batch_size=500, workers=None):
+    with current_app.app_context():
+        add_missing_columns(database.db_engine)
+        if workers is None:
+            workers = current_app.config.get('RENDER_PROCESSES') or cpu_count()
+        start = time.time()
+        count = backfill_fingerprints(db_session, int(batch_size),
+                                      int(workers))
+        print('Fingerprinted %d snippets in %.1fs' %
+              (count, time.time() - start))
+
+@manager.command
+def reap_snippets(batch_size=None, pause=None, interval=None):
+    """
+    Deletes expired snippets and archives cold ones; with --interval, keeps
+    doing so every that many seconds.
+    """
+    with current_app.app_context():
+        add_missing_columns(database.db_engine)
+        config = current_app.config
+        if batch_size is None:
+            batch_size = config.get('REAPER_BATCH_SIZE', 500)
+        if pause is None:
+            pause = config.get('REAPER_PAUSE_SECONDS', 1.0)
+        while True:
+            start = time.time()
+            expired, archived = reap(
+                db_session, int(batch_size), float(pause),
+                max_batches=config.get('REAPER_MAX_BATCHES'),
+                archive_after_days=config.get('ARCHIVE_AFTER_DAYS'),
+                max_views=config.get('ARCHIVE_MAX_VIEWS', 0))
+            if expired or archived:
+                recent_feed.clear()
+                cache.delete(INDEX_CACHE_KEY)
+                cache.delete(MOST_VIEWED_CACHE_KEY)
+            print('Expired %d and archived %d snippets in %.1fs' %
+                  (expired, archived, time.time() - start))
+            if interval is None:
+                return
+            time.sleep(float(interval))
+
+@manager.command
+def create_api_token(username):
+    with current_app.app_context():
+        # Creates the tokens table on databases from before the API.
+        init_db()
+        user_id = db_session.query(User.id) \
+                            .filter(User.username == username).scalar()
+        if user_id is None:
+            print('No such user %r' % username)
+            return
+        token = database.create_api_token(db_session, user_id)
+        db_session.commit()
+        print(token)
+
+@manager.command
+def build_assets():
+    with current_app.app_context():
+        build_dir = current_app.config.get('ASSET_BUILD_DIR')
+        if not build_dir:
+            print('Set ASSET_BUILD_DIR in the config first')
+            return
+        manifest = build_asset_files(
+            current_app.static_folder, build_dir,
+            current_app.config.get('PYGMENTS_STYLE', 'default'))
+        print('Built %d assets into %s' % (len(manifest), build_dir))
+
 if __name__ == '__main__':
     manager.run()
@@ -1,14 +1,134 @@
 from os.path import abspath
-from flask import Flask
+from time import time
+from flask import Flask, request, session
 from pasteapp.views.frontend import frontend
-from pasteapp.database import initialise_engine
+from pasteapp.views.assets import static_assets, asset_url
+from pasteapp.views.api import api
+from pasteapp.assets import asset_manifest
+from pasteapp import database
+from pasteapp.database import initialise_engine, db_session, use_replica
+from pasteapp.render_queue import render_queue
+from pasteapp.cache import cache, render_cache, snippet_cache
+from pasteapp.counters import view_counter
+from pasteapp.feed import recent_feed, FEED_SIZE
+from pasteapp.auth import hash_pool, ip_throttle, username_throttle
+from pasteapp.profiling import instrument
+from pasteapp.limits import (
+    rate_limiter, admission, limit_requests, ForwardedFor
+)
+from pasteapp import highlighting
+from pasteapp.highlighting import preload
+from pasteapp.forms import MAX_SNIPPET_LENGTH
 
-def create_app(cfg_file):
+def create_app(cfg_file, **engine_options):
     app = Flask(__name__)
     app.config.from_pyfile(abspath(cfg_file))
+    if app.config.get('MAX_CONTENT_LENGTH') is None:
+        # Werkzeug refuses bigger bodies before reading them. Allows for
+        # form encoding; SnippetForm checks the exact length.
+        app.config['MAX_CONTENT_LENGTH'] = 4 * app.config.get(
+            'SNIPPET_MAX_LENGTH', MAX_SNIPPET_LENGTH)
+    if app.config.get('INSTRUMENTATION', False):
+        instrument(app)
+    if app.config.get('PROXY_COUNT'):
+        app.wsgi_app = ForwardedFor(app.wsgi_app, app.config['PROXY_COUNT'])
 
     db_uri = app.config['DATABASE']
-    initialise_engine(db_uri)
+    options = {
+        'replica_uri': app.config.get('DATABASE_REPLICA'),
+        'pre_ping': app.config.get('DATABASE_PRE_PING', False)
+    }
+    for name in ('pool_size', 'max_overflow', 'pool_timeout', 'pool_recycle'):
+        value = app.config.get('DATABASE_' + name.upper())
+        if value is not None:
+            options[name] = value
+    options.update(engine_options)
+    initialise_engine(db_uri, **options)
+    # Before the render pool forks, so its processes see the setting.
+    highlighting.configure(guess=app.config.get('GUESS_TEXT_LANGUAGE',
+                                                False))
+    render_queue.configure(processes=app.config.get('RENDER_PROCESSES', 0))
+    cache.configure(app.config.get('CACHE_TYPE', 'null'),
+                    threshold=app.config.get('CACHE_THRESHOLD', 500),
+                    default_timeout=app.config.get('CACHE_DEFAULT_TIMEOUT', 300),
+                    **app.config.get('CACHE_OPTIONS', {}))
+    render_cache.configure('sized',
+                           threshold=app.config.get('RENDER_CACHE_BYTES',
+                                                    32 * 1024 * 1024),
+                           default_timeout=app.config.get('RENDER_CACHE_TIMEOUT',
+                                                          3600))
+    snippet_cache.configure('sized',
+                            threshold=app.config.get('SNIPPET_CACHE_BYTES',
+                                                     16 * 1024 * 1024),
+                            default_timeout=app.config.get(
+                                'SNIPPET_CACHE_TIMEOUT', 3600))
+    view_counter.configure(app.config.get('VIEW_COUNT_FLUSH_SECONDS', 30))
+    recent_feed.configure(app.config.get('FEED_BACKEND', 'local'),
+                          size=app.config.get('FEED_SIZE', FEED_SIZE),
+                          timeout=app.config.get('FEED_TIMEOUT', 60),
+                          **app.config.get('FEED_OPTIONS', {}))
+    hash_pool.configure(workers=app.config.get('HASH_WORKERS', 2),
+                        queue_limit=app.config.get('HASH_QUEUE_LIMIT', 8),
+                        rounds=app.config.get('BCRYPT_ROUNDS', 12))
+    throttle_backend = app.config.get('LOGIN_THROTTLE_BACKEND', 'local')
+    throttle_options = app.config.get('LOGIN_THROTTLE_OPTIONS', {})
+    ip_throttle.configure(limit=app.config.get('LOGIN_ATTEMPTS_PER_IP', 30),
+                          backend=throttle_backend, **throttle_options)
+    username_throttle.configure(
+        limit=app.config.get('LOGIN_FAILURES_PER_USERNAME', 10),
+        backend=throttle_backend, **throttle_options)
+    rate_limiter.configure(app.config.get('RATE_LIMIT_BACKEND', 'local'),
+                           limits=app.config.get('RATE_LIMITS'),
+                           **app.config.get('RATE_LIMIT_OPTIONS', {}))
+    admission.configure(max_in_flight=app.config.get('MAX_IN_FLIGHT'),
+                        retry_after=app.config.get('SHED_RETRY_AFTER', 1))
+    # Ahead of the other hooks, so refused requests do as little as
+    # possible.
+    limit_requests(app)
+
+    pin_seconds = app.config.get('REPLICA_PIN_SECONDS', 10)
+
+    @app.before_request
+    def route_reads():
+        # Someone who has just written is kept on the primary for a while,
+        # so they see their own changes despite replication lag.
+        if database.replica_engine is not None and \
+           request.method in ('GET', 'HEAD') and \
+           session.get('primary_until', 0) < time():
+            use_replica()
+
+    @app.after_request
+    def pin_writers(response):
+        if database.replica_engine is not None and \
+           request.method not in ('GET', 'HEAD'):
+            session['primary_until'] = time() + pin_seconds
+        return response
+
+    @app.teardown_request
+    def remove_session(exception=None):
+        # Renders are written back by another session, so a session kept
+        # alive between requests would keep serving the pending copy.
+        db_session.remove()
+        if view_counter.due():
+            view_counter.flush()
+
+    asset_manifest.configure(app.config.get('ASSET_BUILD_DIR'),
+                             app.config.get('PYGMENTS_STYLE', 'default'))
+    app.jinja_env.globals['asset_url'] = asset_url
 
     app.register_blueprint(frontend)
+    app.register_blueprint(static_assets)
+    app.register_blueprint(api, url_prefix='/api/v1')
+    if app.config.get('PRELOAD', False):
+        warm_up(app)
     return app
+
+def warm_up(app):
+    """
+    Builds the Pygments lexers and formatters and compiles every template,
+    so that with `gunicorn --preload` the forked workers start with them
+    already in (copy-on-write) memory. No database connection is opened.
+    """
+    preload()
+    for name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(name)
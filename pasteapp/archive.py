@@ -0,0 +1,147 @@
+"""
+Snippet expiry and archival, run by the reap_snippets command in
+manage.py.
+
+Snippets past their expires_at are deleted, along with their search
+entries, fingerprint bands and any rendered HTML no other snippet
+shares. With ARCHIVE_AFTER_DAYS set, rendered snippets older than that
+and viewed at most ARCHIVE_MAX_VIEWS times are moved to
+archived_snippets, where view_snippet still finds them; they drop out
+of the listings and search. Both work in batches of REAPER_BATCH_SIZE,
+committing and sleeping REAPER_PAUSE_SECONDS after each, so a large
+backlog is worked through without holding locks or saturating the
+database for long.
+
+Expired snippets that haven't been reaped yet are already hidden from
+viewing, the listings, the feeds and search, so the reaper needn't run
+often.
+"""
+import datetime
+from time import sleep
+
+from sqlalchemy import text
+
+from pasteapp.database import (
+    Snippet, SnippetBlob, ArchivedSnippet, SnippetBand,
+    increment_snippet_count, unexpired, ARCHIVED_COLUMNS, RENDER_DONE,
+    RENDER_CHUNKED
+)
+from pasteapp.search import unindex_snippets
+from pasteapp.metrics import metrics
+
+def remove_snippets(session, rows):
+    """
+    Deletes (id, author_id) rows from snippets, and everything that refers
+    to them. Doesn't commit.
+    """
+    ids = [snippet_id for snippet_id, author_id in rows]
+    unindex_snippets(session, ids)
+    session.query(SnippetBand).filter(SnippetBand.snippet_id.in_(ids)) \
+           .delete(synchronize_session=False)
+    session.query(Snippet).filter(Snippet.duplicate_of.in_(ids)) \
+           .update({'duplicate_of': None}, synchronize_session=False)
+    authors = {}
+    for snippet_id, author_id in rows:
+        if author_id is not None:
+            authors[author_id] = authors.get(author_id, 0) + 1
+    for author_id, count in sorted(authors.items()):
+        increment_snippet_count(session, author_id, -count)
+    session.query(Snippet).filter(Snippet.id.in_(ids)) \
+           .delete(synchronize_session=False)
+
+def remove_unused_blobs(session, blob_ids):
+    """
+    Deletes those of the blobs that no snippet, live or archived, uses.
+    Doesn't commit.
+    """
+    if not blob_ids:
+        return
+    used = set(blob_id for (blob_id,) in
+               session.query(Snippet.blob_id)
+                      .filter(Snippet.blob_id.in_(blob_ids)).distinct())
+    used.update(blob_id for (blob_id,) in
+                session.query(ArchivedSnippet.blob_id)
+                       .filter(ArchivedSnippet.blob_id.in_(blob_ids))
+                       .distinct())
+    unused = [blob_id for blob_id in blob_ids if blob_id not in used]
+    if unused:
+        session.query(SnippetBlob).filter(SnippetBlob.id.in_(unused)) \
+               .delete(synchronize_session=False)
+
+def expire_batch(session, now, batch_size):
+    """
+    Deletes up to batch_size snippets that expired before `now`, and
+    archived ones too. Doesn't commit. Returns the number deleted.
+    """
+    rows = session.query(Snippet.id, Snippet.author_id, Snippet.blob_id) \
+                  .filter(Snippet.expires_at <= now) \
+                  .order_by(Snippet.expires_at).limit(batch_size).all()
+    if rows:
+        remove_snippets(session, [(row.id, row.author_id) for row in rows])
+    archived = session.query(ArchivedSnippet.id, ArchivedSnippet.blob_id) \
+                      .filter(ArchivedSnippet.expires_at <= now) \
+                      .limit(batch_size - len(rows)).all()
+    if archived:
+        session.query(ArchivedSnippet) \
+               .filter(ArchivedSnippet.id.in_([row.id for row in archived])) \
+               .delete(synchronize_session=False)
+    blob_ids = set(row.blob_id for row in rows + archived if row.blob_id)
+    remove_unused_blobs(session, sorted(blob_ids))
+    return len(rows) + len(archived)
+
+def archive_batch(session, cutoff, max_views, batch_size):
+    """
+    Moves up to batch_size rendered snippets created before `cutoff` and
+    viewed at most max_views times to archived_snippets. Doesn't commit.
+    Returns the number moved.
+    """
+    rows = session.query(Snippet.id, Snippet.author_id) \
+                  .filter(Snippet.created_date < cutoff) \
+                  .filter(Snippet.view_count <= max_views) \
+                  .filter(Snippet.render_state.in_([RENDER_DONE,
+                                                    RENDER_CHUNKED])) \
+                  .filter(unexpired()) \
+                  .order_by(Snippet.id).limit(batch_size).all()
+    if not rows:
+        return 0
+    # Copied within the database, so the compressed source is never
+    # loaded; the ids are integers from the query above.
+    columns = ', '.join(ARCHIVED_COLUMNS)
+    session.execute(text(
+        'INSERT INTO %s (%s, archived_date) SELECT %s, :archived_date '
+        'FROM %s WHERE id IN (%s)' % (
+            ArchivedSnippet.__tablename__, columns, columns,
+            Snippet.__tablename__,
+            ', '.join(str(int(row.id)) for row in rows))),
+        {'archived_date': datetime.datetime.now()})
+    remove_snippets(session, [(row.id, row.author_id) for row in rows])
+    return len(rows)
+
+def reap(session, batch_size=500, pause=1.0, max_batches=None,
+         archive_after_days=None, max_views=0):
+    """
+    Deletes expired snippets, then archives cold ones if
+    archive_after_days is set, batch_size at a time until there are none
+    left or max_batches have run. Returns the numbers (expired, archived).
+    """
+    totals = {'expired': 0, 'archived': 0}
+    steps = [('expired', lambda: expire_batch(
+        session, datetime.datetime.now(), batch_size))]
+    if archive_after_days is not None:
+        steps.append(('archived', lambda: archive_batch(
+            session,
+            datetime.datetime.now() -
+            datetime.timedelta(days=archive_after_days),
+            max_views, batch_size)))
+    batches = 0
+    for name, step in steps:
+        while max_batches is None or batches < max_batches:
+            done = step()
+            session.commit()
+            if not done:
+                break
+            batches += 1
+            totals[name] += done
+            metrics.incr('snippets_' + name, done)
+            sleep(pause)
+    return totals['expired'], totals['archived']
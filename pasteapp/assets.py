@@ -0,0 +1,113 @@
+"""
+Builds the static assets for long-lived caching. `manage.py build_assets`
+copies every file under pasteapp/static, plus a stylesheet generated for
+PYGMENTS_STYLE, into ASSET_BUILD_DIR under a name containing a hash of
+its content, with gzip (and, if the brotli module is installed, brotli)
+variants alongside and a manifest mapping the plain names to the hashed
+ones. Old hashed files are left in place so pages cached before a rebuild
+keep working.
+
+Templates link assets with asset_url('style.css'); see
+pasteapp.views.assets for how they are served.
+"""
+import os
+import gzip
+import json
+import hashlib
+
+PYGMENTS_CSS = 'pygments.css'
+MANIFEST = 'manifest.json'
+COMPRESSIBLE = ('.css', '.js', '.svg', '.txt', '.html')
+
+def pygments_css(style='default'):
+    from pygments.formatters import HtmlFormatter
+    return HtmlFormatter(style=style).get_style_defs('.source')
+
+def hashed_name(name, content):
+    digest = hashlib.sha1(content).hexdigest()[:12]
+    root, ext = os.path.splitext(name)
+    return '%s.%s%s' % (root, digest, ext)
+
+def compress_variants(path, content):
+    """
+    Writes path.gz and, when brotli is available, path.br, skipping any
+    that wouldn't be smaller than the original.
+    """
+    with open(path + '.gz', 'wb') as raw:
+        # A fixed mtime keeps rebuilds byte-for-byte identical.
+        with gzip.GzipFile(os.path.basename(path), 'wb', 9, raw, 0) as out:
+            out.write(content)
+    if os.path.getsize(path + '.gz') >= len(content):
+        os.remove(path + '.gz')
+    try:
+        import brotli
+    except ImportError:
+        return
+    compressed = brotli.compress(content)
+    if len(compressed) < len(content):
+        with open(path + '.br', 'wb') as out:
+            out.write(compressed)
+
+def source_files(static_dir, style):
+    """
+    Yields (name, content) for every asset, names relative to static_dir.
+    """
+    for directory, dirs, files in os.walk(static_dir):
+        for filename in sorted(files):
+            path = os.path.join(directory, filename)
+            name = os.path.relpath(path, static_dir).replace(os.sep, '/')
+            with open(path, 'rb') as source:
+                yield name, source.read()
+    yield PYGMENTS_CSS, pygments_css(style).encode('utf-8')
+
+def build_assets(static_dir, build_dir, style='default'):
+    """
+    Returns the new manifest.
+    """
+    manifest = {}
+    for name, content in source_files(static_dir, style):
+        hashed = hashed_name(name, content)
+        path = os.path.join(build_dir, hashed)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        if not os.path.exists(path):
+            with open(path, 'wb') as out:
+                out.write(content)
+            if name.endswith(COMPRESSIBLE):
+                compress_variants(path, content)
+        manifest[name] = hashed
+    # Written last and renamed into place, so a running app never sees a
+    # manifest naming files that aren't there yet.
+    tmp_path = os.path.join(build_dir, MANIFEST + '.tmp')
+    with open(tmp_path, 'w') as out:
+        json.dump(manifest, out, indent=2, sort_keys=True)
+    os.rename(tmp_path, os.path.join(build_dir, MANIFEST))
+    return manifest
+
+class AssetManifest(object):
+    """
+    The manifest of the last build, loaded when the app is created. Empty
+    if assets haven't been built, in which case assets are served from
+    their plain names without long-lived caching.
+    """
+
+    def __init__(self):
+        self.configure(None)
+
+    def configure(self, build_dir, style='default'):
+        self.build_dir = build_dir
+        self.style = style
+        self.names = {}
+        self.hashed = set()
+        if build_dir and os.path.exists(os.path.join(build_dir, MANIFEST)):
+            with open(os.path.join(build_dir, MANIFEST)) as manifest:
+                self.names = json.load(manifest)
+            self.hashed = set(self.names.values())
+
+    def url_name(self, name):
+        return self.names.get(name, name)
+
+    def is_hashed(self, name):
+        return name in self.hashed
+
+asset_manifest = AssetManifest()
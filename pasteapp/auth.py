@@ -0,0 +1,212 @@
+import os
+import hashlib
+import threading
+from time import time
+from multiprocessing import BoundedSemaphore, TimeoutError
+from multiprocessing.pool import ThreadPool
+
+import bcrypt
+
+from pasteapp.metrics import metrics
+from pasteapp.profiling import record
+
+class HashPoolSaturated(Exception):
+    pass
+
+def hash_password(plaintext, rounds):
+    return bcrypt.hashpw(plaintext, bcrypt.gensalt(rounds))
+
+def check_password(plaintext, hashed):
+    return bcrypt.hashpw(plaintext, hashed) == hashed
+
+def new_api_token():
+    return os.urandom(20).encode('hex')
+
+def api_token_digest(token):
+    """
+    API tokens are random, so unlike passwords a plain SHA-256 is enough
+    to keep them from being usable straight out of the database.
+    """
+    return hashlib.sha256(token).hexdigest()
+
+def hash_rounds(hashed):
+    """
+    The cost factor of a '$2a$12$...' hash.
+    """
+    try:
+        return int(hashed.split('$')[2])
+    except (AttributeError, IndexError, ValueError):
+        return None
+
+class HashPool(object):
+    """
+    Runs bcrypt on a small pool of threads (py-bcrypt releases the GIL
+    while hashing). At most `workers` hashes run at once and `queue_limit`
+    more may wait; anything beyond that fails straight away with
+    HashPoolSaturated so a login flood can't tie up every worker. A hash
+    still unfinished after `timeout` seconds raises HashPoolSaturated too,
+    though it keeps its slot until it does finish.
+
+    The slots are a process-shared semaphore, so when create_app runs in
+    the gunicorn master (--preload) they are counted across every worker
+    it forks; a sync worker, handling one request at a time, would never
+    find its own slots taken. A worker killed in the middle of a hash
+    keeps that slot until the master restarts.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pool = None
+        self._pool_pid = None
+        self.configure()
+
+    def configure(self, workers=2, queue_limit=8, timeout=30, rounds=12):
+        with self._lock:
+            if self._pool is not None and self._pool_pid == os.getpid():
+                self._pool.terminate()
+            self._pool = None
+            self.workers = workers
+            self.timeout = timeout
+            self.rounds = rounds
+            self._slots = BoundedSemaphore(workers + queue_limit)
+
+    def _get_pool(self):
+        with self._lock:
+            if self._pool is None or self._pool_pid != os.getpid():
+                self._pool = ThreadPool(self.workers)
+                self._pool_pid = os.getpid()
+            return self._pool
+
+    def run(self, func, *args):
+        if not self._slots.acquire(False):
+            metrics.incr('hash_pool_rejected')
+            raise HashPoolSaturated()
+        metrics.add_gauge('hash_pool_in_use', 1)
+        start = time()
+        try:
+            return self._get_pool().apply_async(
+                self._job, (self._slots, func, args)).get(self.timeout)
+        except TimeoutError:
+            metrics.incr('hash_pool_timeouts')
+            raise HashPoolSaturated()
+        finally:
+            record('hash', time() - start)
+
+    def _job(self, slots, func, args):
+        start = time()
+        try:
+            return func(*args)
+        finally:
+            metrics.add_gauge('hash_pool_in_use', -1)
+            metrics.observe('hash_seconds', time() - start)
+            slots.release()
+
+class LocalCounterBackend(object):
+    """
+    Counters kept in this process, so each worker counts separately.
+    """
+
+    def __init__(self, max_keys=100000):
+        self.max_keys = max_keys
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def incr(self, key, timeout):
+        """
+        Adds one to the counter and returns its new value. A new counter
+        expires after `timeout` seconds.
+        """
+        now = time()
+        with self._lock:
+            count, expires = self._counts.get(key, (0, 0))
+            if expires <= now:
+                count, expires = 0, now + timeout
+            self._counts[key] = (count + 1, expires)
+            if len(self._counts) > self.max_keys:
+                self._purge(now)
+            return count + 1
+
+    def get(self, key):
+        with self._lock:
+            count, expires = self._counts.get(key, (0, 0))
+            return count if expires > time() else 0
+
+    def _purge(self, now):
+        for key, (count, expires) in self._counts.items():
+            if expires <= now:
+                del self._counts[key]
+
+    def clear(self):
+        with self._lock:
+            self._counts.clear()
+
+class RedisCounterBackend(object):
+    """
+    Counters shared between workers, using Redis' atomic INCR.
+    """
+
+    def __init__(self, host='localhost', port=6379, password=None, db=0,
+                 key_prefix='throttle/'):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError('The redis login throttle backend needs the '
+                               'redis module')
+        self.key_prefix = key_prefix
+        self._client = redis.Redis(host=host, port=port, password=password,
+                                   db=db)
+
+    def incr(self, key, timeout):
+        pipe = self._client.pipeline()
+        pipe.incr(self.key_prefix + key)
+        pipe.expire(self.key_prefix + key, timeout)
+        return pipe.execute()[0]
+
+    def get(self, key):
+        return int(self._client.get(self.key_prefix + key) or 0)
+
+    def clear(self):
+        keys = self._client.keys(self.key_prefix + '*')
+        if keys:
+            self._client.delete(*keys)
+
+class AttemptThrottle(object):
+    """
+    Counts attempts per key in fixed windows of `window` seconds. The
+    'local' backend counts in each worker; 'redis' counts across all of
+    them.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.configure()
+
+    def configure(self, limit=10, window=60, backend='local', **options):
+        self.limit = limit
+        self.window = window
+        if backend == 'local':
+            self.backend = LocalCounterBackend(**options)
+        elif backend == 'redis':
+            self.backend = RedisCounterBackend(**options)
+        else:
+            raise ValueError('Unknown login throttle backend %r' % backend)
+
+    def _key(self, key):
+        return '%s/%s/%d' % (self.name, key, time() // self.window)
+
+    def exceeded(self, key):
+        return self.backend.get(self._key(key)) >= self.limit
+
+    def hit(self, key):
+        """
+        Counts an attempt. Returns True if it was within the limit.
+        """
+        return self.backend.incr(self._key(key), self.window) <= self.limit
+
+    @property
+    def retry_after(self):
+        return int(self.window - time() % self.window) + 1
+
+hash_pool = HashPool()
+ip_throttle = AttemptThrottle('ip')
+username_throttle = AttemptThrottle('username')
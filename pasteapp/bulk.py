@@ -0,0 +1,305 @@
+"""
+Bulk export and import of snippets as JSON Lines, one snippet per line:
+
+    {"title": ..., "language": ..., "author": ..., "created_date": ...,
+     "raw": ...}
+
+Used by the export_snippets and import_snippets commands in manage.py;
+the API's batch create shares the render and insert steps.
+"""
+import json
+import datetime
+from itertools import imap
+from functools import partial
+
+from collections import deque
+from multiprocessing import Pool
+
+from sqlalchemy import func, text
+
+from pasteapp.database import (
+    User, Snippet, SnippetBlob, recount_snippets, increment_snippet_count,
+    RENDER_DONE, RENDER_PENDING, RENDER_CHUNKED
+)
+from pasteapp.highlighting import render, render_digest
+from pasteapp.search import index_snippets
+from pasteapp.similarity import fingerprint, index_fingerprints
+
+DATE_FORMATS = ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S')
+
+def export_snippets(session, out, batch_size=500):
+    """
+    Writes every snippet to `out`, reading batch_size rows at a time.
+    Returns the number of snippets written.
+    """
+    query = session.query(Snippet.id, Snippet.title, Snippet.snippet_lang,
+                          Snippet.created_date, Snippet.snippet_raw,
+                          User.username) \
+                   .outerjoin(User, Snippet.author_id == User.id) \
+                   .order_by(Snippet.id)
+    last_id = 0
+    written = 0
+    while True:
+        rows = query.filter(Snippet.id > last_id).limit(batch_size).all()
+        if not rows:
+            return written
+        for row in rows:
+            record = {
+                'title': row.title,
+                'language': row.snippet_lang,
+                'author': row.username,
+                'created_date': row.created_date and row.created_date.isoformat(),
+                'raw': row.snippet_raw
+            }
+            out.write(json.dumps(record) + '\n')
+        written += len(rows)
+        last_id = rows[-1].id
+
+def read_batches(lines, batch_size):
+    batch = []
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        batch.append(json.loads(line))
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def render_batch(batch, chunk_threshold=None):
+    """
+    Runs in the pool. Returns the batch, with each record's fingerprint
+    added, along with a (digest, formatted) pair per snippet; content
+    repeated within the batch is only rendered once. Snippets over
+    chunk_threshold are left alone, since they are highlighted a page at
+    a time when viewed.
+    """
+    rendered = {}
+    results = []
+    for record in batch:
+        if 'simhash' not in record:
+            record['simhash'] = fingerprint(record['raw'])
+        if chunk_threshold is not None and \
+           len(record['raw']) > chunk_threshold:
+            results.append((None, None))
+            continue
+        digest = render_digest(record['raw'], record['language'])
+        if digest not in rendered:
+            rendered[digest], elapsed = render(record['raw'],
+                                               record['language'])
+        results.append((digest, rendered[digest]))
+    return batch, results
+
+def skip_render(batch):
+    for record in batch:
+        record['simhash'] = fingerprint(record['raw'])
+    return batch, [(None, None)] * len(batch)
+
+def store_blobs(session, rendered):
+    """
+    Takes (digest, formatted) pairs from render_batch and returns a dict
+    of digest to blob id, inserting the blobs that aren't stored yet in
+    one executemany.
+    """
+    digests = set(digest for digest, formatted in rendered if digest)
+    if not digests:
+        return {}
+    query = session.query(SnippetBlob.digest, SnippetBlob.id)
+    known = dict(query.filter(SnippetBlob.digest.in_(digests)))
+    missing = {}
+    for digest, formatted in rendered:
+        if digest and digest not in known:
+            missing[digest] = formatted
+    if missing:
+        session.execute(SnippetBlob.__table__.insert(), [
+            {'digest': digest, 'formatted': formatted,
+             'size': len(formatted)}
+            for digest, formatted in missing.items()
+        ])
+        known.update(query.filter(SnippetBlob.digest.in_(missing)))
+    return known
+
+def create_snippets(session, author_id, records, rendered,
+                    chunk_threshold=None):
+    """
+    Adds one author's snippets for records already through render_batch
+    (or skip_render) and indexes them; the caller commits. A record may
+    carry the id of the snippet it nearly duplicates as 'duplicate_of',
+    and a 'blob_id' to use instead of a render. Unlike Importer it goes
+    through the ORM, so the new snippets come back with their ids.
+    """
+    blob_ids = store_blobs(session, rendered)
+    snippets = []
+    for record, (digest, formatted) in zip(records, rendered):
+        snippet = Snippet(record['title'], record['language'], author_id,
+                          record['raw'])
+        snippet.simhash = record['simhash']
+        snippet.duplicate_of = record.get('duplicate_of')
+        if record.get('blob_id'):
+            snippet.blob_id = record['blob_id']
+            snippet.render_state = RENDER_DONE
+        elif digest:
+            snippet.blob_id = blob_ids[digest]
+            snippet.render_state = RENDER_DONE
+        elif chunk_threshold is not None and \
+             snippet.raw_size > chunk_threshold:
+            snippet.render_state = RENDER_CHUNKED
+        snippets.append(snippet)
+    session.add_all(snippets)
+    increment_snippet_count(session, author_id, len(snippets))
+    session.flush()
+    index_snippets(session, [(snippet.id, snippet.title, snippet.snippet_raw)
+                             for snippet in snippets])
+    index_fingerprints(session, [(snippet.id, snippet.simhash)
+                                 for snippet in snippets])
+    return snippets
+
+def bounded_imap(pool, func, items, window):
+    """
+    Like pool.imap, but only reads `window` items ahead of the results
+    taken; imap's feeder thread reads its whole input up front.
+    """
+    pending = deque()
+    for item in items:
+        pending.append(pool.apply_async(func, (item,)))
+        if len(pending) >= window:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+def parse_date(value):
+    if not value:
+        return datetime.datetime.now()
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.datetime.strptime(value, date_format)
+        except ValueError:
+            pass
+    raise ValueError('Unrecognised created_date %r' % value)
+
+class Importer(object):
+    """
+    Inserts snippets read from JSON Lines. Batches are highlighted in a
+    process pool while the previous batch is being inserted, with at most
+    two per process read ahead so memory stays flat however long the
+    input is. Each batch goes in as one executemany for the blobs and one
+    for the snippets, and is added to the search index in the same
+    transaction.
+    """
+
+    def __init__(self, session, batch_size=500, commit_every=5000,
+                 processes=0, default_author=None, render=True,
+                 chunk_threshold=None):
+        self.session = session
+        self.batch_size = batch_size
+        self.commit_every = commit_every
+        self.processes = processes
+        self.render = render
+        self.chunk_threshold = chunk_threshold
+        self.authors = {}
+        self.default_author_id = None
+        if default_author is not None:
+            self.default_author_id = self.author_id(default_author)
+            if self.default_author_id is None:
+                raise ValueError('No such user %r' % default_author)
+        self.imported = 0
+        self.skipped = 0
+
+    def author_id(self, username):
+        if username not in self.authors:
+            self.authors[username] = self.session.query(User.id) \
+                .filter(User.username == username).scalar()
+        return self.authors[username]
+
+    def run(self, lines):
+        batches = read_batches(lines, self.batch_size)
+        job = skip_render
+        if self.render:
+            job = partial(render_batch, chunk_threshold=self.chunk_threshold)
+        pool = None
+        if self.processes and self.render:
+            pool = Pool(self.processes)
+            results = bounded_imap(pool, job, batches, self.processes * 2)
+        else:
+            results = imap(job, batches)
+        try:
+            uncommitted = 0
+            for batch, rendered in results:
+                uncommitted += self.insert(batch, rendered)
+                if uncommitted >= self.commit_every:
+                    self.session.commit()
+                    uncommitted = 0
+            recount_snippets(self.session)
+            self.session.commit()
+        finally:
+            if pool is not None:
+                pool.terminate()
+        return self.imported
+
+    def blob_ids(self, rendered):
+        return store_blobs(self.session, rendered)
+
+    def render_state(self, record, digest):
+        if digest:
+            return RENDER_DONE
+        if self.chunk_threshold is not None and \
+           len(record['raw']) > self.chunk_threshold:
+            return RENDER_CHUNKED
+        return RENDER_PENDING
+
+    def insert(self, batch, rendered):
+        blob_ids = self.blob_ids(rendered)
+        rows = []
+        for record, (digest, formatted) in zip(batch, rendered):
+            author_id = self.author_id(record.get('author'))
+            if author_id is None:
+                author_id = self.default_author_id
+            if author_id is None:
+                self.skipped += 1
+                continue
+            rows.append({
+                'title': record['title'],
+                'snippet_lang': record['language'],
+                'author_id': author_id,
+                'snippet_raw': record['raw'],
+                'raw_size': len(record['raw']),
+                'blob_id': blob_ids.get(digest),
+                'render_state': self.render_state(record, digest),
+                'simhash': record['simhash'],
+                'created_date': parse_date(record.get('created_date'))
+            })
+        if rows:
+            ids = self.insert_rows(rows)
+            index_snippets(self.session, [
+                (snippet_id, row['title'], row['snippet_raw'])
+                for snippet_id, row in zip(ids, rows)
+            ])
+            index_fingerprints(self.session, [
+                (snippet_id, row['simhash'])
+                for snippet_id, row in zip(ids, rows)
+            ])
+        self.imported += len(rows)
+        return len(rows)
+
+    def insert_rows(self, rows):
+        """
+        Inserts the snippets in one executemany and returns their ids in
+        order, which an executemany doesn't report. On PostgreSQL they are
+        taken from the table's sequence first and inserted explicitly. On
+        SQLite the insert holds the write lock until the commit, so the
+        rows get consecutive rowids ending at the largest in the table.
+        """
+        insert = Snippet.__table__.insert()
+        if self.session.get_bind().dialect.name == 'postgresql':
+            ids = [row[0] for row in self.session.execute(text(
+                "SELECT nextval(pg_get_serial_sequence('snippets', 'id')) "
+                "FROM generate_series(1, :count)"), {'count': len(rows)})]
+            for snippet_id, row in zip(ids, rows):
+                row['id'] = snippet_id
+            self.session.execute(insert, rows)
+            return ids
+        self.session.execute(insert, rows)
+        last_id = self.session.query(func.max(Snippet.id)).scalar()
+        return range(last_id - len(rows) + 1, last_id + 1)
@@ -0,0 +1,163 @@
+import threading
+from time import time
+from collections import OrderedDict
+
+from werkzeug.contrib.cache import (
+    BaseCache, NullCache, SimpleCache, RedisCache
+)
+
+class LRUCache(BaseCache):
+    """
+    In-process cache that evicts the least recently used entry once more
+    than `threshold` items are stored. Values are kept as they are rather
+    than pickled, so callers shouldn't mutate what they get back.
+    """
+
+    def __init__(self, threshold=500, default_timeout=300):
+        BaseCache.__init__(self, default_timeout)
+        self._threshold = threshold
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._items.pop(key, None)
+            if item is None:
+                return None
+            expires, value = item
+            if expires <= time():
+                return None
+            self._items[key] = item
+            return value
+
+    def set(self, key, value, timeout=None):
+        if timeout is None:
+            timeout = self.default_timeout
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = (time() + timeout, value)
+            while len(self._items) > self._threshold:
+                self._items.popitem(last=False)
+
+    def add(self, key, value, timeout=None):
+        with self._lock:
+            item = self._items.get(key)
+            if item is not None and item[0] > time():
+                return
+        self.set(key, value, timeout)
+
+    def delete(self, key):
+        with self._lock:
+            self._items.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+def approximate_size(value):
+    """
+    A rough count of the bytes held by a value made of strings, numbers
+    and containers of them: string contents plus a fixed overhead per
+    object, which is close enough to keep a cache within its budget.
+    """
+    if isinstance(value, basestring):
+        return 40 + len(value) * (4 if isinstance(value, unicode) else 1)
+    if isinstance(value, dict):
+        return 100 + sum(approximate_size(key) + approximate_size(item)
+                         for key, item in value.iteritems())
+    if isinstance(value, (list, tuple, set)):
+        return 60 + sum(approximate_size(item) for item in value)
+    return 32
+
+class SizedLRUCache(LRUCache):
+    """
+    LRUCache bounded by the approximate bytes of the values it holds
+    rather than their number, for values whose sizes vary by orders of
+    magnitude. A value bigger than the whole budget is not stored.
+    """
+
+    def __init__(self, max_bytes=16 * 1024 * 1024, default_timeout=300,
+                 sizeof=approximate_size):
+        LRUCache.__init__(self, None, default_timeout)
+        self._max_bytes = max_bytes
+        self._sizeof = sizeof
+        self._sizes = {}
+        self._bytes = 0
+
+    @property
+    def size(self):
+        return self._bytes
+
+    def get(self, key):
+        with self._lock:
+            item = self._items.pop(key, None)
+            if item is None:
+                return None
+            expires, value = item
+            if expires <= time():
+                self._bytes -= self._sizes.pop(key)
+                return None
+            self._items[key] = item
+            return value
+
+    def set(self, key, value, timeout=None):
+        if timeout is None:
+            timeout = self.default_timeout
+        size = self._sizeof(value)
+        with self._lock:
+            if self._items.pop(key, None) is not None:
+                self._bytes -= self._sizes.pop(key)
+            if size > self._max_bytes:
+                return
+            self._items[key] = (time() + timeout, value)
+            self._sizes[key] = size
+            self._bytes += size
+            while self._bytes > self._max_bytes:
+                evicted, item = self._items.popitem(last=False)
+                self._bytes -= self._sizes.pop(evicted)
+
+    def delete(self, key):
+        with self._lock:
+            if self._items.pop(key, None) is not None:
+                self._bytes -= self._sizes.pop(key)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._sizes.clear()
+            self._bytes = 0
+
+class Cache(object):
+    """
+    Forwards to whichever werkzeug cache backend has been configured, so
+    modules can import `cache` before the app exists. The 'simple' backend
+    is the local stand-in for 'redis', which is shared between workers.
+    For 'sized', the threshold is in bytes rather than entries.
+    """
+
+    def __init__(self):
+        self.backend = NullCache()
+
+    def configure(self, cache_type='null', threshold=500, default_timeout=300,
+                  **options):
+        if cache_type == 'lru':
+            self.backend = LRUCache(threshold, default_timeout)
+        elif cache_type == 'sized':
+            self.backend = SizedLRUCache(threshold, default_timeout)
+        elif cache_type == 'simple':
+            self.backend = SimpleCache(threshold, default_timeout)
+        elif cache_type == 'redis':
+            self.backend = RedisCache(default_timeout=default_timeout,
+                                      **options)
+        elif cache_type == 'null':
+            self.backend = NullCache(default_timeout)
+        else:
+            raise ValueError('Unknown cache type %r' % cache_type)
+
+    def __getattr__(self, name):
+        return getattr(self.backend, name)
+
+cache = Cache()
+render_cache = Cache()
+# Finished snippets' records for view_snippet; always in-process.
+snippet_cache = Cache()
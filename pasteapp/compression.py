@@ -0,0 +1,60 @@
+import zlib
+import codecs
+
+# Stored values are a format byte followed by the payload. The zlib payload
+# is exactly what HTTP calls the 'deflate' content coding, so it can be sent
+# to clients as is.
+FORMAT_ZLIB = b'\x01'
+COMPRESSION_LEVEL = 6
+MAX_INFLATE = 256 * 1024
+
+def compress(text):
+    return FORMAT_ZLIB + zlib.compress(text.encode('utf-8'), COMPRESSION_LEVEL)
+
+def is_compressed(value):
+    """
+    Rows written before compression was introduced come back from the
+    database as plain text rather than bytes with a format byte.
+    """
+    if value is None or isinstance(value, unicode):
+        return False
+    return bytes(value[:1]) == FORMAT_ZLIB
+
+def decompress(value):
+    if value is None or isinstance(value, unicode):
+        return value
+    value = bytes(value)
+    if not value.startswith(FORMAT_ZLIB):
+        return value.decode('utf-8')
+    return zlib.decompress(value[1:]).decode('utf-8')
+
+def iter_decompressed(chunks):
+    """
+    Decompresses a stored value that is delivered in pieces, such as by
+    pasteapp.database.iter_stored, yielding text as it goes. No piece of
+    output is larger than MAX_INFLATE bytes however well the input packs.
+    """
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    decompressor = None
+    for index, chunk in enumerate(chunks):
+        if isinstance(chunk, unicode):
+            yield chunk
+            continue
+        chunk = bytes(chunk)
+        if index == 0 and chunk.startswith(FORMAT_ZLIB):
+            decompressor = zlib.decompressobj()
+            chunk = chunk[1:]
+        if decompressor is None:
+            text = decoder.decode(chunk)
+            if text:
+                yield text
+            continue
+        while chunk:
+            text = decoder.decode(decompressor.decompress(chunk, MAX_INFLATE))
+            if text:
+                yield text
+            chunk = decompressor.unconsumed_tail
+    tail = decompressor.flush() if decompressor is not None else b''
+    text = decoder.decode(tail, final=True)
+    if text:
+        yield text
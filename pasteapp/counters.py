@@ -0,0 +1,81 @@
+"""
+Snippet view counts, kept in memory and added to snippets.view_count in
+one batched UPDATE every VIEW_COUNT_FLUSH_SECONDS rather than written on
+every view. The flush runs at the end of whichever request finds it due,
+and once more when the worker exits cleanly; counts held by a worker
+that is killed are lost, which is fine for a popularity ranking.
+"""
+import atexit
+import threading
+from time import time
+
+from sqlalchemy import bindparam
+from sqlalchemy.exc import SQLAlchemyError
+
+from pasteapp import database
+from pasteapp.database import Snippet
+from pasteapp.metrics import metrics
+
+class ViewCounter(object):
+
+    def __init__(self):
+        self.interval = 30
+        self._pending = {}
+        self._last_flush = time()
+        self._lock = threading.Lock()
+
+    def configure(self, interval=30):
+        self.interval = interval
+
+    def hit(self, snippet_id):
+        with self._lock:
+            self._pending[snippet_id] = self._pending.get(snippet_id, 0) + 1
+
+    @property
+    def pending(self):
+        with self._lock:
+            return dict(self._pending)
+
+    def due(self):
+        return bool(self._pending) and \
+            time() - self._last_flush >= self.interval
+
+    def clear(self):
+        with self._lock:
+            self._pending = {}
+
+    def flush(self):
+        """
+        Writes out the counts gathered so far through the primary engine,
+        never the request's session, which may be reading from a replica.
+        On failure the counts are kept for the next flush. Returns the
+        number of snippets updated.
+        """
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._last_flush = time()
+        if not pending or database.db_engine is None:
+            return 0
+        table = Snippet.__table__
+        update = table.update() \
+            .where(table.c.id == bindparam('snippet_id')) \
+            .values(view_count=table.c.view_count + bindparam('views'))
+        # Always in id order, so concurrent flushes from other workers
+        # can't deadlock on each other's row locks.
+        rows = [{'snippet_id': snippet_id, 'views': views}
+                for snippet_id, views in sorted(pending.items())]
+        try:
+            database.db_engine.execute(update, rows)
+        except SQLAlchemyError:
+            metrics.incr('view_count_flush_errors')
+            with self._lock:
+                for snippet_id, views in pending.items():
+                    self._pending[snippet_id] = \
+                        self._pending.get(snippet_id, 0) + views
+            return 0
+        metrics.incr('view_count_flushes')
+        metrics.incr('views_flushed', sum(pending.values()))
+        return len(rows)
+
+view_counter = ViewCounter()
+atexit.register(view_counter.flush)
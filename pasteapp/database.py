@@ -1,21 +1,53 @@
 from sqlalchemy import (
-    create_engine, Column, Integer, String, Text, DateTime, ForeignKey
+    create_engine, event, Column, Integer, BigInteger, String, DateTime,
+    ForeignKey, Index, LargeBinary, select, func, bindparam, literal_column,
+    text, or_
 )
+from sqlalchemy.types import TypeDecorator
 from sqlalchemy.orm import (
-    scoped_session, sessionmaker, relationship, backref
+    scoped_session, sessionmaker, relationship, backref, deferred, Session
 )
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.exc import IntegrityError, DisconnectionError
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.engine.reflection import Inspector
+from sqlalchemy.util import ScopedRegistry
 
-from pygments import highlight
-from pygments.lexers import get_lexer_by_name
-from pygments.formatters import HtmlFormatter
-from pygments.util import ClassNotFound
+from pasteapp.highlighting import render, lexer_name, lexer_digest
+from pasteapp.compression import compress, decompress, is_compressed
+from pasteapp.compression import iter_decompressed
+from pasteapp.auth import (
+    hash_pool, hash_password, check_password, new_api_token, api_token_digest
+)
+from pasteapp.metrics import metrics
 
-import bcrypt
 import datetime
+from time import time
+
+RENDER_PENDING = 'pending'
+RENDER_DONE = 'done'
+RENDER_FAILED = 'failed'
+# Too large to highlight in one go; viewed a range of lines at a time.
+RENDER_CHUNKED = 'chunked'
 
 db_engine = None
-db_session = scoped_session(sessionmaker(autoflush=True))
+replica_engine = None
+
+class RoutingSession(Session):
+    """
+    Sends everything to the primary engine unless use_replica is set, in
+    which case reads go to the replica. Flushes always go to the primary.
+    """
+    use_replica = False
+
+    def get_bind(self, mapper=None, clause=None):
+        if self.use_replica and replica_engine is not None and \
+           not self._flushing:
+            return replica_engine
+        return Session.get_bind(self, mapper, clause)
+
+db_session = scoped_session(sessionmaker(autoflush=True,
+                                         class_=RoutingSession))
 
 Base = declarative_base()
 Base.query = db_session.query_property()
@@ -26,11 +58,132 @@ def init_db():
 def clear_db():
     Base.metadata.drop_all(bind=db_engine)
 
-def initialise_engine(db_uri):
-    global db_engine
-    db_engine = create_engine(db_uri, convert_unicode=True)
+class TimedQueuePool(QueuePool):
+    """
+    QueuePool that records how long each checkout waited for a connection.
+    """
+    label = 'primary'
+
+    def _do_get(self):
+        start = time()
+        try:
+            return QueuePool._do_get(self)
+        finally:
+            metrics.observe('db_pool_wait_seconds', time() - start,
+                            engine=self.label)
+            metrics.set_gauge('db_pool_overflow', max(self.overflow(), 0),
+                              engine=self.label)
+
+    def recreate(self):
+        pool = QueuePool.recreate(self)
+        pool.label = self.label
+        return pool
+
+def ping_connection(dbapi_connection, connection_record, connection_proxy):
+    """
+    Checks a connection still works before handing it out, so one dropped
+    by the server (or a failover) is replaced instead of failing a request.
+    """
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute('SELECT 1')
+    except Exception:
+        raise DisconnectionError()
+    finally:
+        cursor.close()
+
+def instrument_pool(engine, label, pre_ping=False):
+    if isinstance(engine.pool, TimedQueuePool):
+        engine.pool.label = label
+
+    def checkout(dbapi_connection, connection_record, connection_proxy):
+        metrics.add_gauge('db_pool_checked_out', 1, engine=label)
+
+    def checkin(dbapi_connection, connection_record):
+        metrics.add_gauge('db_pool_checked_out', -1, engine=label)
+
+    if pre_ping:
+        event.listen(engine, 'checkout', ping_connection)
+    event.listen(engine, 'checkout', checkout)
+    event.listen(engine, 'checkin', checkin)
+
+def pool_options(db_uri, pool_size=None, max_overflow=None, pool_timeout=None,
+                 pool_recycle=None):
+    """
+    create_engine options for a pooled engine. SQLite keeps the pool
+    SQLAlchemy picks for it (none for files, one connection per thread
+    in memory), so only recycling applies there.
+    """
+    options = {}
+    if pool_recycle is not None:
+        options['pool_recycle'] = pool_recycle
+    if db_uri.startswith('sqlite'):
+        return options
+    options['poolclass'] = TimedQueuePool
+    for name, value in (('pool_size', pool_size),
+                        ('max_overflow', max_overflow),
+                        ('pool_timeout', pool_timeout)):
+        if value is not None:
+            options[name] = value
+    return options
+
+def initialise_engine(db_uri, replica_uri=None, pre_ping=False, **options):
+    """
+    Creates the engine(s) behind db_session. `options` are the pool
+    settings taken by pool_options(), or create_engine arguments.
+    """
+    global db_engine, replica_engine
+    for engine in (db_engine, replica_engine):
+        if engine is not None:
+            engine.dispose()
+    pool_settings = dict((name, options.pop(name)) for name in
+                         ('pool_size', 'max_overflow', 'pool_timeout',
+                          'pool_recycle') if name in options)
+    db_engine = create_engine(db_uri, convert_unicode=True,
+                              **dict(pool_options(db_uri, **pool_settings),
+                                     **options))
+    instrument_pool(db_engine, 'primary', pre_ping)
+    replica_engine = None
+    if replica_uri:
+        replica_engine = create_engine(replica_uri, convert_unicode=True,
+                                       **dict(pool_options(replica_uri,
+                                                           **pool_settings),
+                                              **options))
+        instrument_pool(replica_engine, 'replica', pre_ping)
     db_session.configure(bind=db_engine)
 
+def use_replica(enabled=True):
+    """
+    Routes the current scoped session's reads to the replica, if there is
+    one. Set per request; see create_app.
+    """
+    db_session().use_replica = enabled
+
+def scope_sessions(scopefunc):
+    """
+    Keys db_session by scopefunc() rather than by thread, e.g. per greenlet.
+    Sessions are still removed at the end of each request.
+    """
+    db_session.registry = ScopedRegistry(db_session.session_factory,
+                                         scopefunc)
+
+class CompressedText(TypeDecorator):
+    """
+    Text stored zlib compressed behind a format byte. Values from before
+    the column was compressed are still read back as plain text, and
+    compress_legacy_rows rewrites them.
+    """
+    impl = LargeBinary
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        return compress(value)
+
+    def result_processor(self, dialect, coltype):
+        # LargeBinary's own processor would str() legacy unicode values.
+        return decompress
+
 class User(Base):
     __tablename__ = 'users'
 
@@ -38,17 +191,56 @@ class User(Base):
     username = Column(String(100), unique=True)
     email = Column(String(100), unique=True)
     password = Column(String())
+    snippet_count = Column(Integer, default=0)
 
-    def __init__(self, username, email, plaintext):
+    def __init__(self, username, email, plaintext=None, password=None):
+        """
+        Takes either the plaintext password or, when it has already been
+        hashed through pasteapp.auth.hash_pool, the bcrypt hash.
+        """
         self.username = username
         self.email = email
-        self.password = self.generate_bcrypt_hash(plaintext)
+        if password is None:
+            password = self.generate_bcrypt_hash(plaintext)
+        self.password = password
+        self.snippet_count = 0
 
     def generate_bcrypt_hash(self, plaintext):
-        return bcrypt.hashpw(plaintext, bcrypt.gensalt())
+        return hash_password(plaintext, hash_pool.rounds)
 
     def check_bcrypt_hash(self, plaintext):
-        return bcrypt.hashpw(plaintext, self.password) == self.password
+        return check_password(plaintext, self.password)
+
+class ApiToken(Base):
+    """
+    A token for the JSON API, stored as api_token_digest(token). Created
+    with `manage.py create_api_token`.
+    """
+    __tablename__ = 'api_tokens'
+
+    id = Column(Integer, primary_key=True)
+    digest = Column(String(64), unique=True, index=True)
+    user_id = Column(Integer, ForeignKey('users.id'))
+    user = relationship("User")
+    created_date = Column(DateTime())
+
+    def __init__(self, user_id, digest):
+        self.user_id = user_id
+        self.digest = digest
+        self.created_date = datetime.datetime.now()
+
+def create_api_token(session, user_id):
+    """
+    Adds a token for the user and returns it. Only the digest is stored,
+    so this is the one chance to see the token itself.
+    """
+    token = new_api_token()
+    session.add(ApiToken(user_id, api_token_digest(token)))
+    return token
+
+def api_token_user_id(session, token):
+    return session.query(ApiToken.user_id) \
+                  .filter(ApiToken.digest == api_token_digest(token)).scalar()
 
 class Snippet(Base):
     __tablename__ = 'snippets'
@@ -58,23 +250,353 @@ class Snippet(Base):
     snippet_lang = Column(String(30))
     author_id = Column(Integer, ForeignKey('users.id'))
     author = relationship("User", backref=backref('snippets', order_by=id))
-    snippet_raw = Column(Text())
-    snippet_formatted = Column(Text())
+    # The source and rendered HTML can be hundreds of KB, so they are only
+    # loaded when a single snippet is viewed. See snippet_summaries().
+    snippet_raw = deferred(Column(CompressedText()), group='body')
+    raw_size = Column(Integer)
+    blob_id = Column(Integer, ForeignKey('snippet_blobs.id'))
+    blob = relationship("SnippetBlob")
+    render_state = Column(String(10), default=RENDER_PENDING)
     created_date = Column(DateTime())
+    # Lags behind by up to VIEW_COUNT_FLUSH_SECONDS; see pasteapp.counters.
+    view_count = Column(Integer, default=0, server_default='0',
+                        nullable=False)
+    # See pasteapp.similarity; NULL until fingerprinted.
+    simhash = Column(BigInteger)
+    duplicate_of = Column(Integer, ForeignKey('snippets.id'))
+    # NULL for snippets that never expire; see pasteapp.archive.
+    expires_at = Column(DateTime())
 
     def __init__(self, title, snippet_lang, author_id, snippet_raw):
         self.title = title
         self.snippet_lang = snippet_lang
         self.author_id = author_id
         self.snippet_raw = snippet_raw
-        self.snippet_formatted = self.generate_formatted()
+        self.raw_size = len(snippet_raw)
+        self.render_state = RENDER_PENDING
         self.created_date = datetime.datetime.now()
+        self.view_count = 0
+
+    @property
+    def snippet_formatted(self):
+        return self.blob.formatted if self.blob else None
+
+    @property
+    def is_expired(self):
+        return is_expired(self.expires_at)
+
+    @property
+    def is_rendered(self):
+        return self.render_state == RENDER_DONE
 
     def generate_formatted(self):
-        lexer = None
-        try:
-            lexer = get_lexer_by_name(self.snippet_lang.lower())
-        except ClassNotFound:
-            lexer = get_lexer_by_name('text')
-        formatter = HtmlFormatter(linenos=True, cssclass='source')
-        return highlight(self.snippet_raw, lexer, formatter)
+        formatted, elapsed = render(self.snippet_raw, self.snippet_lang)
+        return formatted
+
+# Covers the dashboard query, which filters on the author and walks the
+# snippets by id.
+Index('ix_snippets_author_id_id', Snippet.author_id, Snippet.id)
+# For the most viewed listing on the index page.
+ix_snippets_view_count = Index('ix_snippets_view_count', Snippet.view_count)
+# For the reaper, which deletes expired snippets in expiry order.
+ix_snippets_expires_at = Index('ix_snippets_expires_at', Snippet.expires_at)
+
+def is_expired(expires_at, now=None):
+    if expires_at is None:
+        return False
+    return expires_at <= (now or datetime.datetime.now())
+
+def unexpired(now=None):
+    """
+    Criterion for snippets that haven't expired. Those that have are gone
+    as far as readers can tell, even before the reaper deletes them.
+    """
+    return or_(Snippet.expires_at == None,
+               Snippet.expires_at > (now or datetime.datetime.now()))
+
+def snippet_summaries(session):
+    """
+    Query for the lightweight columns used by the list pages, leaving out
+    expired snippets.
+    """
+    return session.query(Snippet.id, Snippet.title, Snippet.snippet_lang,
+                         Snippet.created_date).filter(unexpired())
+
+def most_viewed(session, limit=10):
+    return snippet_summaries(session).add_columns(Snippet.view_count) \
+        .filter(Snippet.view_count > 0) \
+        .order_by(Snippet.view_count.desc()).limit(limit)
+
+# Columns added to the original tables since they were first created, in
+# the order they were added, with the index (if any) that goes with each.
+# Existing snippets start out pending; see migrate_legacy_renders.
+ADDED_COLUMNS = [
+    ('snippets', 'render_state', "VARCHAR(10) DEFAULT '%s'" % RENDER_PENDING,
+     None),
+    ('snippets', 'blob_id', 'INTEGER REFERENCES snippet_blobs (id)', None),
+    ('users', 'snippet_count', 'INTEGER DEFAULT 0', None),
+    ('snippets', 'raw_size', 'INTEGER', None),
+    ('snippet_blobs', 'size', 'INTEGER', None),
+    ('snippets', 'view_count', 'INTEGER NOT NULL DEFAULT 0',
+     ix_snippets_view_count),
+    ('snippets', 'simhash', 'BIGINT', None),
+    ('snippets', 'duplicate_of', 'INTEGER REFERENCES snippets (id)', None),
+    ('snippets', 'expires_at', 'TIMESTAMP', ix_snippets_expires_at)
+]
+
+def add_missing_columns(engine):
+    """
+    Brings the tables of an older database up to date, and creates any it
+    lacks. Returns the 'table.column' names of the columns added.
+    """
+    Base.metadata.create_all(bind=engine)
+    inspector = Inspector.from_engine(engine)
+    existing = {}
+    added = []
+    for table, name, ddl, index in ADDED_COLUMNS:
+        if table not in existing:
+            existing[table] = set(column['name'] for column in
+                                  inspector.get_columns(table))
+        if name in existing[table]:
+            continue
+        engine.execute('ALTER TABLE %s ADD COLUMN %s %s' % (table, name, ddl))
+        if index is not None:
+            index.create(bind=engine)
+        added.append('%s.%s' % (table, name))
+    return added
+
+def snippet_info(session, snippet_id):
+    """
+    Loads everything about a snippet except its body, along with the
+    length of whichever body view_snippet will show. Snippets that have
+    been archived are looked up in archived_snippets, and have `archived`
+    set.
+    """
+    for archived, model in enumerate((Snippet, ArchivedSnippet)):
+        size = func.coalesce(SnippetBlob.size, model.raw_size)
+        info = session.query(model.id, model.title, model.snippet_lang,
+                             model.render_state, model.created_date,
+                             model.blob_id, model.expires_at,
+                             size.label('size'),
+                             literal_column(str(archived))
+                             .label('archived')) \
+                      .outerjoin(SnippetBlob, model.blob_id == SnippetBlob.id) \
+                      .filter(model.id == snippet_id).first()
+        if info:
+            return info
+    return None
+
+def snippet_source(snippet_id, archived=False):
+    """
+    The column and criterion to read a snippet's source with (see
+    iter_stored), from whichever table snippet_info found it in.
+    """
+    model = ArchivedSnippet if archived else Snippet
+    return model.snippet_raw, model.id == snippet_id
+
+def iter_stored(session, column, criterion, chunk_size):
+    """
+    Yields a large column exactly as stored, in pieces of chunk_size. The
+    stored value is fetched with one query; reading it a piece at a time
+    with substr() made the database walk the whole row up to each offset,
+    which is quadratic in its length. Since values are stored compressed,
+    holding one costs far less than the text it decompresses to, which
+    iter_text produces a piece at a time.
+    """
+    table_column = column.property.columns[0]
+    # A literal column skips CompressedText so the stored value is seen.
+    stored = literal_column('%s.%s' % (table_column.table.name,
+                                       table_column.name)).label('stored')
+    value = session.query(stored).filter(criterion).scalar()
+    if not value:
+        return
+    for offset in xrange(0, len(value), chunk_size):
+        yield value[offset:offset + chunk_size]
+
+def iter_text(session, column, criterion, chunk_size):
+    """
+    Like iter_stored, but decompresses CompressedText columns on the fly.
+    """
+    return iter_decompressed(iter_stored(session, column, criterion,
+                                         chunk_size))
+
+def increment_snippet_count(session, user_id, amount=1):
+    session.query(User).filter(User.id == user_id).update({
+        'snippet_count': User.snippet_count + amount
+    }, synchronize_session=False)
+
+def recount_snippets(session):
+    """
+    Rebuilds every user's snippet_count from the snippets table.
+    """
+    counts = select([func.count(Snippet.id)]) \
+        .where(Snippet.author_id == User.id).as_scalar()
+    session.query(User).update({'snippet_count': counts},
+                               synchronize_session=False)
+
+class SnippetBlob(Base):
+    """
+    Rendered HTML shared between every snippet with the same source,
+    language and formatter options. The digest comes from
+    pasteapp.highlighting.render_digest.
+    """
+    __tablename__ = 'snippet_blobs'
+
+    id = Column(Integer, primary_key=True)
+    digest = Column(String(40), unique=True, index=True)
+    formatted = Column(CompressedText())
+    size = Column(Integer)
+
+    def __init__(self, digest, formatted):
+        self.digest = digest
+        self.formatted = formatted
+        self.size = len(formatted)
+
+def find_blob_id(session, digest):
+    blob = session.query(SnippetBlob.id) \
+                  .filter(SnippetBlob.digest == digest).first()
+    return blob.id if blob else None
+
+def store_blob(session, digest, formatted):
+    """
+    Returns the id of the blob for the digest, inserting it if this is the
+    first time it has been rendered. Two workers racing on the same digest
+    both end up pointing at whichever row won the insert.
+    """
+    blob_id = find_blob_id(session, digest)
+    if blob_id is not None:
+        return blob_id
+    blob = SnippetBlob(digest, formatted)
+    session.add(blob)
+    try:
+        session.flush()
+    except IntegrityError:
+        session.rollback()
+        return find_blob_id(session, digest)
+    return blob.id
+
+def migrate_legacy_renders(session, batch_size=500):
+    """
+    Moves the HTML that the original schema kept in each snippet's
+    snippet_formatted column into snippet_blobs, marks those snippets
+    rendered and clears the old column, committing after every batch.
+    That HTML was highlighted with today's FORMATTER_OPTIONS by the
+    snippet's own lexer, never a guessed one, so it is stored under the
+    digest a render with that lexer gets. Returns the number of snippets
+    migrated, 0 on databases without the column.
+    """
+    columns = Inspector.from_engine(session.get_bind()).get_columns('snippets')
+    if 'snippet_formatted' not in set(column['name'] for column in columns):
+        return 0
+    # Migrated rows have their old HTML cleared, so each batch is simply
+    # the next rows still holding some.
+    query = text('SELECT id, snippet_lang, snippet_raw, snippet_formatted '
+                 'FROM snippets WHERE snippet_formatted IS NOT NULL '
+                 'AND snippet_raw IS NOT NULL LIMIT :batch_size')
+    clear = text('UPDATE snippets SET snippet_formatted = NULL, '
+                 'blob_id = :blob_id, render_state = :state '
+                 'WHERE id = :snippet_id')
+    migrated = 0
+    while True:
+        rows = session.execute(query, {'batch_size': batch_size}).fetchall()
+        if not rows:
+            return migrated
+        for snippet_id, snippet_lang, snippet_raw, formatted in rows:
+            digest = lexer_digest(lexer_name(snippet_lang),
+                                  decompress(snippet_raw))
+            blob_id = store_blob(session, digest, decompress(formatted))
+            session.execute(clear, {'blob_id': blob_id, 'state': RENDER_DONE,
+                                    'snippet_id': snippet_id})
+        session.commit()
+        migrated += len(rows)
+
+class ArchivedSnippet(Base):
+    """
+    Snippets moved out of the snippets table by the reaper after going
+    unviewed for ARCHIVE_AFTER_DAYS, keeping that table and its indexes
+    small. They are still viewable but no longer listed or searchable.
+    """
+    __tablename__ = 'archived_snippets'
+
+    id = Column(Integer, primary_key=True, autoincrement=False)
+    title = Column(String(100))
+    snippet_lang = Column(String(30))
+    author_id = Column(Integer, ForeignKey('users.id'))
+    snippet_raw = deferred(Column(CompressedText()), group='body')
+    raw_size = Column(Integer)
+    blob_id = Column(Integer, ForeignKey('snippet_blobs.id'))
+    render_state = Column(String(10))
+    created_date = Column(DateTime())
+    view_count = Column(Integer)
+    expires_at = Column(DateTime())
+    archived_date = Column(DateTime())
+
+# The columns moved across as they are, compressed source and all.
+ARCHIVED_COLUMNS = ('id', 'title', 'snippet_lang', 'author_id', 'snippet_raw',
+                    'raw_size', 'blob_id', 'render_state', 'created_date',
+                    'view_count', 'expires_at')
+
+class SearchTerm(Base):
+    """
+    The inverted index used by pasteapp.search when SQLite's FTS5 isn't
+    available: one row per distinct term in a snippet, weighted by how
+    often it occurs (title occurrences count for more).
+    """
+    __tablename__ = 'search_terms'
+
+    term = Column(String(64), primary_key=True)
+    snippet_id = Column(Integer, ForeignKey('snippets.id'), primary_key=True)
+    weight = Column(Integer)
+
+# Lets a snippet's terms be deleted when it is reindexed.
+Index('ix_search_terms_snippet_id', SearchTerm.snippet_id)
+
+class SnippetBand(Base):
+    """
+    The locality-sensitive index over Snippet.simhash: one row per 16-bit
+    band of each fingerprint. Fingerprints within three bits of each
+    other always have a band in common. See pasteapp.similarity.
+    """
+    __tablename__ = 'snippet_bands'
+
+    band = Column(Integer, primary_key=True, autoincrement=False)
+    value = Column(Integer, primary_key=True, autoincrement=False)
+    snippet_id = Column(Integer, ForeignKey('snippets.id'), primary_key=True,
+                        autoincrement=False)
+
+Index('ix_snippet_bands_snippet_id', SnippetBand.snippet_id)
+
+def compress_legacy_rows(session, table, column, size_column,
+                         batch_size=500):
+    """
+    Compresses the rows of `table` whose `column` was written before it
+    became CompressedText and fills in their `size_column`, committing
+    after every batch_size rows. Returns the number of rows rewritten.
+    """
+    # A literal column skips CompressedText so the stored value is seen.
+    stored = literal_column(table.c[column].name)
+    update = table.update().where(table.c.id == bindparam('row_id')).values({
+        column: bindparam('value', type_=table.c[column].type),
+        size_column: bindparam('size')
+    })
+    last_id = 0
+    rewritten = 0
+    while True:
+        rows = session.execute(select([table.c.id, stored])
+                               .where(table.c.id > last_id)
+                               .order_by(table.c.id)
+                               .limit(batch_size)).fetchall()
+        if not rows:
+            return rewritten
+        last_id = rows[-1][0]
+        batch = []
+        for row_id, value in rows:
+            if value is None or is_compressed(value):
+                continue
+            value = decompress(value)
+            batch.append({'row_id': row_id, 'value': value,
+                          'size': len(value)})
+        if batch:
+            session.execute(update, batch)
+            rewritten += len(batch)
+        session.commit()
@@ -0,0 +1,184 @@
+"""
+The most recently created snippets, kept as lists of small records
+(newest first) for the home page and the Atom and JSON feeds, so that
+once warm they never query the snippets table. There is one list of
+FEED_SIZE for all snippets and one per language.
+
+Snippets are pushed onto the lists as they are created. A list that
+isn't there (first use, a restart, or a bulk import clearing them) is
+filled from the database by whichever request next needs it. The
+'local' backend keeps the lists in each worker and refills them every
+FEED_TIMEOUT seconds, so snippets created through other workers show up
+within that; 'redis' shares one set of lists between all the workers.
+Records carry the snippet's expiry, and expired ones are left out when
+a list is read.
+"""
+import json
+import threading
+import datetime
+from time import time
+from collections import deque
+
+from pasteapp.database import Snippet, snippet_summaries
+from pasteapp.metrics import metrics
+
+FEED_SIZE = 20
+ALL = 'all'
+
+def feed_record(snippet_id, title, snippet_lang, created_date,
+                expires_at=None):
+    return {
+        'id': snippet_id,
+        'title': title,
+        'language': snippet_lang,
+        'created': created_date.strftime('%Y-%m-%dT%H:%M:%S'),
+        # Formatted once here rather than by the template on every view.
+        'date': created_date.strftime('%Y-%m-%d'),
+        'expires': expires_at.strftime('%Y-%m-%dT%H:%M:%S')
+                   if expires_at else None
+    }
+
+def record_datetime(record):
+    return datetime.datetime.strptime(record['created'], '%Y-%m-%dT%H:%M:%S')
+
+def record_expired(record, now):
+    # Lists filled before records carried an expiry have no 'expires'.
+    expires = record.get('expires')
+    return expires is not None and \
+        datetime.datetime.strptime(expires, '%Y-%m-%dT%H:%M:%S') <= now
+
+def language_key(snippet_lang):
+    return 'lang/%s' % snippet_lang
+
+class LocalFeedBackend(object):
+
+    def __init__(self, size=FEED_SIZE, timeout=60):
+        self.size = size
+        self.timeout = timeout
+        self._lists = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._lists.get(key)
+            if item is None or item[0] <= time():
+                return None
+            return list(item[1])
+
+    def set(self, key, records):
+        with self._lock:
+            self._lists[key] = (time() + self.timeout,
+                                deque(records, maxlen=self.size))
+
+    def push(self, key, record):
+        # A list that hasn't been loaded will include the record when it
+        # is, since the snippet has been committed by now.
+        with self._lock:
+            item = self._lists.get(key)
+            if item is not None:
+                item[1].appendleft(record)
+
+    def clear(self):
+        with self._lock:
+            self._lists.clear()
+
+class RedisFeedBackend(object):
+    """
+    Each list is a Redis list of JSON records, trimmed to `size` on every
+    push. A separate marker key says it has been loaded, since an empty
+    list and a missing one look the same to Redis.
+    """
+
+    def __init__(self, size=FEED_SIZE, host='localhost', port=6379,
+                 password=None, db=0, key_prefix='feed/'):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError('The redis feed backend needs the redis '
+                               'module')
+        self.size = size
+        self.key_prefix = key_prefix
+        self._client = redis.Redis(host=host, port=port, password=password,
+                                   db=db)
+
+    def _keys(self, key):
+        return self.key_prefix + key, self.key_prefix + 'loaded/' + key
+
+    def get(self, key):
+        list_key, loaded_key = self._keys(key)
+        pipe = self._client.pipeline()
+        pipe.exists(loaded_key)
+        pipe.lrange(list_key, 0, self.size - 1)
+        loaded, items = pipe.execute()
+        if not loaded:
+            return None
+        return [json.loads(item) for item in items]
+
+    def set(self, key, records):
+        list_key, loaded_key = self._keys(key)
+        pipe = self._client.pipeline()
+        pipe.delete(list_key)
+        if records:
+            pipe.rpush(list_key, *[json.dumps(record) for record in records])
+        pipe.set(loaded_key, 1)
+        pipe.execute()
+
+    def push(self, key, record):
+        list_key, loaded_key = self._keys(key)
+        pipe = self._client.pipeline()
+        pipe.lpush(list_key, json.dumps(record))
+        pipe.ltrim(list_key, 0, self.size - 1)
+        pipe.execute()
+
+    def clear(self):
+        keys = self._client.keys(self.key_prefix + '*')
+        if keys:
+            self._client.delete(*keys)
+
+class RecentFeed(object):
+
+    def __init__(self):
+        self.configure()
+
+    def configure(self, backend='local', size=FEED_SIZE, timeout=60,
+                  **options):
+        self.size = size
+        if backend == 'local':
+            self.backend = LocalFeedBackend(size, timeout)
+        elif backend == 'redis':
+            self.backend = RedisFeedBackend(size, **options)
+        else:
+            raise ValueError('Unknown feed backend %r' % backend)
+
+    def recent(self, session, snippet_lang=None):
+        key = language_key(snippet_lang) if snippet_lang else ALL
+        records = self.backend.get(key)
+        if records is not None:
+            metrics.incr('feed_hits')
+            # Snippets that have expired since they were listed are left
+            # for the next refill to drop.
+            now = datetime.datetime.now()
+            return [record for record in records
+                    if not record_expired(record, now)]
+        metrics.incr('feed_misses')
+        query = snippet_summaries(session).add_columns(Snippet.expires_at)
+        if snippet_lang:
+            query = query.filter(Snippet.snippet_lang == snippet_lang)
+        records = [feed_record(row.id, row.title, row.snippet_lang,
+                               row.created_date, row.expires_at)
+                   for row in query.order_by(Snippet.id.desc())
+                                   .limit(self.size)]
+        self.backend.set(key, records)
+        return records
+
+    def push(self, record):
+        """
+        Adds a feed_record for a snippet that has just been committed.
+        """
+        self.backend.push(ALL, record)
+        self.backend.push(language_key(record['language']), record)
+
+    def clear(self):
+        self.backend.clear()
+
+recent_feed = RecentFeed()
@@ -1,8 +1,22 @@
+from flask import current_app
 from flask.ext.wtf import (
     Form, TextField, PasswordField, SubmitField, Required, Length,
     ValidationError, EqualTo, TextAreaField, SelectField
 )
 
+from pasteapp.highlighting import LANGUAGES
+
+MAX_SNIPPET_LENGTH = 1000 * 1000
+# Seconds from creation; '' keeps the snippet for good.
+EXPIRY_CHOICES = [('', 'Never'), ('3600', '1 hour'), ('86400', '1 day'),
+                  ('604800', '1 week'), ('2592000', '30 days')]
+
+def within_size_limit(form, field):
+    limit = current_app.config.get('SNIPPET_MAX_LENGTH', MAX_SNIPPET_LENGTH)
+    if field.data and len(field.data) > limit:
+        raise ValidationError('Snippets can be at most %d characters long.'
+                              % limit)
+
 class RegistrationForm(Form):
 
     username = TextField('Username', validators = [
@@ -33,29 +47,16 @@ class SnippetForm(Form):
     title = TextField('Title', validators = [
         Required(message='You must enter a title.')])
     language = SelectField('Programming Language',
-                           choices=[
-                               ('bash', 'Bash'),
-                               ('c', 'C'),
-                               ('csharp', 'C#'),
-                               ('clj', 'Clojure'),
-                               ('cl', 'Common Lisp'),
-                               ('cpp', 'C++'),
-                               ('css', 'CSS'),
-                               ('erlang', 'Erlang'),
-                               ('go', 'Go'),
-                               ('haskell', 'Haskell'),
-                               ('html', 'HTML'),
-                               ('java', 'Java'),
-                               ('javascript', 'Javascript'),
-                               ('lua', 'Lua'),
-                               ('ocaml', 'OCaml'),
-                               ('perl', 'Perl'),
-                               ('php', 'PHP'),
-                               ('text', 'Plain Text'),
-                               ('python', 'Python'),
-                               ('ruby', 'Ruby'),
-                               ('scheme', 'Scheme'),
-                               ('sql', 'SQL')])
+                           choices=LANGUAGES)
     raw_content = TextAreaField('Source Code', validators = [
-        Required(message='You must enter some source code.')])
+        Required(message='You must enter some source code.'),
+        within_size_limit])
+    expires = SelectField('Expires', choices=EXPIRY_CHOICES, default='')
     submit = SubmitField('Submit Snippet')
+
+class SearchForm(Form):
+
+    q = TextField('Search')
+    lang = SelectField('Language', choices=[('', 'Any language')] + LANGUAGES,
+                       default='')
+    author = TextField('Author')
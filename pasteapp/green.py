@@ -0,0 +1,91 @@
+"""
+An app factory for serving the read-heavy routes from gevent workers:
+
+    gunicorn -k gevent --worker-connections 2000 \\
+        'pasteapp.green:create_green_app("config_production.py")'
+
+Each request runs in its own greenlet, so one process can hold thousands
+of slow clients while only GREEN_POOL_SIZE database connections are in
+use. It shares the models, templates and views with create_app but only
+answers GREEN_ENDPOINTS. Everything else (logins, new snippets) should be
+routed by the proxy to the sync workers, since bcrypt and the render pool
+would stall the event loop. Views that highlight while answering (with
+?linenos= or ?style=, a page of ?lines=, or an unrendered snippet in lazy
+mode) run Pygments on gevent's threadpool, so other greenlets carry on
+meanwhile.
+"""
+from os.path import abspath
+
+from flask import request, abort, Config
+
+from pasteapp import create_app
+from pasteapp.database import scope_sessions
+from pasteapp.render_queue import render_queue
+
+GREEN_ENDPOINTS = frozenset([
+    'frontend.index',
+    'frontend.view_snippet',
+    'frontend.raw_snippet',
+    'frontend.search_snippets',
+    'frontend.json_feed',
+    'frontend.atom_feed',
+    'api.get_snippets',
+    'api.get_snippet',
+    'metrics',
+    'static_assets.asset',
+    'static'
+])
+
+def patch_driver(db_uri):
+    """
+    Makes psycopg2 yield to the event loop while waiting on the server.
+    SQLite has no such hook, so its queries still block the worker.
+    """
+    if db_uri.startswith('postgresql'):
+        try:
+            from psycogreen.gevent import patch_psycopg
+        except ImportError:
+            raise RuntimeError('Serving PostgreSQL from gevent workers '
+                               'needs psycogreen')
+        patch_psycopg()
+
+def serve_green(app, run_in_thread):
+    """
+    Restricts the app to GREEN_ENDPOINTS and has its views highlight
+    through `run_in_thread(func, args)`.
+    """
+    app.extensions['highlight_runner'] = run_in_thread
+
+    @app.before_request
+    def read_only_routes():
+        if request.endpoint not in GREEN_ENDPOINTS:
+            abort(404)
+
+def run_in_threadpool(func, args):
+    from gevent import get_hub
+    return get_hub().threadpool.apply(func, args)
+
+def create_green_app(cfg_file):
+    try:
+        from gevent import getcurrent
+    except ImportError:
+        raise RuntimeError('create_green_app needs gevent')
+    config = Config(None)
+    config.from_pyfile(abspath(cfg_file))
+    db_uri = config['DATABASE']
+    patch_driver(db_uri)
+    engine_options = {}
+    if not db_uri.startswith('sqlite'):
+        # Greenlets queue for a connection rather than each opening one.
+        engine_options = {
+            'pool_size': config.get('GREEN_POOL_SIZE', 20),
+            'max_overflow': config.get('GREEN_POOL_OVERFLOW', 0),
+            'pool_timeout': config.get('GREEN_POOL_TIMEOUT', 10)
+        }
+    app = create_app(cfg_file, **engine_options)
+    scope_sessions(getcurrent)
+    # Renders are left to the sync workers' pool; a multiprocessing pool
+    # doesn't mix with a monkey-patched process.
+    render_queue.configure(processes=0)
+    serve_green(app, run_in_threadpool)
+    return app
@@ -0,0 +1,305 @@
+"""
+Rate limiting and admission control for the expensive endpoints: creating
+snippets (LIMITED_ENDPOINTS' 'create' class) and reading them ('read').
+
+Each request in a class takes a token from every bucket configured for
+it in RATE_LIMITS: the user's (by session or API token), the client IP's
+and a global one, or from none of them if any is empty. Buckets hold up
+to `burst` tokens and refill at `rate` per second, so short bursts go
+through while a steady stream is held to the rate. A request finding a
+bucket empty gets a 429 with Retry-After set to when the bucket will
+have a token again. The 'local' backend keeps the buckets in each
+worker, so every worker allows the full rate; 'redis' shares them
+between all the workers.
+
+On top of that, each worker admits at most MAX_IN_FLIGHT limited
+requests at once and sheds the rest with a 503 and Retry-After, so an
+overloaded worker answers the excess at once rather than queueing
+everything behind it. That only matters for threaded or gevent workers;
+a sync worker handles one request at a time anyway.
+
+Behind a reverse proxy every request comes from the proxy's address, so
+set PROXY_COUNT to the number of proxies in front of the app to take
+the client's address from X-Forwarded-For instead (see ForwardedFor).
+"""
+import math
+import threading
+from time import time
+from collections import OrderedDict
+
+from flask import request, session, g, jsonify, render_template
+
+from pasteapp.auth import api_token_digest
+from pasteapp.metrics import metrics
+
+LIMITED_ENDPOINTS = {
+    'frontend.new_snippet': 'create',
+    'api.create_snippets': 'create',
+    'frontend.view_snippet': 'read',
+    'frontend.raw_snippet': 'read',
+    'frontend.search_snippets': 'read',
+    'api.get_snippets': 'read',
+    'api.get_snippet': 'read'
+}
+SCOPES = ('user', 'ip', 'global')
+RATE_LIMITED_MESSAGE = 'Too many requests, please slow down.'
+OVERLOADED_MESSAGE = 'The site is busy right now, please try again shortly.'
+
+class LocalBucketBackend(object):
+    """
+    Buckets kept in this process. Only the `max_keys` most recently used
+    are kept; a bucket left idle long enough to be dropped would mostly
+    have refilled anyway.
+    """
+
+    def __init__(self, max_keys=100000):
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, buckets, now):
+        """
+        Takes a token from each of the buckets ([(key, rate, burst)]) if
+        every one has a token. Returns the longest number of seconds until
+        an empty one will and its position in `buckets`, or (0, None) if
+        the tokens were taken.
+        """
+        with self._lock:
+            levels = []
+            wait, refused = 0, None
+            for i, (key, rate, burst) in enumerate(buckets):
+                tokens, updated = self._buckets.pop(key, (burst, now))
+                tokens = min(burst, tokens + (now - updated) * rate)
+                if tokens < 1 and (1 - tokens) / rate > wait:
+                    wait, refused = (1 - tokens) / rate, i
+                levels.append((key, tokens))
+            for key, tokens in levels:
+                self._buckets[key] = (tokens if refused is not None
+                                      else tokens - 1, now)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+            return wait, refused
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+# Refills the buckets (KEYS, with ARGV holding now and then a rate and
+# burst per key) and takes a token from each if all of them have one, in
+# one round trip, atomically.
+TAKE_SCRIPT = """
+local now = tonumber(ARGV[1])
+local levels = {}
+local wait, refused = 0, 0
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[2 * i])
+    local burst = tonumber(ARGV[2 * i + 1])
+    local state = redis.call('HMGET', key, 'tokens', 'updated')
+    local tokens = tonumber(state[1]) or burst
+    local updated = tonumber(state[2]) or now
+    tokens = math.min(burst, tokens + math.max(now - updated, 0) * rate)
+    if tokens < 1 and (1 - tokens) / rate > wait then
+        wait, refused = (1 - tokens) / rate, i
+    end
+    levels[i] = tokens
+end
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[2 * i])
+    local burst = tonumber(ARGV[2 * i + 1])
+    local tokens = levels[i]
+    if refused == 0 then
+        tokens = tokens - 1
+    end
+    redis.call('HMSET', key, 'tokens', tostring(tokens),
+               'updated', tostring(now))
+    redis.call('EXPIRE', key, math.ceil(burst / rate) + 1)
+end
+return {tostring(wait), refused}
+"""
+
+class RedisBucketBackend(object):
+    """
+    Buckets shared between workers as Redis hashes, each expiring once it
+    would have refilled.
+    """
+
+    def __init__(self, host='localhost', port=6379, password=None, db=0,
+                 key_prefix='bucket/'):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError('The redis rate limit backend needs the redis '
+                               'module')
+        self.key_prefix = key_prefix
+        self._client = redis.Redis(host=host, port=port, password=password,
+                                   db=db)
+        self._take = self._client.register_script(TAKE_SCRIPT)
+
+    def take(self, buckets, now):
+        args = [repr(now)]
+        for key, rate, burst in buckets:
+            args.extend([rate, burst])
+        wait, refused = self._take(
+            keys=[self.key_prefix + key for key, rate, burst in buckets],
+            args=args)
+        # Lua counts from 1, with 0 for none.
+        return float(wait), (int(refused) - 1 if int(refused) else None)
+
+    def clear(self):
+        keys = self._client.keys(self.key_prefix + '*')
+        if keys:
+            self._client.delete(*keys)
+
+class RateLimiter(object):
+
+    def __init__(self):
+        self.configure()
+
+    def configure(self, backend='local', limits=None, **options):
+        """
+        `limits` maps a request class to {scope: (rate, burst)}, for
+        scopes from SCOPES; classes and scopes left out aren't limited.
+        """
+        self.limits = limits or {}
+        if backend == 'local':
+            self.backend = LocalBucketBackend(**options)
+        elif backend == 'redis':
+            self.backend = RedisBucketBackend(**options)
+        else:
+            raise ValueError('Unknown rate limit backend %r' % backend)
+
+    def check(self, request_class, identities):
+        """
+        Takes a token from each of the class's buckets for the identities
+        ({scope: key}), or none if any of them is empty. Returns the
+        seconds until the request would be allowed, 0 if it is.
+        """
+        limits = self.limits.get(request_class)
+        if not limits:
+            return 0
+        scopes = [scope for scope in SCOPES
+                  if scope in limits and identities.get(scope) is not None]
+        buckets = [('%s/%s/%s' % (request_class, scope, identities[scope]),)
+                   + tuple(limits[scope]) for scope in scopes]
+        if not buckets:
+            return 0
+        wait, refused = self.backend.take(buckets, time())
+        if wait:
+            metrics.incr('rate_limited', request_class=request_class,
+                         scope=scopes[refused])
+        return wait
+
+    def clear(self):
+        self.backend.clear()
+
+class AdmissionControl(object):
+    """
+    Counts the limited requests in flight in this worker.
+    """
+
+    def __init__(self):
+        self._in_flight = 0
+        self._lock = threading.Lock()
+        self.configure()
+
+    def configure(self, max_in_flight=None, retry_after=1):
+        self.max_in_flight = max_in_flight
+        self.retry_after = retry_after
+
+    @property
+    def in_flight(self):
+        return self._in_flight
+
+    def acquire(self):
+        with self._lock:
+            if self.max_in_flight is not None and \
+               self._in_flight >= self.max_in_flight:
+                return False
+            self._in_flight += 1
+            metrics.add_gauge('requests_in_flight', 1)
+            return True
+
+    def release(self):
+        with self._lock:
+            self._in_flight -= 1
+            metrics.add_gauge('requests_in_flight', -1)
+
+class ForwardedFor(object):
+    """
+    WSGI middleware setting REMOTE_ADDR from X-Forwarded-For for an app
+    behind `proxies` reverse proxies. Each proxy appends the address it
+    got the request from, so the entry `proxies` from the end is the one
+    the outermost proxy saw; anything before it could have been sent by
+    the client. Unlike werkzeug's ProxyFix, that takes the first entry
+    and trusts X-Forwarded-Host too, it leaves the rest of the request
+    alone.
+    """
+
+    def __init__(self, app, proxies=1):
+        self.app = app
+        self.proxies = proxies
+
+    def __call__(self, environ, start_response):
+        forwarded_for = [address.strip() for address in
+                         environ.get('HTTP_X_FORWARDED_FOR', '').split(',')
+                         if address.strip()]
+        if len(forwarded_for) >= self.proxies:
+            environ['werkzeug.proxy_fix.orig_remote_addr'] = \
+                environ.get('REMOTE_ADDR')
+            environ['REMOTE_ADDR'] = forwarded_for[-self.proxies]
+        return self.app(environ, start_response)
+
+rate_limiter = RateLimiter()
+admission = AdmissionControl()
+
+def request_class():
+    endpoint_class = LIMITED_ENDPOINTS.get(request.endpoint)
+    # Only submitting the new snippet form is expensive, not showing it.
+    if endpoint_class == 'create' and request.method in ('GET', 'HEAD'):
+        return None
+    return endpoint_class
+
+def request_identities():
+    user = session.get('user_id')
+    if user is not None:
+        user = 'user:%s' % user
+    else:
+        scheme, _, token = request.headers.get('Authorization', '') \
+                                  .partition(' ')
+        if scheme.lower() == 'token' and token.strip():
+            user = 'token:%s' % api_token_digest(token.strip())
+    return {'user': user, 'ip': request.remote_addr or 'unknown',
+            'global': 'all'}
+
+def refused(status, message, retry_after):
+    if request.blueprint == 'api':
+        response = jsonify(error=message)
+    else:
+        response = render_template('busy.html', message=message)
+    return response, status, {'Retry-After': str(retry_after)}
+
+def limit_requests(app):
+    """
+    Installs the hooks on the app.
+    """
+
+    @app.before_request
+    def admit_request():
+        endpoint_class = request_class()
+        if endpoint_class is None:
+            return None
+        wait = rate_limiter.check(endpoint_class, request_identities())
+        if wait:
+            return refused(429, RATE_LIMITED_MESSAGE,
+                           int(math.ceil(wait)))
+        if not admission.acquire():
+            metrics.incr('requests_shed', request_class=endpoint_class)
+            return refused(503, OVERLOADED_MESSAGE, admission.retry_after)
+        g.admitted = True
+
+    @app.teardown_request
+    def finish_request(exception=None):
+        # Streamed responses finish after their body has been sent.
+        if getattr(g, 'admitted', False):
+            g.admitted = False
+            admission.release()
@@ -0,0 +1,152 @@
+import threading
+from collections import defaultdict
+
+# Upper bounds, in seconds, of the histogram buckets.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0)
+
+class Metrics(object):
+    """
+    Thread-safe, in-process counters, gauges and timings. Each metric is
+    identified by a name plus an optional set of labels, e.g.
+    metrics.observe('render_seconds', 0.2, lexer='python').
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.counters = defaultdict(int)
+            self.gauges = defaultdict(int)
+            self.timings = {}
+            self.histograms = {}
+
+    @staticmethod
+    def key(name, labels):
+        return (name, tuple(sorted(labels.items())))
+
+    def incr(self, name, value=1, **labels):
+        with self._lock:
+            self.counters[self.key(name, labels)] += value
+
+    def add_gauge(self, name, value, **labels):
+        with self._lock:
+            self.gauges[self.key(name, labels)] += value
+
+    def set_gauge(self, name, value, **labels):
+        with self._lock:
+            self.gauges[self.key(name, labels)] = value
+
+    def observe(self, name, value, **labels):
+        key = self.key(name, labels)
+        with self._lock:
+            count, total, largest = self.timings.get(key, (0, 0.0, 0.0))
+            self.timings[key] = (count + 1, total + value, max(largest, value))
+
+    def observe_histogram(self, name, value, buckets=DEFAULT_BUCKETS,
+                          **labels):
+        key = self.key(name, labels)
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = {
+                    'buckets': buckets,
+                    'counts': [0] * len(buckets),
+                    'count': 0,
+                    'sum': 0.0
+                }
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    histogram['counts'][i] += 1
+            histogram['count'] += 1
+            histogram['sum'] += value
+
+    def counter(self, name, **labels):
+        return self.counters.get(self.key(name, labels), 0)
+
+    def gauge(self, name, **labels):
+        return self.gauges.get(self.key(name, labels), 0)
+
+    def timing(self, name, **labels):
+        """
+        Returns a (count, total, max) tuple for the given timing.
+        """
+        return self.timings.get(self.key(name, labels), (0, 0.0, 0.0))
+
+    def histogram(self, name, **labels):
+        """
+        Returns (buckets, cumulative counts, count, sum), or None if
+        nothing has been observed.
+        """
+        with self._lock:
+            histogram = self.histograms.get(self.key(name, labels))
+            if histogram is None:
+                return None
+            return (histogram['buckets'], list(histogram['counts']),
+                    histogram['count'], histogram['sum'])
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'counters': dict(self.counters),
+                'gauges': dict(self.gauges),
+                'timings': dict(self.timings),
+                'histograms': dict(
+                    (key, dict(histogram, counts=list(histogram['counts'])))
+                    for key, histogram in self.histograms.items())
+            }
+
+def format_labels(labels, **extra):
+    labels = sorted(labels + tuple(extra.items()))
+    if not labels:
+        return ''
+    escaped = []
+    for name, value in labels:
+        value = unicode(value).replace('\\', '\\\\').replace('"', '\\"') \
+                              .replace('\n', '\\n')
+        escaped.append(u'%s="%s"' % (name, value))
+    return u'{%s}' % u','.join(escaped)
+
+def prometheus_text(registry):
+    """
+    The registry in the Prometheus text exposition format. Timings are
+    exported as summaries plus a _max gauge.
+    """
+    snapshot = registry.snapshot()
+    lines = []
+    seen = set()
+
+    def declare(name, kind):
+        if name not in seen:
+            seen.add(name)
+            lines.append(u'# TYPE %s %s' % (name, kind))
+
+    for (name, labels), value in sorted(snapshot['counters'].items()):
+        declare(name, 'counter')
+        lines.append(u'%s%s %s' % (name, format_labels(labels), value))
+    for (name, labels), value in sorted(snapshot['gauges'].items()):
+        declare(name, 'gauge')
+        lines.append(u'%s%s %s' % (name, format_labels(labels), value))
+    for (name, labels), (count, total, largest) in \
+            sorted(snapshot['timings'].items()):
+        declare(name, 'summary')
+        lines.append(u'%s_count%s %d' % (name, format_labels(labels), count))
+        lines.append(u'%s_sum%s %r' % (name, format_labels(labels), total))
+        declare(name + '_max', 'gauge')
+        lines.append(u'%s_max%s %r' % (name, format_labels(labels), largest))
+    for (name, labels), histogram in sorted(snapshot['histograms'].items()):
+        declare(name, 'histogram')
+        for bound, count in zip(histogram['buckets'], histogram['counts']):
+            lines.append(u'%s_bucket%s %d' % (
+                name, format_labels(labels, le=repr(bound)), count))
+        lines.append(u'%s_bucket%s %d' % (
+            name, format_labels(labels, le='+Inf'), histogram['count']))
+        lines.append(u'%s_count%s %d' % (name, format_labels(labels),
+                                         histogram['count']))
+        lines.append(u'%s_sum%s %r' % (name, format_labels(labels),
+                                       histogram['sum']))
+    return u'\n'.join(lines) + u'\n'
+
+metrics = Metrics()
@@ -0,0 +1,162 @@
+"""
+Opt-in request instrumentation, switched on with INSTRUMENTATION = True.
+
+Each request's time is broken down into phases: SQL (from SQLAlchemy's
+cursor events), template rendering, highlighting and password hashing.
+The breakdown is sent back in a Server-Timing header and recorded as
+per-endpoint histograms, which /metrics serves in the Prometheus text
+format. Phases can overlap; a query run while a template iterates over
+it counts towards both.
+
+With PROFILE_DIR set, PROFILE_SAMPLE_RATE of requests also run under
+cProfile and those slower than PROFILE_SLOW_SECONDS are dumped there for
+pstats or snakeviz.
+"""
+import os
+import time
+import random
+import cProfile
+import threading
+from contextlib import contextmanager
+
+from flask import request, current_app
+from jinja2 import Template
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from pasteapp.metrics import metrics, prometheus_text
+
+PHASE_DESCRIPTIONS = {
+    'sql': 'SQL',
+    'template': 'Templates',
+    'highlight': 'Highlighting',
+    'hash': 'Password hashing'
+}
+
+_local = threading.local()
+_sql_listeners = []
+
+class RequestTimings(object):
+
+    def __init__(self):
+        self.start = time.time()
+        # phase -> (count, seconds)
+        self.phases = {}
+        self.profiler = None
+
+    def add(self, phase, seconds):
+        count, total = self.phases.get(phase, (0, 0.0))
+        self.phases[phase] = (count + 1, total + seconds)
+
+def current_timings():
+    return getattr(_local, 'timings', None)
+
+def record(phase, seconds):
+    """
+    Adds to the phase of the request being timed on this thread, if any.
+    Safe to call from anywhere, including render workers.
+    """
+    timings = current_timings()
+    if timings is not None:
+        timings.add(phase, seconds)
+
+@contextmanager
+def timed(phase):
+    start = time.time()
+    try:
+        yield
+    finally:
+        record(phase, time.time() - start)
+
+class TimedTemplate(Template):
+
+    def render(self, *args, **kwargs):
+        with timed('template'):
+            return Template.render(self, *args, **kwargs)
+
+def before_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    conn.info.setdefault('query_start', []).append(time.time())
+
+def after_cursor_execute(conn, cursor, statement, parameters, context,
+                         executemany):
+    record('sql', time.time() - conn.info['query_start'].pop())
+
+def listen_for_sql():
+    if not _sql_listeners:
+        event.listen(Engine, 'before_cursor_execute', before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', after_cursor_execute)
+        _sql_listeners.append(Engine)
+
+def server_timing(timings, total):
+    entries = []
+    for phase, (count, seconds) in sorted(timings.phases.items()):
+        description = PHASE_DESCRIPTIONS.get(phase, phase)
+        if phase == 'sql':
+            description = '%d queries' % count
+        entries.append('%s;dur=%.1f;desc="%s"' % (phase, seconds * 1000,
+                                                  description))
+    entries.append('total;dur=%.1f' % (total * 1000))
+    return ', '.join(entries)
+
+def dump_profile(profiler, directory, endpoint, total):
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    name = '%s-%s-%dms-%d.prof' % (time.strftime('%Y%m%d-%H%M%S'), endpoint,
+                                   total * 1000, os.getpid())
+    profiler.dump_stats(os.path.join(directory, name))
+    metrics.incr('profiles_written', endpoint=endpoint)
+
+def metrics_endpoint():
+    return current_app.response_class(
+        prometheus_text(metrics),
+        content_type='text/plain; version=0.0.4; charset=utf-8')
+
+def instrument(app):
+    """
+    Installs the hooks on the app. Call it before registering any other
+    request hooks so the timings cover them.
+    """
+    listen_for_sql()
+    app.jinja_env.template_class = TimedTemplate
+
+    @app.before_request
+    def start_timing():
+        timings = _local.timings = RequestTimings()
+        sample_rate = app.config.get('PROFILE_SAMPLE_RATE', 0.01)
+        if app.config.get('PROFILE_DIR') and random.random() < sample_rate:
+            timings.profiler = cProfile.Profile()
+            timings.profiler.enable()
+
+    @app.after_request
+    def finish_timing(response):
+        timings = current_timings()
+        if timings is None:
+            return response
+        _local.timings = None
+        total = time.time() - timings.start
+        endpoint = request.endpoint or 'none'
+        if timings.profiler is not None:
+            timings.profiler.disable()
+            if total >= app.config.get('PROFILE_SLOW_SECONDS', 1.0):
+                dump_profile(timings.profiler, app.config['PROFILE_DIR'],
+                             endpoint, total)
+        metrics.observe_histogram('request_seconds', total,
+                                  endpoint=endpoint)
+        for phase, (count, seconds) in timings.phases.items():
+            metrics.observe_histogram('request_phase_seconds', seconds,
+                                      endpoint=endpoint, phase=phase)
+        sql_count = timings.phases.get('sql', (0, 0.0))[0]
+        metrics.observe('request_sql_queries', sql_count, endpoint=endpoint)
+        response.headers['Server-Timing'] = server_timing(timings, total)
+        return response
+
+    @app.teardown_request
+    def discard_timing(exception=None):
+        # after_request doesn't run when a view raises.
+        timings = current_timings()
+        if timings is not None and timings.profiler is not None:
+            timings.profiler.disable()
+        _local.timings = None
+
+    app.add_url_rule('/metrics', 'metrics', metrics_endpoint)
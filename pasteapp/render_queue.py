@@ -0,0 +1,173 @@
+import os
+import time
+import logging
+import threading
+from functools import partial
+from multiprocessing import Pool
+
+from pasteapp.database import (
+    db_session, Snippet, RENDER_DONE, RENDER_FAILED, RENDER_PENDING,
+    find_blob_id, store_blob
+)
+from pasteapp.highlighting import render, render_digest
+from pasteapp.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+def render_job(snippet_raw, snippet_lang):
+    """
+    Runs inside a pool worker. Exceptions can't be reported back through
+    apply_async's callback, so failures are returned as a None result.
+    """
+    start = time.time()
+    try:
+        return render(snippet_raw, snippet_lang)
+    except Exception:
+        return None, time.time() - start
+
+class RenderQueue(object):
+    """
+    Highlights snippets off the request path. With processes=0 the render
+    happens inline in the calling thread, which is what the tests use.
+    Otherwise jobs are handed to a multiprocessing pool and the result is
+    written back to the snippets table from the pool's result thread.
+    """
+
+    def __init__(self):
+        self.processes = 0
+        self._pool = None
+        self._pool_pid = None
+        self._lock = threading.Lock()
+
+    def configure(self, processes=0):
+        self.close()
+        self.processes = processes
+
+    def close(self):
+        with self._lock:
+            if self._pool is not None and self._pool_pid == os.getpid():
+                self._pool.terminate()
+            self._pool = None
+            self._pool_pid = None
+
+    def join(self):
+        """
+        Waits for every submitted render to finish. Only useful from
+        scripts such as manage.py; the web workers never block on this.
+        """
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    def _get_pool(self):
+        # The pool is created lazily so that each forked gunicorn worker
+        # ends up with its own set of render processes.
+        with self._lock:
+            if self._pool is None or self._pool_pid != os.getpid():
+                self._pool = Pool(self.processes)
+                self._pool_pid = os.getpid()
+            return self._pool
+
+    def map(self, func, items):
+        """
+        Runs func over items in the render pool, or inline with
+        processes=0, and waits for all the results. Only for batches small
+        enough for a request to wait on, such as the API's batch create.
+        """
+        if not self.processes:
+            return [func(item) for item in items]
+        return self._get_pool().map(func, items)
+
+    @property
+    def depth(self):
+        return metrics.gauge('render_queue_depth')
+
+    def submit(self, snippet):
+        digest = render_digest(snippet.snippet_raw, snippet.snippet_lang)
+        if link_existing_render(snippet.id, digest):
+            metrics.incr('render_cache_hits')
+            return
+        metrics.incr('render_cache_misses')
+        args = (snippet.snippet_raw, snippet.snippet_lang)
+        on_complete = partial(self._complete, snippet.id, snippet.snippet_lang,
+                              digest, time.time())
+        metrics.add_gauge('render_queue_depth', 1)
+        metrics.incr('render_jobs_submitted')
+        if not self.processes:
+            on_complete(render_job(*args))
+        else:
+            self._get_pool().apply_async(render_job, args,
+                                         callback=on_complete)
+
+    def _complete(self, snippet_id, snippet_lang, digest, submitted, result):
+        # On the pool's result thread an exception escaping here would end
+        # that thread, and with it every later write-back. A failed write
+        # leaves the snippet pending for `manage.py requeue_pending`.
+        try:
+            formatted, elapsed = result
+            state = RENDER_DONE if formatted is not None else RENDER_FAILED
+            metrics.add_gauge('render_queue_depth', -1)
+            metrics.incr('render_jobs_completed', state=state)
+            metrics.observe('render_seconds', elapsed, lexer=snippet_lang)
+            metrics.observe('render_queue_wait_seconds',
+                            time.time() - submitted - elapsed)
+            store_render(snippet_id, digest, formatted, state)
+        except Exception:
+            metrics.incr('render_writeback_errors')
+            logger.exception('Writing back the render of snippet %d failed',
+                             snippet_id)
+
+def _update_snippet(session, snippet_id, blob_id, state):
+    session.query(Snippet).filter(Snippet.id == snippet_id).update({
+        'blob_id': blob_id,
+        'render_state': state
+    }, synchronize_session=False)
+
+def link_existing_render(snippet_id, digest):
+    """
+    Points the snippet at an already rendered blob with the same digest.
+    Returns False if the content hasn't been rendered before.
+    """
+    session = db_session.session_factory()
+    try:
+        blob_id = find_blob_id(session, digest)
+        if blob_id is None:
+            return False
+        _update_snippet(session, snippet_id, blob_id, RENDER_DONE)
+        session.commit()
+        return True
+    finally:
+        session.close()
+
+def store_render(snippet_id, digest, formatted, state):
+    # A private session keeps the write independent of whatever the
+    # request (or the pool's result thread) has in its own scoped session.
+    session = db_session.session_factory()
+    try:
+        blob_id = None
+        if formatted is not None:
+            blob_id = store_blob(session, digest, formatted)
+        _update_snippet(session, snippet_id, blob_id, state)
+        session.commit()
+    finally:
+        session.close()
+
+def pending_snippets(batch_size=500):
+    """
+    Yields snippets that are still waiting on a render, e.g. because the
+    worker that queued them was restarted before the job finished.
+    """
+    last_id = 0
+    while True:
+        batch = Snippet.query.filter(Snippet.render_state == RENDER_PENDING) \
+                             .filter(Snippet.id > last_id) \
+                             .order_by(Snippet.id).limit(batch_size).all()
+        if not batch:
+            return
+        for snippet in batch:
+            yield snippet
+        last_id = batch[-1].id
+
+render_queue = RenderQueue()
@@ -0,0 +1,222 @@
+"""
+Full-text search over snippet titles and sources.
+
+Where SQLite has FTS5 the index is the snippets_fts virtual table, ranked
+with bm25(). It is contentless: it keeps only the index, not a second copy
+of every title and source, so removing a snippet from it takes the text
+that was indexed, read back from the snippets table. Otherwise search
+falls back to the search_terms table, which is filled by tokenising
+snippets here and ranked by summed term weights.
+Either way a snippet is indexed in the transaction that creates it, and
+rebuild_index() reindexes everything in batches.
+"""
+import re
+import datetime
+
+from sqlalchemy import event, func, text, bindparam, DateTime
+from sqlalchemy.exc import OperationalError
+
+from pasteapp.database import (
+    Base, Snippet, SearchTerm, snippet_summaries, unexpired
+)
+
+FTS_TABLE = 'snippets_fts'
+BACKEND_FTS5 = 'fts5'
+BACKEND_TERMS = 'terms'
+TITLE_WEIGHT = 10
+MAX_TERM_LENGTH = 64
+MAX_QUERY_TERMS = 8
+
+# Identifiers such as snake_case names are kept whole, as FTS5 is told to
+# with tokenchars.
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+_backends = {}
+
+FTS_DDL = ('CREATE VIRTUAL TABLE IF NOT EXISTS %s USING '
+           'fts5(title, body, content=\'\', tokenize="unicode61 '
+           'tokenchars \'_\'")' % FTS_TABLE)
+
+def create_fts_table(target, connection, **kw):
+    _backends.clear()
+    if connection.dialect.name != 'sqlite':
+        return
+    try:
+        connection.execute(FTS_DDL)
+    except OperationalError:
+        # Built without FTS5, so search_terms is used instead.
+        pass
+
+def drop_fts_table(target, connection, **kw):
+    _backends.clear()
+    if connection.dialect.name == 'sqlite':
+        connection.execute('DROP TABLE IF EXISTS %s' % FTS_TABLE)
+
+event.listen(Base.metadata, 'after_create', create_fts_table)
+event.listen(Base.metadata, 'after_drop', drop_fts_table)
+
+def search_backend(session):
+    engine = session.get_bind()
+    if engine not in _backends:
+        found = None
+        if engine.dialect.name == 'sqlite':
+            found = session.execute(text(
+                "SELECT name FROM sqlite_master WHERE type = 'table' "
+                "AND name = :name"), {'name': FTS_TABLE}).first()
+        _backends[engine] = BACKEND_FTS5 if found else BACKEND_TERMS
+    return _backends[engine]
+
+def terms(value):
+    return [term for term in TOKEN_RE.findall(value.lower())
+            if len(term) <= MAX_TERM_LENGTH]
+
+def term_weights(title, raw):
+    weights = {}
+    for term in terms(title or u''):
+        weights[term] = weights.get(term, 0) + TITLE_WEIGHT
+    for term in terms(raw or u''):
+        weights[term] = weights.get(term, 0) + 1
+    return weights
+
+def index_snippets(session, rows):
+    """
+    Adds (id, title, raw) rows, which mustn't be in the index already, to
+    the index. Doesn't commit.
+    """
+    if not rows:
+        return
+    if search_backend(session) == BACKEND_FTS5:
+        session.execute(text('INSERT INTO %s (rowid, title, body) '
+                             'VALUES (:snippet_id, :title, :body)'
+                             % FTS_TABLE),
+                        [{'snippet_id': snippet_id, 'title': title,
+                          'body': raw}
+                         for snippet_id, title, raw in rows])
+        return
+    table = SearchTerm.__table__
+    entries = []
+    for snippet_id, title, raw in rows:
+        for term, weight in term_weights(title, raw).iteritems():
+            entries.append({'term': term, 'snippet_id': snippet_id,
+                            'weight': weight})
+    if entries:
+        session.execute(table.insert(), entries)
+
+def unindex_snippets(session, ids):
+    """
+    Removes the snippets from the index, while they are still in the
+    snippets table. Doesn't commit.
+    """
+    if not ids:
+        return
+    if search_backend(session) == BACKEND_FTS5:
+        # A contentless table is told what to remove from the index.
+        rows = session.query(Snippet.id, Snippet.title, Snippet.snippet_raw) \
+                      .filter(Snippet.id.in_(ids)).all()
+        if rows:
+            session.execute(text("INSERT INTO %s (%s, rowid, title, body) "
+                                 "VALUES ('delete', :snippet_id, :title, "
+                                 ":body)" % (FTS_TABLE, FTS_TABLE)),
+                            [{'snippet_id': snippet_id, 'title': title,
+                              'body': raw}
+                             for snippet_id, title, raw in rows])
+    else:
+        table = SearchTerm.__table__
+        session.execute(table.delete().where(table.c.snippet_id.in_(ids)))
+
+def index_snippet(session, snippet):
+    index_snippets(session, [(snippet.id, snippet.title,
+                              snippet.snippet_raw)])
+
+def clear_index(session):
+    if search_backend(session) == BACKEND_FTS5:
+        # Recreated rather than emptied, which also turns a table from
+        # before the index was contentless into a contentless one.
+        session.execute(text('DROP TABLE %s' % FTS_TABLE))
+        session.execute(text(FTS_DDL))
+    else:
+        session.execute(SearchTerm.__table__.delete())
+
+def rebuild_index(session, batch_size=500):
+    """
+    Reindexes every snippet, committing after each batch. Returns the
+    number of snippets indexed.
+    """
+    clear_index(session)
+    session.commit()
+    query = session.query(Snippet.id, Snippet.title, Snippet.snippet_raw) \
+                   .order_by(Snippet.id)
+    last_id = 0
+    indexed = 0
+    while True:
+        rows = query.filter(Snippet.id > last_id).limit(batch_size).all()
+        if not rows:
+            break
+        index_snippets(session, rows)
+        session.commit()
+        indexed += len(rows)
+        last_id = rows[-1].id
+    if search_backend(session) == BACKEND_FTS5:
+        # Merges the b-trees written batch by batch into one.
+        session.execute(text("INSERT INTO %s (%s) VALUES ('optimize')"
+                             % (FTS_TABLE, FTS_TABLE)))
+        session.commit()
+    return indexed
+
+def fts5_ids(session, words, lang, author_id, limit, offset):
+    # Every word is quoted so FTS5 query syntax in the search box is inert.
+    params = {'match': ' '.join('"%s"' % word for word in words),
+              'now': datetime.datetime.now(), 'limit': limit,
+              'offset': offset}
+    sql = ('SELECT snippets.id FROM %s JOIN snippets '
+           'ON snippets.id = %s.rowid WHERE %s MATCH :match '
+           'AND (snippets.expires_at IS NULL OR snippets.expires_at > :now)'
+           % (FTS_TABLE, FTS_TABLE, FTS_TABLE))
+    if lang:
+        sql += ' AND snippets.snippet_lang = :lang'
+        params['lang'] = lang
+    if author_id is not None:
+        sql += ' AND snippets.author_id = :author_id'
+        params['author_id'] = author_id
+    sql += (' ORDER BY bm25(%s, %d.0, 1.0) LIMIT :limit OFFSET :offset'
+            % (FTS_TABLE, TITLE_WEIGHT))
+    query = text(sql, bindparams=[bindparam('now', type_=DateTime)])
+    return [row[0] for row in session.execute(query, params)]
+
+def term_ids(session, words, lang, author_id, limit, offset):
+    score = func.sum(SearchTerm.weight)
+    query = session.query(SearchTerm.snippet_id) \
+                   .join(Snippet, Snippet.id == SearchTerm.snippet_id) \
+                   .filter(SearchTerm.term.in_(words)) \
+                   .filter(unexpired()) \
+                   .group_by(SearchTerm.snippet_id) \
+                   .having(func.count(SearchTerm.term) == len(words))
+    if lang:
+        query = query.filter(Snippet.snippet_lang == lang)
+    if author_id is not None:
+        query = query.filter(Snippet.author_id == author_id)
+    query = query.order_by(score.desc(), SearchTerm.snippet_id.desc()) \
+                 .limit(limit).offset(offset)
+    return [row[0] for row in query]
+
+def search(session, query, lang=None, author_id=None, limit=10, offset=0):
+    """
+    Summaries (see snippet_summaries) of the unexpired snippets containing
+    every word of the query, best match first.
+    """
+    words = []
+    for word in terms(query):
+        if word not in words:
+            words.append(word)
+    words = words[:MAX_QUERY_TERMS]
+    if not words:
+        return []
+    if search_backend(session) == BACKEND_FTS5:
+        ids = fts5_ids(session, words, lang, author_id, limit, offset)
+    else:
+        ids = term_ids(session, words, lang, author_id, limit, offset)
+    if not ids:
+        return []
+    rows = snippet_summaries(session).filter(Snippet.id.in_(ids)).all()
+    by_id = dict((row.id, row) for row in rows)
+    return [by_id[snippet_id] for snippet_id in ids if snippet_id in by_id]
@@ -0,0 +1,202 @@
+"""
+Near-duplicate detection with SimHash fingerprints.
+
+A snippet's source is split into tokens (whitespace is ignored, so
+reindented copies match), and every run of SHINGLE_SIZE tokens is
+hashed; the fingerprint is the 64-bit SimHash of those shingle hashes.
+Sources that share most of their shingles get fingerprints a few bits
+apart. To bound the cost for huge pastes only the first MAX_CHARACTERS
+are used, and those are sampled down to the MAX_SHINGLES smallest
+shingle hashes; near-duplicates mostly share both.
+
+Fingerprints are split into BANDS 16-bit bands stored in snippet_bands,
+so finding candidates is a handful of primary key lookups; any two
+fingerprints within BANDS - 1 bits of each other share a band.
+"""
+import re
+import struct
+import hashlib
+import heapq
+from multiprocessing import Pool
+
+from sqlalchemy import and_, or_, bindparam
+
+from pasteapp.database import Snippet, SnippetBand, SnippetBlob, unexpired
+from pasteapp.highlighting import render_digest
+
+SHINGLE_SIZE = 4
+MAX_SHINGLES = 1024
+MAX_CHARACTERS = 64 * 1024
+BANDS = 4
+BAND_BITS = 16
+MAX_DISTANCE = BANDS - 1
+
+TOKEN_RE = re.compile(r'\w+|[^\w\s]', re.UNICODE)
+
+# Odd multipliers for mixing token hashes into shingle hashes, small
+# enough that the arithmetic stays within machine-sized integers.
+MULTIPLIERS = (0x1e3779b1, 0x12b2ae35, 0x165667b1, 0x06e8feb9)
+HALF_MASK = (1 << 32) - 1
+
+def token_hash(token):
+    """
+    Two independent 32-bit hashes of the token.
+    """
+    return struct.unpack('<II', hashlib.md5(token.encode('utf-8'))
+                         .digest()[:8])
+
+def shingle_hashes(text):
+    """
+    64-bit hashes of the distinct shingles of the text, at most
+    MAX_SHINGLES of them.
+    """
+    tokens = TOKEN_RE.findall(text[:MAX_CHARACTERS].lower())
+    if not tokens:
+        return []
+    # Repeated shingles are dropped before any hashing and each distinct
+    # token is hashed once. A shingle's hash is mixed from its tokens' in
+    # two 32-bit halves, and only the shingles kept by the sample (the
+    # smallest high halves) get their low half.
+    count = max(len(tokens) - SHINGLE_SIZE + 1, 1)
+    tokens += [u''] * (SHINGLE_SIZE - 1)
+    shingles = set(zip(tokens, tokens[1:], tokens[2:], tokens[3:])[:count])
+    high = {}
+    low = {}
+    for token in set(tokens):
+        high[token], low[token] = token_hash(token)
+    m1, m2, m3, m4 = MULTIPLIERS
+    keyed = [((high[a] * m1 + high[b] * m2 + high[c] * m3 + high[d] * m4) &
+              HALF_MASK, (a, b, c, d))
+             for a, b, c, d in shingles]
+    if len(keyed) > MAX_SHINGLES:
+        keyed = heapq.nsmallest(MAX_SHINGLES, keyed)
+    return [(key << 32) |
+            ((low[a] * m1 + low[b] * m2 + low[c] * m3 + low[d] * m4) &
+             HALF_MASK)
+            for key, (a, b, c, d) in keyed]
+
+def fingerprint(text):
+    """
+    The SimHash of the text as a signed 64-bit integer, which is what the
+    database column holds.
+    """
+    hashes = shingle_hashes(text or u'')
+    if not hashes:
+        return 0
+    # One string of bits per shingle; zip turns them into a column per
+    # bit, which str.count can sum without a Python-level loop per bit.
+    columns = zip(*['{0:064b}'.format(value) for value in hashes])
+    half = len(hashes) / 2.0
+    value = 0
+    for column in columns:
+        value = (value << 1) | (column.count('1') > half)
+    return to_signed(value)
+
+def to_signed(value):
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+def to_unsigned(value):
+    return value + (1 << 64) if value < 0 else value
+
+def distance(a, b):
+    return bin(to_unsigned(a) ^ to_unsigned(b)).count('1')
+
+def bands(value):
+    value = to_unsigned(value)
+    mask = (1 << BAND_BITS) - 1
+    return [(band, (value >> (band * BAND_BITS)) & mask)
+            for band in range(BANDS)]
+
+def index_fingerprints(session, rows):
+    """
+    Adds (snippet_id, fingerprint) rows to snippet_bands. Doesn't commit.
+    """
+    if not rows:
+        return
+    session.execute(SnippetBand.__table__.insert(), [
+        {'band': band, 'value': value, 'snippet_id': snippet_id}
+        for snippet_id, simhash in rows
+        for band, value in bands(simhash)
+    ])
+
+def find_near_duplicate(session, simhash, lang=None,
+                        max_distance=MAX_DISTANCE):
+    """
+    Returns the id of the closest unexpired snippet whose fingerprint is
+    within max_distance bits of simhash, or None. Distances over
+    MAX_DISTANCE may miss matches that share no band.
+    """
+    criteria = [and_(SnippetBand.band == band, SnippetBand.value == value)
+                for band, value in bands(simhash)]
+    query = session.query(Snippet.id, Snippet.simhash) \
+                   .join(SnippetBand, SnippetBand.snippet_id == Snippet.id) \
+                   .filter(or_(*criteria)).filter(unexpired())
+    if lang is not None:
+        query = query.filter(Snippet.snippet_lang == lang)
+    best = None
+    for snippet_id, candidate in query.distinct():
+        bits = distance(simhash, candidate)
+        if bits <= max_distance and (best is None or bits < best[0] or
+                                     (bits == best[0] and
+                                      snippet_id < best[1])):
+            best = (bits, snippet_id)
+    return best[1] if best else None
+
+def duplicate_blob_id(session, duplicate_id, snippet_raw, snippet_lang):
+    """
+    The blob the near-duplicate was rendered into, if highlighting this
+    source would produce that same HTML; None otherwise, or if it hasn't
+    been rendered yet.
+    """
+    digest = render_digest(snippet_raw, snippet_lang)
+    row = session.query(Snippet.blob_id) \
+                 .join(SnippetBlob, SnippetBlob.id == Snippet.blob_id) \
+                 .filter(Snippet.id == duplicate_id) \
+                 .filter(SnippetBlob.digest == digest).first()
+    return row.blob_id if row else None
+
+def fingerprint_batch(rows):
+    """
+    Runs in the backfill pool: (id, raw) rows to (id, fingerprint) ones.
+    """
+    return [(snippet_id, fingerprint(raw)) for snippet_id, raw in rows]
+
+def backfill_fingerprints(session, batch_size=500, processes=0):
+    """
+    Fingerprints and indexes every snippet that doesn't have one yet,
+    `processes` batches at a time, committing after each round. Returns
+    the number of snippets fingerprinted.
+    """
+    table = Snippet.__table__
+    update = table.update().where(table.c.id == bindparam('snippet_id')) \
+                           .values(simhash=bindparam('fingerprint'))
+    pool = Pool(processes) if processes else None
+    done = 0
+    last_id = 0
+    try:
+        while True:
+            rows = session.query(Snippet.id, Snippet.snippet_raw) \
+                          .filter(Snippet.id > last_id) \
+                          .filter(Snippet.simhash == None) \
+                          .order_by(Snippet.id) \
+                          .limit(batch_size * max(processes, 1)).all()
+            if not rows:
+                return done
+            last_id = rows[-1][0]
+            batches = [[tuple(row) for row in rows[i:i + batch_size]]
+                       for i in range(0, len(rows), batch_size)]
+            if pool is not None:
+                results = pool.map(fingerprint_batch, batches)
+            else:
+                results = [fingerprint_batch(batch) for batch in batches]
+            fingerprinted = [row for result in results for row in result]
+            session.execute(update, [
+                {'snippet_id': snippet_id, 'fingerprint': simhash}
+                for snippet_id, simhash in fingerprinted
+            ])
+            index_fingerprints(session, fingerprinted)
+            session.commit()
+            done += len(fingerprinted)
+    finally:
+        if pool is not None:
+            pool.terminate()
@@ -0,0 +1,267 @@
+"""
+Version 1 of the JSON API, for scripts that would otherwise scrape the
+HTML pages. Every request needs a token from `manage.py create_api_token`
+sent as `Authorization: Token <token>`.
+
+    POST /api/v1/snippets           {"snippets": [{"title": ..,
+                                                   "language": ..,
+                                                   "raw": ..}, ...]}
+    GET  /api/v1/snippets?ids=1,2,3
+    GET  /api/v1/snippets/<id>
+
+A batch create is validated with SnippetForm, highlighted across the
+render pool and inserted in one transaction, so either every snippet in
+it goes in or none does. Fetches carry an ETag derived from the snippets'
+render states, which is checked before any of their bodies are loaded.
+
+Near-duplicates of existing snippets are handled as NEAR_DUPLICATES says,
+item by item: 'reject' fails the batch, 'redirect' answers with the
+existing snippet (marked "duplicate": true) in place of a new one, and
+'allow' creates it with duplicate_of set.
+"""
+import json
+import hashlib
+from functools import partial
+
+from flask import Blueprint, request, current_app, jsonify, url_for, g
+from werkzeug.datastructures import MultiDict
+from werkzeug.http import is_resource_modified
+from sqlalchemy.orm import undefer_group, joinedload
+
+from pasteapp import bulk
+from pasteapp.forms import SnippetForm
+from pasteapp.database import (
+    db_session, Snippet, api_token_user_id, unexpired
+)
+from pasteapp.render_queue import render_queue
+from pasteapp.cache import cache
+from pasteapp.feed import recent_feed, feed_record
+from pasteapp.metrics import metrics
+from pasteapp.similarity import (
+    fingerprint, find_near_duplicate, duplicate_blob_id, MAX_DISTANCE
+)
+from pasteapp.views.frontend import INDEX_CACHE_KEY, CHUNK_THRESHOLD
+
+API_BATCH_LIMIT = 100
+
+api = Blueprint('api', __name__)
+
+def api_error(status, message, **details):
+    response = jsonify(error=message, **details)
+    response.status_code = status
+    return response
+
+@api.errorhandler(413)
+def too_large(error):
+    # Ahead of the frontend's handler, which answers with the HTML form.
+    return api_error(413, 'Requests can be at most %d bytes.'
+                     % current_app.config['MAX_CONTENT_LENGTH'])
+
+@api.before_request
+def authenticate():
+    scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+    user_id = None
+    if scheme.lower() == 'token' and token.strip():
+        user_id = api_token_user_id(db_session, token.strip())
+    if user_id is None:
+        response = api_error(401, 'A valid API token is required.')
+        response.headers['WWW-Authenticate'] = 'Token'
+        return response
+    g.api_user_id = user_id
+
+@api.route('/snippets', methods=['POST'])
+def create_snippets():
+    try:
+        payload = json.loads(request.data)
+    except ValueError:
+        return api_error(400, 'The request body must be JSON.')
+    items = payload.get('snippets') if isinstance(payload, dict) else None
+    if not isinstance(items, list) or not items:
+        return api_error(400, 'Expected {"snippets": [...]}.')
+    limit = current_app.config.get('API_BATCH_LIMIT', API_BATCH_LIMIT)
+    if len(items) > limit:
+        return api_error(400, 'At most %d snippets per request.' % limit)
+    records, errors = validate_snippets(items)
+    if errors:
+        return api_error(400, 'Some snippets are invalid.', errors=errors)
+    threshold = current_app.config.get('SNIPPET_CHUNK_THRESHOLD',
+                                       CHUNK_THRESHOLD)
+    duplicates = near_duplicates(records)
+    action = current_app.config.get('NEAR_DUPLICATES', 'allow')
+    found = [duplicate_id for duplicate_id in duplicates
+             if duplicate_id is not None]
+    if found:
+        metrics.incr('near_duplicates', len(found), action=action)
+    if found and action == 'reject':
+        # Every item was valid, so positions in records are the items'.
+        errors = dict((position, {'raw': ['This is nearly identical to '
+                                          'snippet %d.' % duplicate_id]})
+                      for position, duplicate_id in enumerate(duplicates)
+                      if duplicate_id is not None)
+        return api_error(400, 'Some snippets are invalid.', errors=errors)
+    if action == 'redirect':
+        new_records = [record for record, duplicate_id
+                       in zip(records, duplicates) if duplicate_id is None]
+    else:
+        new_records = records
+        for record, duplicate_id in zip(records, duplicates):
+            if duplicate_id is None:
+                continue
+            record['duplicate_of'] = duplicate_id
+            if len(record['raw']) <= threshold:
+                # A copy highlights to the same HTML as the one it copies.
+                record['blob_id'] = duplicate_blob_id(
+                    db_session, duplicate_id, record['raw'],
+                    record['language'])
+    rendered = render_records(new_records, threshold)
+    snippets = bulk.create_snippets(db_session, g.api_user_id, new_records,
+                                    rendered, threshold)
+    # Read before the commit expires them.
+    ids = iter([snippet.id for snippet in snippets])
+    feed_records = [feed_record(snippet.id, snippet.title,
+                                snippet.snippet_lang, snippet.created_date)
+                    for snippet in snippets]
+    db_session.commit()
+    for record in feed_records:
+        recent_feed.push(record)
+    if snippets:
+        cache.delete(INDEX_CACHE_KEY)
+    metrics.incr('api_snippets_created', len(snippets))
+    results = []
+    for duplicate_id in duplicates:
+        if action == 'redirect' and duplicate_id is not None:
+            results.append({'id': duplicate_id, 'duplicate': True})
+        else:
+            results.append({'id': next(ids)})
+        results[-1]['url'] = url_for('frontend.view_snippet',
+                                     snippet_id=results[-1]['id'],
+                                     _external=True)
+    response = jsonify(snippets=results)
+    response.status_code = 201 if snippets else 200
+    return response
+
+def validate_snippets(items):
+    """
+    Runs each item through SnippetForm. Returns the valid records and a
+    dict of errors by the item's position.
+    """
+    records = []
+    errors = {}
+    for position, item in enumerate(items):
+        if not isinstance(item, dict):
+            errors[position] = {'snippet': ['Must be an object.']}
+            continue
+        fields = {'title': item.get('title'),
+                  'language': item.get('language', 'text'),
+                  'raw_content': item.get('raw')}
+        formdata = MultiDict((name, value) for name, value in fields.items()
+                             if isinstance(value, basestring))
+        form = SnippetForm(formdata, csrf_enabled=False)
+        if not form.validate():
+            item_errors = dict(form.errors)
+            if 'raw_content' in item_errors:
+                item_errors['raw'] = item_errors.pop('raw_content')
+            errors[position] = item_errors
+            continue
+        records.append({'title': form.title.data,
+                        'language': form.language.data,
+                        'raw': form.raw_content.data})
+    return records, errors
+
+def near_duplicates(records):
+    """
+    Fingerprints the records and returns, for each, the id of the snippet
+    it nearly duplicates or None.
+    """
+    distance = current_app.config.get('NEAR_DUPLICATE_DISTANCE',
+                                      MAX_DISTANCE)
+    duplicates = []
+    for record in records:
+        record['simhash'] = fingerprint(record['raw'])
+        duplicates.append(find_near_duplicate(db_session, record['simhash'],
+                                              record['language'], distance))
+    return duplicates
+
+def render_records(records, chunk_threshold):
+    """
+    Highlights the records split evenly across the render pool, or skips
+    that in lazy mode. Records with a 'blob_id' already have their HTML.
+    Returns a (digest, formatted) pair per record.
+    """
+    pending = [record for record in records if not record.get('blob_id')]
+    if not pending or \
+       current_app.config.get('RENDER_MODE', 'eager') == 'lazy':
+        rendered = iter(bulk.skip_render(pending)[1])
+    else:
+        parts = max(render_queue.processes, 1)
+        size = -(-len(pending) // parts)
+        batches = [pending[i:i + size] for i in range(0, len(pending), size)]
+        job = partial(bulk.render_batch, chunk_threshold=chunk_threshold)
+        rendered = []
+        for batch, results in render_queue.map(job, batches):
+            rendered.extend(results)
+        rendered = iter(rendered)
+    return [(None, None) if record.get('blob_id') else next(rendered)
+            for record in records]
+
+@api.route('/snippets')
+def get_snippets():
+    try:
+        ids = [int(value) for value in request.args.get('ids', '').split(',')
+               if value.strip()]
+    except ValueError:
+        return api_error(400, 'ids must be a comma separated list of '
+                              'snippet ids.')
+    if not ids:
+        return api_error(400, 'Expected ?ids=1,2,3.')
+    limit = current_app.config.get('API_BATCH_LIMIT', API_BATCH_LIMIT)
+    if len(ids) > limit:
+        return api_error(400, 'At most %d snippets per request.' % limit)
+    # Keeps the order asked for, without repeats.
+    seen = set()
+    ids = [snippet_id for snippet_id in ids
+           if not (snippet_id in seen or seen.add(snippet_id))]
+    return fetch_snippets(ids, single=False)
+
+@api.route('/snippets/<int:snippet_id>')
+def get_snippet(snippet_id):
+    return fetch_snippets([snippet_id], single=True)
+
+def fetch_snippets(ids, single):
+    # A snippet's content never changes, only its render, so the states
+    # are all the ETag needs and can be checked with a narrow query.
+    states = db_session.query(Snippet.id, Snippet.render_state,
+                              Snippet.blob_id) \
+                       .filter(Snippet.id.in_(ids)).filter(unexpired()).all()
+    if single and not states:
+        return api_error(404, 'No such snippet.')
+    etag = hashlib.sha1(repr((ids, sorted(states)))).hexdigest()
+    if not is_resource_modified(request.environ, etag):
+        response = current_app.response_class(status=304)
+        response.set_etag(etag)
+        return response
+    snippets = Snippet.query.options(undefer_group('body'),
+                                     joinedload('blob')) \
+                            .filter(Snippet.id.in_(ids)) \
+                            .filter(unexpired()).all()
+    by_id = dict((snippet.id, snippet) for snippet in snippets)
+    if single:
+        response = jsonify(snippet_json(by_id[ids[0]]))
+    else:
+        response = jsonify(
+            snippets=[snippet_json(by_id[i]) for i in ids if i in by_id],
+            missing=[i for i in ids if i not in by_id])
+    response.set_etag(etag)
+    return response
+
+def snippet_json(snippet):
+    return {
+        'id': snippet.id,
+        'title': snippet.title,
+        'language': snippet.snippet_lang,
+        'author_id': snippet.author_id,
+        'created_date': snippet.created_date.isoformat(),
+        'render_state': snippet.render_state,
+        'raw': snippet.snippet_raw,
+        'html': snippet.snippet_formatted
+    }
@@ -0,0 +1,72 @@
+import os
+import mimetypes
+
+from flask import (
+    Blueprint, current_app, request, send_file, send_from_directory, url_for
+)
+from flask.helpers import safe_join
+
+from pasteapp.assets import asset_manifest, pygments_css, PYGMENTS_CSS, MANIFEST
+
+ONE_YEAR = 365 * 24 * 60 * 60
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+static_assets = Blueprint('static_assets', __name__)
+
+_generated = {}
+
+def asset_url(name):
+    """
+    The URL of a file under pasteapp/static (or of pygments.css): its
+    hashed name once assets have been built, otherwise the plain one.
+    """
+    return url_for('static_assets.asset',
+                   filename=asset_manifest.url_name(name))
+
+@static_assets.route('/assets/<path:filename>')
+def asset(filename):
+    build_dir = asset_manifest.build_dir
+    if build_dir and filename != MANIFEST:
+        path = safe_join(build_dir, filename)
+        if os.path.isfile(path):
+            return built_asset(path, filename)
+    return plain_asset(filename)
+
+def built_asset(path, filename):
+    """
+    Hashed names never change content, so they can be cached for good. The
+    precompressed variant is sent when the client accepts it.
+    """
+    encoding = None
+    for name, extension in ENCODINGS:
+        if request.accept_encodings.quality(name) > 0 and \
+           os.path.isfile(path + extension):
+            encoding = name
+            path += extension
+            break
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    response = send_file(path, mimetype=mimetype, conditional=True)
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = 'public, max-age=%d, immutable' \
+        % ONE_YEAR
+    return response
+
+def plain_asset(filename):
+    """
+    Serves an asset by its plain name, for when they haven't been built.
+    Clients revalidate these on every use.
+    """
+    if filename == PYGMENTS_CSS:
+        style = asset_manifest.style
+        if style not in _generated:
+            _generated[style] = pygments_css(style)
+        response = current_app.response_class(_generated[style],
+                                              mimetype='text/css')
+        response.add_etag()
+        response.make_conditional(request)
+    else:
+        response = send_from_directory(current_app.static_folder, filename)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
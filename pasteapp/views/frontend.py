@@ -1,21 +1,93 @@
 from flask import (
     Blueprint, render_template, request, flash, redirect, url_for, abort,
-    session
+    session, make_response, current_app, stream_with_context
 )
+from werkzeug.http import is_resource_modified
+from werkzeug.contrib.atom import AtomFeed
 
-from pasteapp.forms import RegistrationForm, LoginForm, SnippetForm
-from pasteapp.database import User, db_session, Snippet
+from pasteapp.forms import (
+    RegistrationForm, LoginForm, SnippetForm, SearchForm, MAX_SNIPPET_LENGTH
+)
+from pasteapp.database import (
+    User, db_session, Snippet, SnippetBlob, increment_snippet_count,
+    snippet_summaries, snippet_info, snippet_source, most_viewed, is_expired,
+    iter_stored, iter_text, RENDER_DONE, RENDER_PENDING, RENDER_CHUNKED
+)
+from pasteapp.compression import is_compressed, iter_decompressed
+from pasteapp.render_queue import render_queue
+from pasteapp.cache import cache, render_cache, snippet_cache
+from pasteapp.counters import view_counter
+from pasteapp.highlighting import render, parse_options, options_key
+from pasteapp.auth import (
+    hash_pool, hash_password, check_password, hash_rounds, HashPoolSaturated,
+    ip_throttle, username_throttle
+)
+from pasteapp.metrics import metrics
+from pasteapp.search import search, search_backend, index_snippet
+from pasteapp.feed import recent_feed, feed_record, record_datetime
+from pasteapp.highlighting import LANGUAGES
+from pasteapp.similarity import (
+    fingerprint, find_near_duplicate, duplicate_blob_id, index_fingerprints,
+    MAX_DISTANCE
+)
 
+import json
 from math import ceil
+from time import time
+from datetime import datetime, timedelta
+from itertools import chain
 
 PER_PAGE = 10
+INDEX_CACHE_KEY = 'page/index'
+MOST_VIEWED_CACHE_KEY = 'list/most_viewed'
+STREAM_THRESHOLD = 256 * 1024
+STREAM_CHUNK_SIZE = 64 * 1024
+CHUNK_THRESHOLD = 200 * 1000
+LINES_PER_PAGE = 2000
+BUSY_MESSAGE = 'Too many login attempts right now, please try again shortly.'
 
 class Pagination(object):
+    """
+    Pages through results either by page number (OFFSET) or, in keyset
+    mode, relative to the first/last id already shown. Keyset pages are
+    fetched with an indexed range scan so deep pages cost the same as the
+    first one.
+    """
 
-    def __init__(self, page_num, per_page, results_total):
+    def __init__(self, page_num, per_page, results_total, keyset=False):
         self.page_num = page_num
         self.per_page = per_page
         self.results_total = results_total
+        self.keyset = keyset
+        self.first_id = None
+        self.last_id = None
+        self.more_before = False
+        self.more_after = False
+
+    def paginate(self, query, column, after=None, before=None):
+        """
+        Returns one keyset page of the query in descending column order.
+        `after` gives the page following that id and `before` the page
+        preceding it.
+        """
+        if before is not None:
+            results = query.filter(column > before).order_by(column.asc()) \
+                           .limit(self.per_page + 1).all()
+            self.more_before = len(results) > self.per_page
+            self.more_after = True
+            results = results[:self.per_page][::-1]
+        else:
+            if after is not None:
+                query = query.filter(column < after)
+            results = query.order_by(column.desc()) \
+                           .limit(self.per_page + 1).all()
+            self.more_after = len(results) > self.per_page
+            self.more_before = after is not None
+            results = results[:self.per_page]
+        if results:
+            self.first_id = results[0].id
+            self.last_id = results[-1].id
+        return results
 
     @property
     def pages(self):
@@ -23,10 +95,14 @@ class Pagination(object):
 
     @property
     def has_prev(self):
+        if self.keyset:
+            return self.more_before
         return self.page_num > 1
 
     @property
     def has_next(self):
+        if self.keyset:
+            return self.more_after
         return self.page_num < self.pages
 
 
@@ -34,8 +110,95 @@ frontend = Blueprint('frontend', __name__)
 
 @frontend.route('/')
 def index():
-    snippets = Snippet.query.order_by(Snippet.id.desc()).limit(20)
-    return render_template('index.html', snippets=snippets)
+    cacheable = is_shareable_page()
+    if cacheable:
+        page = cache.get(INDEX_CACHE_KEY)
+        if page is not None:
+            metrics.incr('page_cache_hits', page='index')
+            return page
+        metrics.incr('page_cache_misses', page='index')
+    page = render_template('index.html',
+                           snippets=recent_feed.recent(db_session),
+                           popular=most_viewed_list())
+    if cacheable:
+        # Creating a snippet only clears this worker's copy unless the
+        # cache is shared, so INDEX_CACHE_TIMEOUT bounds how stale the
+        # others' can get.
+        cache.set(INDEX_CACHE_KEY, page,
+                  timeout=current_app.config.get('INDEX_CACHE_TIMEOUT'))
+    return page
+
+def most_viewed_list():
+    """
+    The counts only change when views are flushed, so the list is cached
+    for that long.
+    """
+    popular = cache.get(MOST_VIEWED_CACHE_KEY)
+    if popular is None:
+        popular = [{'id': row.id, 'title': row.title,
+                    'view_count': row.view_count}
+                   for row in most_viewed(db_session)]
+        cache.set(MOST_VIEWED_CACHE_KEY, popular,
+                  timeout=current_app.config.get('VIEW_COUNT_FLUSH_SECONDS',
+                                                 30))
+    return popular
+
+@frontend.route('/feed.json')
+def json_feed():
+    snippet_lang = feed_language()
+    records = recent_feed.recent(db_session, snippet_lang)
+    response = feed_response(records, snippet_lang)
+    if response.status_code == 304:
+        return response
+    response.data = json.dumps({'snippets': [
+        dict(record, url=snippet_url(record)) for record in records
+    ]})
+    response.mimetype = 'application/json'
+    return response
+
+@frontend.route('/feed.atom')
+def atom_feed():
+    snippet_lang = feed_language()
+    records = recent_feed.recent(db_session, snippet_lang)
+    response = feed_response(records, snippet_lang)
+    if response.status_code == 304:
+        return response
+    title = 'Recent %s snippets' % (snippet_lang or 'code')
+    updated = record_datetime(records[0]) if records else datetime.now()
+    feed = AtomFeed(title, feed_url=request.url, url=request.url_root,
+                    updated=updated, author='Simple Code Snippets')
+    for record in records:
+        created = record_datetime(record)
+        feed.add(record['title'], url=snippet_url(record),
+                 summary='%s snippet' % record['language'],
+                 summary_type='text', updated=created, published=created,
+                 author='Simple Code Snippets')
+    response.data = feed.to_string().encode('utf-8')
+    response.mimetype = 'application/atom+xml'
+    return response
+
+def feed_language():
+    snippet_lang = request.args.get('language')
+    if snippet_lang and snippet_lang not in dict(LANGUAGES):
+        abort(404)
+    return snippet_lang
+
+def feed_response(records, snippet_lang):
+    """
+    A feed only changes when a snippet is added, so the newest id is
+    enough for an ETag. Returns a 304 if the client is up to date.
+    """
+    etag = 'feed-%s-%s' % (snippet_lang or 'all',
+                           records[0]['id'] if records else 0)
+    response = current_app.response_class()
+    response.set_etag(etag)
+    if not is_resource_modified(request.environ, etag):
+        response.status_code = 304
+    return response
+
+def snippet_url(record):
+    return url_for('frontend.view_snippet', snippet_id=record['id'],
+                   _external=True)
 
 @frontend.route('/register', methods=['GET', 'POST'])
 def register():
@@ -50,9 +213,14 @@ def register():
             return render_template('register.html',
                                    form=form,
                                    err='Email address has already been used.')
+        try:
+            password = hash_pool.run(hash_password, form.password.data,
+                                     hash_pool.rounds)
+        except HashPoolSaturated:
+            return too_busy('register.html', form, 1)
         user = User(form.username.data,
                     form.email.data,
-                    form.password.data)
+                    password=password)
         db_session.add(user)
         db_session.commit()
         flash('You have successfully registered and can now log in.')
@@ -64,11 +232,24 @@ def login():
     form = LoginForm()
     err = None
     if form.validate_on_submit():
-        user = User.query.filter(User.username == form.username.data).first()
-        if not user or not user.check_bcrypt_hash(form.password.data):
+        address = request.remote_addr
+        username = form.username.data
+        if not ip_throttle.hit(address):
+            return too_busy('login.html', form, ip_throttle.retry_after)
+        if username_throttle.exceeded(username):
+            return too_busy('login.html', form, username_throttle.retry_after)
+        user = User.query.filter(User.username == username).first()
+        try:
+            valid = user and hash_pool.run(check_password, form.password.data,
+                                           user.password)
+        except HashPoolSaturated:
+            return too_busy('login.html', form, 1)
+        if not valid:
+            username_throttle.hit(username)
             err = "Invalid username or password"
             return render_template('login.html', form=form, err=err)
         else:
+            upgrade_password_hash(user, form.password.data)
             session['user_id'] = user.id
             flash('You have logged in successfully.')
             return redirect(url_for('frontend.dashboard'))
@@ -82,18 +263,29 @@ def logout():
     session.pop('user_id', None)
     return redirect(url_for('frontend.index'))
 
-@frontend.route('/dashboard', defaults={'page_num': 1})
+@frontend.route('/dashboard', defaults={'page_num': None})
 @frontend.route('/dashboard/<int:page_num>')
 def dashboard(page_num):
     if 'user_id' not in session:
         flash('You must log in first')
         return redirect(url_for('frontend.login'))
     else:
-        count = Snippet.query.filter(Snippet.author_id == session['user_id']).count()
-        results = Snippet.query.filter(Snippet.author_id == session['user_id']).order_by(Snippet.id.desc()).limit(PER_PAGE).offset((page_num-1) * PER_PAGE).all()
-        if not results and page_num != 1:
-            abort(404)
-        pagination = Pagination(page_num, PER_PAGE, count)
+        count = db_session.query(User.snippet_count) \
+                          .filter(User.id == session['user_id']).scalar()
+        query = snippet_summaries(db_session) \
+            .filter(Snippet.author_id == session['user_id'])
+        if page_num is None:
+            after = request.args.get('after', type=int)
+            before = request.args.get('before', type=int)
+            pagination = Pagination(1, PER_PAGE, count or 0, keyset=True)
+            results = pagination.paginate(query, Snippet.id, after, before)
+            if not results and (after or before):
+                abort(404)
+        else:
+            results = query.order_by(Snippet.id.desc()).limit(PER_PAGE).offset((page_num-1) * PER_PAGE).all()
+            if not results and page_num != 1:
+                abort(404)
+            pagination = Pagination(page_num, PER_PAGE, count or 0)
         return render_template('dashboard.html', pagination=pagination, results=results)
 
 @frontend.route('/snippet/new', methods=['GET', 'POST'])
@@ -103,26 +295,452 @@ def new_snippet():
         return redirect(url_for('frontend.login'))
     form = SnippetForm()
     if form.validate_on_submit():
+        simhash = fingerprint(form.raw_content.data)
+        duplicate_id = find_near_duplicate(
+            db_session, simhash, form.language.data,
+            current_app.config.get('NEAR_DUPLICATE_DISTANCE', MAX_DISTANCE))
+        if duplicate_id is not None:
+            action = current_app.config.get('NEAR_DUPLICATES', 'allow')
+            metrics.incr('near_duplicates', action=action)
+            if action == 'reject':
+                err = 'This is nearly identical to snippet %d.' % duplicate_id
+                return render_template('new_snippet.html', form=form, err=err)
+            if action == 'redirect':
+                flash('An almost identical snippet already exists.')
+                return redirect(url_for('frontend.view_snippet',
+                                        snippet_id=duplicate_id))
         snippet = Snippet(form.title.data,
                           form.language.data,
                           session['user_id'],
                           form.raw_content.data)
+        snippet.simhash = simhash
+        snippet.duplicate_of = duplicate_id
+        if form.expires.data:
+            snippet.expires_at = snippet.created_date + \
+                timedelta(seconds=int(form.expires.data))
+        threshold = current_app.config.get('SNIPPET_CHUNK_THRESHOLD',
+                                           CHUNK_THRESHOLD)
+        if snippet.raw_size > threshold:
+            snippet.render_state = RENDER_CHUNKED
+        elif duplicate_id is not None:
+            # A copy highlights to the same HTML as the snippet it copies.
+            snippet.blob_id = duplicate_blob_id(db_session, duplicate_id,
+                                                snippet.snippet_raw,
+                                                snippet.snippet_lang)
+            if snippet.blob_id is not None:
+                snippet.render_state = RENDER_DONE
         db_session.add(snippet)
+        increment_snippet_count(db_session, session['user_id'])
+        db_session.flush()
+        index_snippet(db_session, snippet)
+        index_fingerprints(db_session, [(snippet.id, simhash)])
+        record = feed_record(snippet.id, snippet.title, snippet.snippet_lang,
+                             snippet.created_date, snippet.expires_at)
         db_session.commit()
+        recent_feed.push(record)
+        cache.delete(INDEX_CACHE_KEY)
+        if snippet.render_state == RENDER_PENDING and not lazy_rendering():
+            render_queue.submit(snippet)
         flash('The new snippet has been successfully created.')
         return redirect(url_for('frontend.view_snippet', snippet_id=snippet.id))
     return render_template('new_snippet.html', form=form)
 
+@frontend.app_errorhandler(413)
+def too_large(error):
+    limit = current_app.config.get('SNIPPET_MAX_LENGTH', MAX_SNIPPET_LENGTH)
+    err = 'Snippets can be at most %d characters long.' % limit
+    # The body was refused unread, so the form starts out empty.
+    form = SnippetForm(formdata=None)
+    return render_template('new_snippet.html', form=form, err=err), 413
+
+@frontend.route('/search')
+def search_snippets():
+    form = SearchForm(request.args, csrf_enabled=False)
+    page_num = max(request.args.get('page', 1, type=int), 1)
+    results = []
+    query = (form.q.data or '').strip()
+    if query:
+        author_id = None
+        if form.author.data:
+            author_id = db_session.query(User.id) \
+                .filter(User.username == form.author.data).scalar() or 0
+        start = time()
+        results = search(db_session, query, lang=form.lang.data or None,
+                         author_id=author_id, limit=PER_PAGE + 1,
+                         offset=(page_num - 1) * PER_PAGE)
+        metrics.observe('search_seconds', time() - start,
+                        backend=search_backend(db_session))
+    args = dict((key, value) for key, value in request.args.items()
+                if key != 'page')
+    return render_template('search.html', form=form, query=query,
+                           results=results[:PER_PAGE], page_num=page_num,
+                           has_next=len(results) > PER_PAGE, args=args)
+
 @frontend.route('/about')
 def about():
     return render_template('about.html')
 
 @frontend.route('/snippet/view/<int:snippet_id>')
 def view_snippet(snippet_id):
-    snippet = Snippet.query.filter(Snippet.id == snippet_id).first()
-    if not snippet:
+    options = parse_options(request.args)
+    lines = parse_line_range(request.args.get('lines'))
+    record = snippet_record(snippet_id)
+    # Expired snippets are hidden until the reaper gets to them.
+    if not record or is_expired(record['expires_at']):
+        return abort(404)
+    view_counter.hit(snippet_id)
+    if '_flashes' in session:
+        fragment = snippet_fragment(snippet_id, record, options, lines)
+        if not fragment:
+            return abort(404)
+        return snippet_page(snippet_id, fragment)
+    # Worked out from the record alone, so a revalidation is answered
+    # without highlighting anything. The layout differs for logged in
+    # users, so they get their own etag.
+    state, page = fragment_state(record, options, lines)
+    etag = '%d-%s-%s-%s' % (snippet_id, state,
+                            session.get('user_id', 'anon'),
+                            options_key(options))
+    if page:
+        etag += '-lines=%d-%d' % page
+    last_modified = None
+    if state in (RENDER_DONE, RENDER_CHUNKED):
+        last_modified = record['created_date']
+    if not is_resource_modified(request.environ, etag,
+                                last_modified=last_modified):
+        response = current_app.response_class(status=304)
+    else:
+        fragment = snippet_fragment(snippet_id, record, options, lines)
+        if not fragment:
+            return abort(404)
+        response = snippet_page(snippet_id, fragment)
+    response.set_etag(etag)
+    if last_modified:
+        response.last_modified = last_modified
+    response.headers['Vary'] = 'Cookie'
+    return response
+
+@frontend.route('/snippet/raw/<int:snippet_id>')
+def raw_snippet(snippet_id):
+    record = snippet_record(snippet_id)
+    if not record or is_expired(record['expires_at']):
         return abort(404)
-    return render_template('view_snippet.html', snippet=snippet)
+    chunk_size = current_app.config.get('STREAM_CHUNK_SIZE', STREAM_CHUNK_SIZE)
+    rest = iter_source(snippet_id, record['archived'], chunk_size)
+    first = next(rest, None)
+    # The stored zlib stream is a valid 'deflate' body, so clients that
+    # accept it get the bytes straight from the database.
+    deflate = (is_compressed(first) and
+               request.accept_encodings.quality('deflate') > 0)
+    if deflate:
+        body = chain([bytes(first)[1:]], (bytes(chunk) for chunk in rest))
+    elif first is None:
+        body = iter([])
+    else:
+        body = iter_decompressed(chain([first], rest))
+    response = current_app.response_class(stream_with_context(body),
+                                          mimetype='text/plain')
+    if deflate:
+        response.headers['Content-Encoding'] = 'deflate'
+    response.headers['Vary'] = 'Accept-Encoding'
+    return response
+
+def snippet_fragment(snippet_id, record, options, lines=None):
+    """
+    Returns the rendered content block for a snippet from its
+    snippet_record, or None if `lines` starts past its end.
+    The rendered HTML comes from the cached record, so only the
+    small snippet_body template is rendered per view. Bodies over
+    STREAM_THRESHOLD are left out and streamed by snippet_page.
+
+    Snippets viewed with formatter options, or not yet rendered when
+    RENDER_MODE is 'lazy', are highlighted on demand by render_on_demand.
+    Chunked snippets, and any viewed with ?lines=, are shown a page of
+    lines at a time by lines_fragment.
+    """
+    fragment = {
+        'title': record['title'],
+        'state': record['render_state'],
+        'blob_id': record['blob_id'],
+        'archived': record['archived'],
+        'body': None
+    }
+    if lines or record['render_state'] == RENDER_CHUNKED:
+        return lines_fragment(fragment, snippet_id, record['snippet_lang'],
+                              options, lines)
+    if options or (record['render_state'] != RENDER_DONE and
+                   lazy_rendering()):
+        formatted = render_on_demand(snippet_id, record['snippet_lang'],
+                                     options, record['archived'])
+        fragment['state'] = RENDER_DONE
+        fragment['body'] = render_template('snippet_body.html',
+                                           snippet_id=snippet_id,
+                                           title=record['title'],
+                                           rendered=True,
+                                           formatted=[formatted])
+        return fragment
+    threshold = current_app.config.get('STREAM_THRESHOLD', STREAM_THRESHOLD)
+    if (record['size'] or 0) > threshold:
+        return fragment
+    if record['formatted'] is not None:
+        fragment['body'] = render_template('snippet_body.html',
+                                           snippet_id=snippet_id,
+                                           title=record['title'],
+                                           rendered=True,
+                                           formatted=[record['formatted']])
+        return fragment
+    column, criterion = snippet_source(snippet_id, record['archived'])
+    snippet_raw = db_session.query(column).filter(criterion).scalar()
+    fragment['body'] = render_template('snippet_body.html',
+                                       snippet_id=snippet_id,
+                                       title=record['title'],
+                                       rendered=False,
+                                       raw=[snippet_raw])
+    return fragment
+
+def fragment_state(record, options, lines=None):
+    """
+    The render state snippet_fragment will report for a snippet, and the
+    page of lines it will show if it shows one, without rendering it.
+    """
+    state = record['render_state']
+    if lines or state == RENDER_CHUNKED:
+        if state != RENDER_CHUNKED:
+            state = RENDER_DONE
+        return state, page_lines(lines)
+    if options or (state != RENDER_DONE and lazy_rendering()):
+        return RENDER_DONE, None
+    return state, None
+
+def snippet_record(snippet_id):
+    """
+    What snippet_fragment needs to know about a snippet: the columns from
+    snippet_info plus, when it has been rendered and is small enough to
+    show inline, the rendered HTML. Once rendering has finished none of
+    it changes, so records are kept in the in-process snippet_cache,
+    bounded by bytes since the HTML ranges from a line to STREAM_THRESHOLD.
+    """
+    key = 'snippet/%d' % snippet_id
+    record = snippet_cache.get(key)
+    if record is not None:
+        metrics.incr('snippet_cache_hits')
+        return record
+    metrics.incr('snippet_cache_misses')
+    info = snippet_info(db_session, snippet_id)
+    if not info:
+        return None
+    record = dict(zip(info.keys(), info))
+    record['archived'] = bool(info.archived)
+    record['formatted'] = None
+    threshold = current_app.config.get('STREAM_THRESHOLD', STREAM_THRESHOLD)
+    if info.render_state == RENDER_DONE and (info.size or 0) <= threshold:
+        record['formatted'] = db_session.query(SnippetBlob.formatted) \
+            .filter(SnippetBlob.id == info.blob_id).scalar()
+    if info.render_state in (RENDER_DONE, RENDER_CHUNKED):
+        snippet_cache.set(key, record)
+    return record
+
+def iter_source(snippet_id, archived, chunk_size):
+    """
+    Reads a snippet's stored source with iter_stored. A record from
+    snippet_cache can still call the snippet live after the reaper has
+    moved it to archived_snippets; when the live row is gone the record
+    is dropped from the cache and the archived copy is read instead.
+    """
+    column, criterion = snippet_source(snippet_id, archived)
+    found = False
+    for chunk in iter_stored(db_session, column, criterion, chunk_size):
+        found = True
+        yield chunk
+    if found or archived:
+        return
+    snippet_cache.delete('snippet/%d' % snippet_id)
+    column, criterion = snippet_source(snippet_id, True)
+    for chunk in iter_stored(db_session, column, criterion, chunk_size):
+        yield chunk
+
+def snippet_page(snippet_id, fragment):
+    if fragment['body'] is not None:
+        return make_response(render_template('view_snippet.html',
+                                             title=fragment['title'],
+                                             body=fragment['body']))
+    # Large snippets are streamed: the layout goes out first and the body
+    # follows in chunks read straight from the database.
+    chunk_size = current_app.config.get('STREAM_CHUNK_SIZE', STREAM_CHUNK_SIZE)
+    formatted = iter_text(db_session, SnippetBlob.formatted,
+                          SnippetBlob.id == fragment['blob_id'], chunk_size)
+    raw = iter_decompressed(iter_source(snippet_id, fragment['archived'],
+                                        chunk_size))
+    page = stream_template('view_snippet.html',
+                           snippet_id=snippet_id,
+                           title=fragment['title'],
+                           rendered=fragment['state'] == RENDER_DONE,
+                           formatted=formatted,
+                           raw=raw)
+    return current_app.response_class(stream_with_context(page))
+
+def render_on_demand(snippet_id, snippet_lang, options, archived=False):
+    """
+    Highlights a snippet at view time, keeping the result in the bounded
+    render cache keyed by the snippet and the formatter options.
+    """
+    key = 'render/%d/%s' % (snippet_id, options_key(options))
+    formatted = render_cache.get(key)
+    if formatted is not None:
+        metrics.incr('on_demand_render_hits')
+        return formatted
+    metrics.incr('on_demand_render_misses')
+    chunk_size = current_app.config.get('STREAM_CHUNK_SIZE', STREAM_CHUNK_SIZE)
+    snippet_raw = u''.join(iter_decompressed(iter_source(snippet_id, archived,
+                                                         chunk_size)))
+    formatted, elapsed = highlight(snippet_raw, snippet_lang, options)
+    metrics.observe('render_seconds', elapsed, lexer=snippet_lang)
+    render_cache.set(key, formatted)
+    return formatted
+
+def highlight(snippet_raw, snippet_lang, options):
+    """
+    render() for a view, run through the app's 'highlight_runner'
+    extension when it has one; the gevent app uses that to keep the
+    highlight off its event loop (see pasteapp.green).
+    """
+    runner = current_app.extensions.get('highlight_runner')
+    if runner is None:
+        return render(snippet_raw, snippet_lang, options)
+    return runner(render, (snippet_raw, snippet_lang, options))
+
+def parse_line_range(value):
+    """
+    '1-2000' -> (1, 2000); a single number is the range starting there.
+    Anything else is ignored.
+    """
+    if not value:
+        return None
+    first, sep, last = value.partition('-')
+    try:
+        first = int(first)
+        last = int(last) if last else None
+    except ValueError:
+        return None
+    if first < 1 or (last is not None and last < first):
+        return None
+    return first, last
+
+def read_lines(chunks, first, count):
+    """
+    Returns up to `count` lines starting at line `first` (1-based) of the
+    text arriving in `chunks`, and whether there is anything after them.
+    Stops reading once it has them, so only the text up to the range is
+    ever decompressed.
+    """
+    lines = []
+    number = 1
+    tail = u''
+    for chunk in chunks:
+        parts = (tail + chunk).split(u'\n')
+        tail = parts.pop()
+        for line in parts:
+            if number >= first + count:
+                return u'\n'.join(lines) + u'\n', True
+            if number >= first:
+                lines.append(line)
+            number += 1
+    if tail:
+        if number >= first + count:
+            return u'\n'.join(lines) + u'\n', True
+        if number >= first:
+            lines.append(tail)
+    return u'\n'.join(lines) + (u'\n' if lines else u''), False
+
+def page_lines(lines):
+    """
+    The (first, last) lines lines_fragment shows for a ?lines= range:
+    from the first line by default, and at most SNIPPET_LINES_PER_PAGE.
+    """
+    per_page = current_app.config.get('SNIPPET_LINES_PER_PAGE',
+                                      LINES_PER_PAGE)
+    first, last = lines or (1, None)
+    if last is None or last - first + 1 > per_page:
+        last = first + per_page - 1
+    return first, last
+
+def lines_fragment(fragment, snippet_id, snippet_lang, options, lines):
+    """
+    Highlights one page of lines by itself, so memory and CPU per request
+    are bounded however large the snippet is. A construct spanning the
+    page boundary (a long string or comment) may be coloured differently
+    at the top of the next page.
+    """
+    first, last = page_lines(lines)
+    key = 'render/%d/%s/lines=%d-%d' % (snippet_id, options_key(options),
+                                        first, last)
+    page = render_cache.get(key)
+    if page is None:
+        chunk_size = current_app.config.get('STREAM_CHUNK_SIZE',
+                                            STREAM_CHUNK_SIZE)
+        chunks = iter_source(snippet_id, fragment['archived'], chunk_size)
+        text, more = read_lines(iter_decompressed(chunks),
+                                first, last - first + 1)
+        if not text and first > 1:
+            return None
+        page_options = dict(options, linenostart=first)
+        formatted, elapsed = highlight(text, snippet_lang, page_options)
+        metrics.observe('render_seconds', elapsed, lexer=snippet_lang)
+        page = (formatted, more)
+        render_cache.set(key, page)
+    formatted, more = page
+    size = last - first + 1
+    pager = {'first': first, 'last': last, 'prev': None, 'next': None}
+    if first > 1:
+        pager['prev'] = '%d-%d' % (max(first - size, 1), first - 1)
+    if more:
+        pager['next'] = '%d-%d' % (last + 1, last + size)
+    if fragment['state'] != RENDER_CHUNKED:
+        fragment['state'] = RENDER_DONE
+    fragment['body'] = render_template('snippet_body.html',
+                                       snippet_id=snippet_id,
+                                       title=fragment['title'],
+                                       rendered=True,
+                                       formatted=[formatted],
+                                       pager=pager)
+    return fragment
+
+def lazy_rendering():
+    return current_app.config.get('RENDER_MODE', 'eager') == 'lazy'
+
+def stream_template(template_name, **context):
+    app = current_app
+    app.update_template_context(context)
+    template = app.jinja_env.get_template(template_name)
+    stream = template.stream(context)
+    stream.enable_buffering(5)
+    return stream
+
+def is_shareable_page():
+    """
+    The layout changes with the login state and any flashed messages, so
+    only pages rendered without either can be served to everyone.
+    """
+    return 'user_id' not in session and '_flashes' not in session
+
+def too_busy(template, form, retry_after):
+    return (render_template(template, form=form, err=BUSY_MESSAGE), 429,
+            {'Retry-After': str(retry_after)})
+
+def upgrade_password_hash(user, plaintext):
+    """
+    Rehashes the password after a successful login if it was hashed with a
+    different cost factor than BCRYPT_ROUNDS. If the pool is busy it is
+    left for the next login.
+    """
+    if hash_rounds(user.password) == hash_pool.rounds:
+        return
+    try:
+        user.password = hash_pool.run(hash_password, plaintext,
+                                      hash_pool.rounds)
+    except HashPoolSaturated:
+        return
+    db_session.commit()
 
 def username_taken(username):
     return User.query.filter(User.username == username).first()
@@ -1,7 +1,50 @@
 from os.path import abspath
+import os
+import shutil
+import tempfile
 import unittest
+from nose.plugins.skip import SkipTest
+import zlib
+import gzip
+import json
+import sys
+import time
+import threading
+import multiprocessing
 from pasteapp import create_app
-from pasteapp.database import db_session, init_db, clear_db, User
+from pasteapp import database
+from pasteapp.database import (
+    db_session, init_db, clear_db, User, Snippet, SnippetBlob, RENDER_DONE,
+    RENDER_CHUNKED, recount_snippets, compress_legacy_rows, Base,
+    TimedQueuePool, instrument_pool, create_api_token
+)
+from sqlalchemy import create_engine
+from sqlalchemy.exc import OperationalError
+from pasteapp.metrics import metrics
+from pasteapp.render_queue import render_queue
+from pasteapp.bulk import export_snippets, Importer, bounded_imap
+from multiprocessing import Pool
+from StringIO import StringIO
+import datetime
+from pasteapp.cache import (
+    cache, render_cache, snippet_cache, LRUCache, SizedLRUCache
+)
+from pasteapp.counters import view_counter
+from pasteapp.feed import recent_feed
+from pasteapp.auth import (
+    hash_pool, hash_password, hash_rounds, ip_throttle, username_throttle,
+    AttemptThrottle
+)
+from pasteapp import search
+from pasteapp import similarity
+from pasteapp import highlighting
+from pasteapp.highlighting import render
+from pasteapp.green import serve_green
+from pasteapp import archive
+from pasteapp.assets import asset_manifest, build_assets
+from pasteapp.limits import (
+    rate_limiter, admission, LocalBucketBackend, ForwardedFor
+)
 
 class TestCase(unittest.TestCase):
 
@@ -13,6 +56,11 @@ class TestCase(unittest.TestCase):
         self.client = self.app.test_client()
         self.ctx = self.app.test_request_context()
         self.ctx.push()
+        cache.clear()
+        render_cache.clear()
+        snippet_cache.clear()
+        view_counter.clear()
+        recent_feed.clear()
         init_db()
         user = User('test_user', 'test_user@example.com', 'password')
         db_session.add(user)
@@ -28,6 +76,954 @@ class HomePageTest(TestCase):
         rv = self.client.get('/')
         assert 'Simple Code Sharing' in rv.data
 
+    def test_home_page_lists_snippets(self):
+        snippet = Snippet('Listed snippet', 'text', 1, 'x' * 1000)
+        db_session.add(snippet)
+        db_session.commit()
+        created = snippet.created_date.strftime('%Y-%m-%d')
+        rv = self.client.get('/')
+        assert 'Listed snippet' in rv.data
+        assert created in rv.data
+        assert 'x' * 1000 not in rv.data
+
+    def test_home_page_cached(self):
+        """
+        This test checks that the home page is served from the cache for
+        anonymous visitors and refreshed once a snippet is created.
+        """
+        self.client.get('/')
+        db_session.add(Snippet('Not yet listed', 'text', 1, 'text'))
+        db_session.commit()
+        # Added behind the feed's back, as a bulk import does.
+        recent_feed.clear()
+        rv = self.client.get('/')
+        assert 'Not yet listed' not in rv.data
+        self.client.post('/login', data={'username': 'test_user',
+                                         'password': 'password'})
+        self.client.post('/snippet/new', data={'title': 'Invalidates',
+                                               'language': 'text',
+                                               'raw_content': 'text'})
+        self.client.get('/logout')
+        rv = self.client.get('/')
+        assert 'Not yet listed' in rv.data
+        assert 'Invalidates' in rv.data
+
+class ViewCountTestCase(TestCase):
+
+    def setUp(self):
+        super(ViewCountTestCase, self).setUp()
+        snippets = [Snippet('Popular', 'text', 1, 'popular'),
+                    Snippet('Unpopular', 'text', 1, 'unpopular')]
+        db_session.add_all(snippets)
+        db_session.commit()
+        for snippet in snippets:
+            render_queue.submit(snippet)
+
+    def test_views_flushed_in_batches(self):
+        for i in range(3):
+            self.client.get('/snippet/view/1')
+        self.client.get('/snippet/view/2')
+        self.client.get('/snippet/view/42')
+        assert view_counter.pending == {1: 3, 2: 1}
+        assert db_session.query(Snippet.view_count).order_by(Snippet.id) \
+                         .all() == [(0,), (0,)]
+        assert view_counter.flush() == 2
+        assert view_counter.pending == {}
+        db_session.expire_all()
+        assert db_session.query(Snippet.view_count).order_by(Snippet.id) \
+                         .all() == [(3,), (1,)]
+
+    def test_most_viewed_listed(self):
+        self.client.get('/snippet/view/1')
+        view_counter.flush()
+        rv = self.client.get('/')
+        assert 'Most Viewed Snippets' in rv.data
+        assert 'Viewed 1 times' in rv.data
+        assert rv.data.count('Unpopular') == 1
+
+    def test_rendered_snippet_record_cached(self):
+        """
+        This test checks that a rendered snippet's record is kept in the
+        snippet cache, so later views skip the database even when the page
+        cache has lost the fragment.
+        """
+        misses = metrics.counter('snippet_cache_misses')
+        self.client.get('/snippet/view/1')
+        assert snippet_cache.get('snippet/1')['title'] == 'Popular'
+        cache.clear()
+        rv = self.client.get('/snippet/view/1')
+        assert 'popular' in rv.data
+        assert metrics.counter('snippet_cache_misses') == misses + 1
+
+class ApiTestCase(TestCase):
+
+    def setUp(self):
+        super(ApiTestCase, self).setUp()
+        self.token = create_api_token(db_session, 1)
+        db_session.commit()
+
+    def post(self, snippets, token=None):
+        return self.client.post('/api/v1/snippets',
+                                data=json.dumps({'snippets': snippets}),
+                                content_type='application/json',
+                                headers=self.auth(token))
+
+    def auth(self, token=None):
+        return {'Authorization': 'Token %s' % (token or self.token)}
+
+    def test_token_required(self):
+        rv = self.client.get('/api/v1/snippets/1')
+        assert rv.status_code == 401
+        assert rv.headers['WWW-Authenticate'] == 'Token'
+        rv = self.client.get('/api/v1/snippets/1', headers=self.auth('bad'))
+        assert rv.status_code == 401
+
+    def test_batch_create(self):
+        rv = self.post([
+            {'title': 'One', 'language': 'python', 'raw': "print 'one'"},
+            {'title': 'Two', 'language': 'ruby', 'raw': "puts 'two'"},
+            {'title': 'Again', 'language': 'python', 'raw': "print 'one'"}
+        ])
+        assert rv.status_code == 201
+        ids = [snippet['id'] for snippet in json.loads(rv.data)['snippets']]
+        assert ids == [1, 2, 3]
+        assert Snippet.query.filter(Snippet.render_state == RENDER_DONE) \
+                            .count() == 3
+        assert SnippetBlob.query.count() == 2
+        assert User.query.get(1).snippet_count == 3
+        assert [row.id for row in search.search(db_session, 'two')] == [2]
+
+    def test_batch_create_too_large(self):
+        self.app.config['MAX_CONTENT_LENGTH'] = 100
+        rv = self.post([{'title': 'Huge', 'language': 'text',
+                         'raw': 'x' * 200}])
+        assert rv.status_code == 413
+        assert json.loads(rv.data)['error'] == \
+            'Requests can be at most 100 bytes.'
+
+    def test_batch_create_near_duplicates(self):
+        source = u''.join(u'def scale_%d(value):\n    return value * %d\n'
+                          % (i, i) for i in range(30))
+        assert self.post([{'title': 'Original', 'language': 'python',
+                           'raw': source}]).status_code == 201
+        copy = {'title': 'Copy', 'language': 'python', 'raw': source}
+        fresh = {'title': 'Fresh', 'language': 'python', 'raw': 'x = 1'}
+        self.app.config['NEAR_DUPLICATES'] = 'reject'
+        try:
+            rv = self.post([fresh, copy])
+            assert rv.status_code == 400
+            assert json.loads(rv.data)['errors'].keys() == ['1']
+            self.app.config['NEAR_DUPLICATES'] = 'redirect'
+            rv = self.post([fresh, copy])
+            assert rv.status_code == 201
+            results = json.loads(rv.data)['snippets']
+            assert [result['id'] for result in results] == [2, 1]
+            assert results[1]['duplicate']
+            self.app.config['NEAR_DUPLICATES'] = 'allow'
+            rv = self.post([copy])
+            assert json.loads(rv.data)['snippets'][0]['id'] == 3
+        finally:
+            self.app.config.pop('NEAR_DUPLICATES')
+        original, copied = Snippet.query.get(1), Snippet.query.get(3)
+        assert copied.duplicate_of == 1
+        assert copied.blob_id == original.blob_id
+        assert copied.is_rendered
+        assert Snippet.query.count() == 3
+
+    def test_batch_create_all_or_nothing(self):
+        rv = self.post([
+            {'title': 'Fine', 'language': 'python', 'raw': 'x = 1'},
+            {'title': '', 'language': 'no-such-language', 'raw': 'x = 2'}
+        ])
+        assert rv.status_code == 400
+        errors = json.loads(rv.data)['errors']
+        assert sorted(errors['1']) == ['language', 'title']
+        assert Snippet.query.count() == 0
+
+    def test_batch_fetch(self):
+        self.post([{'title': 'One', 'language': 'python', 'raw': 'x = 1'},
+                   {'title': 'Two', 'language': 'python', 'raw': 'x = 2'}])
+        rv = self.client.get('/api/v1/snippets?ids=2,42,1,2',
+                             headers=self.auth())
+        data = json.loads(rv.data)
+        assert [snippet['id'] for snippet in data['snippets']] == [2, 1]
+        assert data['missing'] == [42]
+        assert data['snippets'][1]['raw'] == 'x = 1'
+        assert 'class="source"' in data['snippets'][1]['html']
+        headers = dict(self.auth(), **{'If-None-Match': rv.headers['ETag']})
+        rv = self.client.get('/api/v1/snippets?ids=2,42,1,2', headers=headers)
+        assert rv.status_code == 304
+        rv = self.client.get('/api/v1/snippets/42', headers=self.auth())
+        assert rv.status_code == 404
+
+class FeedTestCase(TestCase):
+
+    def setUp(self):
+        super(FeedTestCase, self).setUp()
+        self.client.post('/login', data={'username': 'test_user',
+                                         'password': 'password'})
+
+    def create_snippet(self, title, language):
+        self.client.post('/snippet/new', data={
+            'title': title, 'language': language, 'raw_content': title
+        })
+
+    def test_feed_kept_up_to_date(self):
+        self.create_snippet('Before', 'python')
+        misses = metrics.counter('feed_misses')
+        hits = metrics.counter('feed_hits')
+        assert [record['title'] for record in
+                recent_feed.recent(db_session)] == ['Before']
+        self.create_snippet('After', 'ruby')
+        assert [record['title'] for record in
+                recent_feed.recent(db_session)] == ['After', 'Before']
+        assert [record['title'] for record in
+                recent_feed.recent(db_session, 'ruby')] == ['After']
+        assert metrics.counter('feed_misses') == misses + 2
+        assert metrics.counter('feed_hits') == hits + 1
+
+    def test_json_feed(self):
+        self.create_snippet('First', 'python')
+        self.create_snippet('Second', 'ruby')
+        rv = self.client.get('/feed.json')
+        titles = [record['title'] for record in
+                  json.loads(rv.data)['snippets']]
+        assert titles == ['Second', 'First']
+        rv = self.client.get('/feed.json',
+                             headers={'If-None-Match': rv.headers['ETag']})
+        assert rv.status_code == 304
+        rv = self.client.get('/feed.json?language=python')
+        assert [record['url'] for record in json.loads(rv.data)['snippets']] \
+            == ['http://localhost/snippet/view/1']
+        rv = self.client.get('/feed.json?language=cobol')
+        assert rv.status_code == 404
+
+    def test_atom_feed(self):
+        self.create_snippet('Atom entry', 'python')
+        rv = self.client.get('/feed.atom')
+        assert rv.mimetype == 'application/atom+xml'
+        assert '<title type="text">Atom entry</title>' in rv.data
+        assert 'http://localhost/snippet/view/1' in rv.data
+
+class LimitsTestCase(TestCase):
+
+    def setUp(self):
+        super(LimitsTestCase, self).setUp()
+        db_session.add(Snippet('Limited', 'text', 1, 'limited'))
+        db_session.commit()
+
+    def tearDown(self):
+        rate_limiter.configure()
+        admission.configure()
+        super(LimitsTestCase, self).tearDown()
+
+    def test_token_bucket(self):
+        backend = LocalBucketBackend(max_keys=2)
+        a = [('a', 0.5, 2)]
+        assert backend.take(a, now=0) == (0, None)
+        assert backend.take(a, now=0) == (0, None)
+        assert backend.take(a, now=0) == (2.0, 0)
+        assert backend.take(a, now=1) == (1.0, 0)
+        assert backend.take(a, now=2) == (0, None)
+        backend.take([('b', 0.5, 2)], now=2)
+        backend.take([('c', 0.5, 2)], now=2)
+        assert backend.take(a, now=2) == (0, None)
+
+    def test_refused_request_takes_no_tokens(self):
+        backend = LocalBucketBackend()
+        assert backend.take([('user', 1, 1)], now=0) == (0, None)
+        # The empty user bucket refuses, so the global one keeps its token.
+        both = [('global', 1, 1), ('user', 1, 1)]
+        assert backend.take(both, now=0) == (1.0, 1)
+        assert backend.take([('global', 1, 1)], now=0) == (0, None)
+
+    def test_reads_rate_limited(self):
+        rate_limiter.configure(limits={'read': {'ip': (1, 2)}})
+        assert self.client.get('/snippet/view/1').status_code == 200
+        assert self.client.get('/snippet/raw/1').status_code == 200
+        rv = self.client.get('/snippet/view/1')
+        assert rv.status_code == 429
+        assert rv.headers['Retry-After'] == '1'
+        # Other addresses and unlimited pages are unaffected.
+        rv = self.client.get('/snippet/view/1',
+                             environ_base={'REMOTE_ADDR': '10.0.0.2'})
+        assert rv.status_code == 200
+        assert self.client.get('/').status_code == 200
+
+    def test_forwarded_for(self):
+        rate_limiter.configure(limits={'read': {'ip': (0.01, 1)}})
+        self.app.wsgi_app = ForwardedFor(self.app.wsgi_app, proxies=1)
+        def view(forwarded_for):
+            return self.client.get('/snippet/view/1', headers={
+                'X-Forwarded-For': forwarded_for}).status_code
+        assert view('10.0.0.1') == 200
+        assert view('10.0.0.2') == 200
+        assert view('10.0.0.1') == 429
+        # A client can't get a fresh address by sending its own header.
+        assert view('10.0.0.9, 10.0.0.1') == 429
+
+    def test_creates_limited_per_user(self):
+        rate_limiter.configure(limits={'create': {'user': (0.01, 1)}})
+        self.client.post('/login', data={'username': 'test_user',
+                                         'password': 'password'})
+        assert self.client.get('/snippet/new').status_code == 200
+        data = {'title': 'Once', 'language': 'text', 'raw_content': 'once'}
+        assert self.client.post('/snippet/new',
+                                data=data).status_code == 302
+        rv = self.client.post('/snippet/new', data=data)
+        assert rv.status_code == 429
+        assert int(rv.headers['Retry-After']) > 90
+        assert Snippet.query.count() == 2
+
+    def test_overload_shed(self):
+        admission.configure(max_in_flight=1, retry_after=2)
+        assert admission.acquire()
+        try:
+            rv = self.client.get('/snippet/view/1')
+            assert rv.status_code == 503
+            assert rv.headers['Retry-After'] == '2'
+            assert self.client.get('/').status_code == 200
+        finally:
+            admission.release()
+        assert self.client.get('/snippet/view/1').status_code == 200
+        assert admission.in_flight == 0
+
+class InstrumentationTestCase(TestCase):
+
+    def test_server_timing(self):
+        rv = self.client.get('/')
+        timing = rv.headers['Server-Timing']
+        assert 'sql;dur=' in timing
+        assert 'template;dur=' in timing
+        assert 'total;dur=' in timing
+
+    def test_metrics_endpoint(self):
+        self.client.get('/about')
+        rv = self.client.get('/metrics')
+        assert rv.headers['Content-Type'].startswith('text/plain')
+        assert '# TYPE request_seconds histogram' in rv.data
+        assert 'request_seconds_bucket{endpoint="frontend.about",le="+Inf"}' \
+            in rv.data
+
+    def test_slow_request_profiled(self):
+        directory = tempfile.mkdtemp()
+        self.app.config.update(PROFILE_DIR=directory, PROFILE_SAMPLE_RATE=1,
+                               PROFILE_SLOW_SECONDS=0)
+        try:
+            self.client.get('/about')
+            dumps = os.listdir(directory)
+            assert len(dumps) == 1
+            assert 'frontend.about' in dumps[0]
+        finally:
+            self.app.config.pop('PROFILE_DIR')
+            shutil.rmtree(directory)
+
+class HighlightingTestCase(unittest.TestCase):
+
+    def test_registry_reuses_lexers(self):
+        highlighting.preload()
+        lexer = highlighting.get_lexer('python')
+        assert highlighting.get_lexer('Python') is lexer
+        assert highlighting.lexer_name('python') == lexer.name
+        assert highlighting.lexer_name('no-such-language') == 'Text only'
+        assert highlighting.get_formatter(None) is \
+            highlighting.get_formatter({})
+
+    def test_guess_text_lexer(self):
+        script = u'#!/usr/bin/env python\nprint 1\n'
+        assert highlighting.resolve_lexer(script, 'text').name == 'Text only'
+        highlighting.configure(guess=True)
+        try:
+            assert highlighting.resolve_lexer(script, 'text') is \
+                highlighting.get_lexer('python')
+            assert highlighting.resolve_lexer(u'plain words', 'text') is \
+                highlighting.get_lexer('text')
+            assert highlighting.resolve_lexer(script, 'ruby') is \
+                highlighting.get_lexer('ruby')
+            assert highlighting.render_digest(script, 'text') == \
+                highlighting.render_digest(script, 'python')
+        finally:
+            highlighting.configure()
+
+class AssetsTestCase(TestCase):
+
+    def setUp(self):
+        super(AssetsTestCase, self).setUp()
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        asset_manifest.configure(None)
+        shutil.rmtree(self.directory)
+        super(AssetsTestCase, self).tearDown()
+
+    def test_unbuilt_assets(self):
+        rv = self.client.get('/')
+        assert '/assets/style.css' in rv.data
+        rv = self.client.get('/assets/pygments.css')
+        assert '.source .k' in rv.data
+        assert rv.headers['Cache-Control'] == 'no-cache'
+
+    def test_built_assets(self):
+        """
+        This test checks that built assets are linked by their hashed
+        names and served precompressed with immutable cache headers.
+        """
+        manifest = build_assets(self.app.static_folder, self.directory)
+        asset_manifest.configure(self.directory)
+        rv = self.client.get('/')
+        url = '/assets/%s' % manifest['style.css']
+        assert url in rv.data
+        assert '/assets/%s' % manifest['pygments.css'] in rv.data
+        rv = self.client.get(url, headers={'Accept-Encoding': 'gzip'})
+        assert rv.headers['Content-Encoding'] == 'gzip'
+        assert 'immutable' in rv.headers['Cache-Control']
+        body = gzip.GzipFile(fileobj=StringIO(rv.data)).read()
+        assert body == open(os.path.join(self.app.static_folder,
+                                         'style.css')).read()
+        rv = self.client.get(url)
+        assert 'Content-Encoding' not in rv.headers
+        assert self.client.get('/assets/manifest.json').status_code == 404
+
+class CacheTestCase(unittest.TestCase):
+
+    def test_lru_eviction(self):
+        lru = LRUCache(threshold=2)
+        lru.set('a', 1)
+        lru.set('b', 2)
+        lru.get('a')
+        lru.set('c', 3)
+        assert lru.get('a') == 1
+        assert lru.get('b') is None
+        assert lru.get('c') == 3
+
+    def test_lru_expiry(self):
+        lru = LRUCache()
+        lru.set('a', 1, timeout=-1)
+        assert lru.get('a') is None
+
+    def test_sized_lru_eviction(self):
+        lru = SizedLRUCache(max_bytes=100, sizeof=len)
+        lru.set('a', 'x' * 40)
+        lru.set('b', 'x' * 40)
+        lru.get('a')
+        lru.set('c', 'x' * 40)
+        assert lru.get('a') is not None
+        assert lru.get('b') is None
+        assert lru.size == 80
+        lru.set('d', 'x' * 101)
+        assert lru.get('d') is None
+        assert lru.size == 80
+
+class CompressedStorageTestCase(TestCase):
+
+    def test_round_trip(self):
+        source = u'print "caf\xe9"\n' * 100
+        db_session.add(Snippet('Unicode', 'python', 1, source))
+        db_session.commit()
+        db_session.remove()
+        stored = db_session.execute('SELECT snippet_raw FROM snippets').scalar()
+        assert len(stored) < len(source)
+        assert Snippet.query.get(1).snippet_raw == source
+
+    def test_compress_legacy_rows(self):
+        """
+        This test checks that rows written before compression can still be
+        read and are compressed by the migration.
+        """
+        db_session.execute("INSERT INTO snippets (id, title, snippet_lang, "
+                           "snippet_raw) VALUES (1, 'Old', 'text', "
+                           "'legacy text')")
+        db_session.commit()
+        assert Snippet.query.get(1).snippet_raw == 'legacy text'
+        db_session.remove()
+        table = Snippet.__table__
+        assert compress_legacy_rows(db_session, table, 'snippet_raw',
+                                    'raw_size', batch_size=1) == 1
+        assert compress_legacy_rows(db_session, table, 'snippet_raw',
+                                    'raw_size') == 0
+        snippet = Snippet.query.get(1)
+        assert snippet.snippet_raw == 'legacy text'
+        assert snippet.raw_size == len('legacy text')
+
+class BulkTestCase(TestCase):
+
+    def test_export_import_round_trip(self):
+        """
+        This test checks that exported snippets can be imported again with
+        their renders shared and the author's count updated.
+        """
+        db_session.add(Snippet('One', 'python', 1, "print 'one'"))
+        db_session.add(Snippet('Two', 'ruby', 1, "puts 'two'"))
+        db_session.commit()
+        out = StringIO()
+        assert export_snippets(db_session, out, batch_size=1) == 2
+        lines = out.getvalue().splitlines() * 2
+        importer = Importer(db_session, batch_size=3, commit_every=1)
+        assert importer.run(lines) == 4
+        assert Snippet.query.count() == 6
+        assert SnippetBlob.query.count() == 2
+        assert User.query.get(1).snippet_count == 6
+        imported = Snippet.query.order_by(Snippet.id.desc()).first()
+        assert imported.title == 'Two'
+        assert imported.is_rendered
+        assert 'puts' in imported.snippet_formatted
+
+    def test_import_unknown_author(self):
+        line = '{"title": "T", "language": "text", "author": "nobody", ' \
+               '"raw": "text"}'
+        importer = Importer(db_session)
+        assert importer.run([line]) == 0
+        assert importer.skipped == 1
+        importer = Importer(db_session, default_author='test_user')
+        assert importer.run([line]) == 1
+        assert len(search.search(db_session, 'text')) == 1
+
+    def test_import_indexes_new_ids(self):
+        snippet = Snippet('Existing', 'text', 1, 'existing')
+        snippet.id = 7
+        db_session.add(snippet)
+        db_session.commit()
+        lines = [json.dumps({'title': word, 'language': 'text',
+                             'author': 'test_user', 'raw': word * 3})
+                 for word in ('alpha', 'beta', 'gamma')]
+        importer = Importer(db_session, batch_size=3, render=False)
+        assert importer.run(lines) == 3
+        for word in ('alpha', 'beta', 'gamma'):
+            ids = [row.id for row in search.search(db_session, word * 3)]
+            assert [Snippet.query.get(i).title for i in ids] == [word]
+        assert set(row.snippet_id for row in
+                   db_session.query(similarity.SnippetBand.snippet_id)) == \
+            set([8, 9, 10])
+
+    def test_bounded_imap(self):
+        read = []
+        def items():
+            for i in range(10):
+                read.append(i)
+                yield -i
+        pool = Pool(1)
+        try:
+            results = bounded_imap(pool, abs, items(), 2)
+            assert next(results) == 0
+            assert len(read) == 2
+            assert list(results) == range(1, 10)
+        finally:
+            pool.terminate()
+
+class SearchTestCase(TestCase):
+
+    def create_snippet(self, title, language, raw_content):
+        return self.client.post('/snippet/new', data={
+            'title': title,
+            'language': language,
+            'raw_content': raw_content
+        })
+
+    def setUp(self):
+        super(SearchTestCase, self).setUp()
+        self.client.post('/login', data={'username': 'test_user',
+                                         'password': 'password'})
+        self.create_snippet('Parse config', 'python',
+                            'def read_config(path):\n    return path\n')
+        self.create_snippet('Misc', 'ruby', 'def read_config; config = {}; end')
+        self.create_snippet('Unrelated', 'python', 'print 1')
+
+    def test_search_ranked(self):
+        """
+        This test checks that new snippets are searchable straight away and
+        that title matches rank first.
+        """
+        rv = self.client.get('/search?q=config')
+        assert 'Parse config' in rv.data
+        assert 'Misc' in rv.data
+        assert 'Unrelated' not in rv.data
+        assert rv.data.index('Parse config') < rv.data.index('Misc')
+        rv = self.client.get('/search?q=read_config+path')
+        assert 'Parse config' in rv.data
+        assert 'Misc' not in rv.data
+
+    def test_search_filters(self):
+        rv = self.client.get('/search?q=read_config&lang=ruby')
+        assert 'Misc' in rv.data
+        assert 'Parse config' not in rv.data
+        rv = self.client.get('/search?q=read_config&author=test_user')
+        assert 'Misc' in rv.data
+        rv = self.client.get('/search?q=read_config&author=nobody')
+        assert 'No snippets matched' in rv.data
+
+    def test_search_query_syntax_ignored(self):
+        rv = self.client.get('/search?q=config+OR+%22NEAR(')
+        assert rv.status_code == 200
+
+    def test_rebuild_index(self):
+        search.clear_index(db_session)
+        assert search.search(db_session, 'config') == []
+        assert search.rebuild_index(db_session, batch_size=2) == 3
+        assert len(search.search(db_session, 'config')) == 2
+
+    def test_fts_index_contentless(self):
+        assert search.search_backend(db_session) == search.BACKEND_FTS5
+        sql = db_session.execute(
+            "SELECT sql FROM sqlite_master WHERE name = 'snippets_fts'"
+        ).scalar()
+        assert "content=''" in sql
+        search.unindex_snippets(db_session, [1])
+        results = search.search(db_session, 'config')
+        assert [row.title for row in results] == ['Misc']
+        db_session.execute("INSERT INTO snippets_fts (snippets_fts) "
+                           "VALUES ('integrity-check')")
+
+    def test_term_index_fallback(self):
+        search._backends[db_session.get_bind()] = search.BACKEND_TERMS
+        assert search.rebuild_index(db_session) == 3
+        results = search.search(db_session, 'CONFIG')
+        assert [row.title for row in results] == ['Parse config', 'Misc']
+        assert len(search.search(db_session, 'config', lang='ruby')) == 1
+        assert search.search(db_session, 'config', author_id=2) == []
+
+class SimilarityTestCase(TestCase):
+
+    source = u''.join(u'def scale_%d(value):\n    return value * %d\n' % (i, i)
+                      for i in range(30))
+
+    def test_fingerprint_ignores_layout(self):
+        reindented = self.source.replace(u'    ', u'\t')
+        renamed = self.source.replace(u'value', u'number')
+        assert similarity.fingerprint(reindented) == \
+            similarity.fingerprint(self.source)
+        assert similarity.distance(similarity.fingerprint(renamed),
+                                   similarity.fingerprint(self.source)) > 3
+
+    def test_find_near_duplicate(self):
+        db_session.add_all([Snippet('Python', 'python', 1, self.source),
+                            Snippet('Text', 'text', 1, self.source)])
+        db_session.commit()
+        assert similarity.backfill_fingerprints(db_session, 1) == 2
+        assert similarity.backfill_fingerprints(db_session, 1) == 0
+        simhash = similarity.fingerprint(self.source + u'# done\n')
+        assert similarity.find_near_duplicate(db_session, simhash) == 1
+        assert similarity.find_near_duplicate(db_session, simhash,
+                                              'text') == 2
+        assert similarity.find_near_duplicate(db_session, simhash,
+                                              'ruby') is None
+        Snippet.query.get(1).expires_at = datetime.datetime.now()
+        db_session.commit()
+        assert similarity.find_near_duplicate(db_session, simhash,
+                                              'python') is None
+
+    def test_new_snippet_near_duplicates(self):
+        self.client.post('/login', data={'username': 'test_user',
+                                         'password': 'password'})
+        def create(title, source):
+            return self.client.post('/snippet/new', data={
+                'title': title, 'language': 'python', 'raw_content': source
+            }, follow_redirects=True)
+        create('Original', self.source)
+        self.app.config['NEAR_DUPLICATES'] = 'allow'
+        try:
+            create('Allowed', self.source + u'# again\n')
+            assert Snippet.query.get(2).duplicate_of == 1
+            self.app.config['NEAR_DUPLICATES'] = 'reject'
+            rv = create('Rejected', self.source.replace(u'    ', u'  '))
+            assert 'nearly identical to snippet 1' in rv.data
+            self.app.config['NEAR_DUPLICATES'] = 'redirect'
+            rv = create('Redirected', self.source)
+            assert 'An almost identical snippet already exists.' in rv.data
+            assert 'Original' in rv.data
+        finally:
+            self.app.config.pop('NEAR_DUPLICATES')
+        assert Snippet.query.count() == 2
+
+class ArchiveTestCase(TestCase):
+
+    def setUp(self):
+        super(ArchiveTestCase, self).setUp()
+        self.client.post('/login', data={'username': 'test_user',
+                                         'password': 'password'})
+        for title, expires in (('Kept snippet', ''),
+                               ('Expiring snippet', '3600')):
+            self.client.post('/snippet/new', data={
+                'title': title, 'language': 'python', 'expires': expires,
+                'raw_content': 'def reaped():\n    return 1\n'})
+
+    def test_expired_snippets_reaped(self):
+        snippet = Snippet.query.get(2)
+        assert snippet.expires_at > snippet.created_date
+        assert self.client.get('/snippet/view/2').status_code == 200
+        db_session.query(Snippet).filter(Snippet.id == 2).update({
+            'expires_at': datetime.datetime.now()})
+        db_session.commit()
+        # The cached copies still have the original expiry time.
+        snippet_cache.clear()
+        cache.clear()
+        assert self.client.get('/snippet/view/2').status_code == 404
+        assert self.client.get('/snippet/raw/2').status_code == 404
+        assert archive.reap(db_session, batch_size=1, pause=0) == (1, 0)
+        assert [s.id for s in Snippet.query] == [1]
+        assert [row.id for row in search.search(db_session, 'reaped')] == [1]
+        assert db_session.query(similarity.SnippetBand.snippet_id) \
+                         .distinct().all() == [(1,)]
+        assert User.query.get(1).snippet_count == 1
+
+    def test_expired_snippets_unlisted(self):
+        """
+        This test checks that an expired snippet the reaper hasn't deleted
+        yet drops out of the home page, feeds, search and dashboard, even
+        from feed lists loaded while it was live.
+        """
+        expires_at = datetime.datetime.now() + datetime.timedelta(seconds=1)
+        db_session.query(Snippet).filter(Snippet.id == 2).update({
+            'expires_at': expires_at})
+        db_session.commit()
+        recent_feed.clear()
+        assert 'Expiring snippet' in self.client.get('/feed.json').data
+        time.sleep(max((expires_at - datetime.datetime.now())
+                       .total_seconds(), 0) + 0.01)
+        cache.clear()
+        for path in ('/', '/feed.json', '/feed.atom', '/dashboard'):
+            rv = self.client.get(path)
+            assert 'Kept snippet' in rv.data
+            assert 'Expiring snippet' not in rv.data
+        assert [row.id for row in search.search(db_session, 'reaped')] == [1]
+        search._backends[db_session.get_bind()] = search.BACKEND_TERMS
+        search.rebuild_index(db_session)
+        assert [row.id for row in search.search(db_session, 'reaped')] == [1]
+
+    def test_cold_snippets_archived(self):
+        db_session.query(Snippet).update({
+            'created_date': datetime.datetime(2000, 1, 1)})
+        Snippet.query.get(1).view_count = 5
+        db_session.commit()
+        assert archive.reap(db_session, pause=0, archive_after_days=30,
+                            max_views=0) == (0, 1)
+        assert [s.id for s in Snippet.query] == [1]
+        snippet_cache.clear()
+        cache.clear()
+        rv = self.client.get('/snippet/view/2')
+        assert 'Expiring snippet' in rv.data
+        assert 'reaped' in rv.data
+        assert 'reaped' in self.client.get('/snippet/raw/2').data
+        assert 'reaped' in self.client.get('/snippet/view/2?lines=1-1').data
+        assert [row.id for row in search.search(db_session, 'reaped')] == [1]
+        assert User.query.get(1).snippet_count == 1
+
+    def test_archived_snippet_with_cached_record(self):
+        assert self.client.get('/snippet/view/2').status_code == 200
+        assert snippet_cache.get('snippet/2')['archived'] is False
+        db_session.query(Snippet).update({
+            'created_date': datetime.datetime(2000, 1, 1)})
+        Snippet.query.get(1).view_count = 5
+        db_session.commit()
+        assert archive.reap(db_session, pause=0, archive_after_days=30,
+                            max_views=0) == (0, 1)
+        assert 'reaped' in self.client.get('/snippet/raw/2').data
+        assert snippet_cache.get('snippet/2') is None
+        assert 'reaped' in self.client.get('/snippet/view/2?lines=1-1').data
+        assert snippet_cache.get('snippet/2')['archived'] is True
+
+class ReplicaTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        cfg_file = os.path.join(self.directory, 'config.py')
+        with open(cfg_file, 'w') as cfg:
+            cfg.write(open('config_testing.py').read())
+            cfg.write("DATABASE = 'sqlite:///%s/primary.db'\n" % self.directory)
+            cfg.write("DATABASE_REPLICA = 'sqlite:///%s/replica.db'\n"
+                      % self.directory)
+        self.app = create_app(cfg_file)
+        self.client = self.app.test_client()
+        cache.clear()
+        init_db()
+        Base.metadata.create_all(bind=database.replica_engine)
+        session = db_session.session_factory()
+        session.add(User('test_user', 'test_user@example.com', 'password'))
+        session.commit()
+        session.close()
+        replica = db_session.session_factory(bind=database.replica_engine)
+        replica.add(User('replica_user', 'replica@example.com', 'password'))
+        replica.add(Snippet('Only on the replica', 'text', 1, 'text'))
+        replica.commit()
+        replica.close()
+
+    def tearDown(self):
+        db_session.remove()
+        shutil.rmtree(self.directory)
+        create_app(abspath('config_testing.py'))
+
+    def test_reads_use_replica_until_a_write(self):
+        rv = self.client.get('/')
+        assert 'Only on the replica' in rv.data
+        self.client.post('/login', data={'username': 'test_user',
+                                         'password': 'password'})
+        rv = self.client.get('/dashboard')
+        assert 'Total pastes: 0' in rv.data
+        rv = self.client.get('/snippet/view/1')
+        assert rv.status_code == 404
+
+class UpgradeTestCase(unittest.TestCase):
+    """
+    Upgrades a database created with the original schema.
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        cfg_file = os.path.join(self.directory, 'config.py')
+        with open(cfg_file, 'w') as cfg:
+            cfg.write(open('config_testing.py').read())
+            cfg.write("DATABASE = 'sqlite:///%s/legacy.db'\n" % self.directory)
+        self.app = create_app(cfg_file)
+        self.client = self.app.test_client()
+        cache.clear()
+        snippet_cache.clear()
+        engine = database.db_engine
+        engine.execute('CREATE TABLE users (id INTEGER PRIMARY KEY, '
+                       'username VARCHAR(100) UNIQUE, '
+                       'email VARCHAR(100) UNIQUE, password VARCHAR)')
+        engine.execute('CREATE TABLE snippets (id INTEGER PRIMARY KEY, '
+                       'title VARCHAR(100), snippet_lang VARCHAR(30), '
+                       'author_id INTEGER REFERENCES users (id), '
+                       'snippet_raw TEXT, snippet_formatted TEXT, '
+                       'created_date DATETIME)')
+        engine.execute("INSERT INTO users VALUES (1, 'old_user', "
+                       "'old@example.com', 'x')")
+        engine.execute("INSERT INTO snippets VALUES (1, 'Old snippet', "
+                       "'python', 1, 'print 1', "
+                       "'<div class=\"source\">old html</div>', "
+                       "'2012-01-01 00:00:00')")
+
+    def tearDown(self):
+        db_session.remove()
+        shutil.rmtree(self.directory)
+        create_app(abspath('config_testing.py'))
+
+    def test_add_missing_columns(self):
+        added = database.add_missing_columns(database.db_engine)
+        assert 'snippets.raw_size' in added
+        assert 'users.snippet_count' in added
+        assert database.add_missing_columns(database.db_engine) == []
+        assert compress_legacy_rows(db_session, Snippet.__table__,
+                                    'snippet_raw', 'raw_size') == 1
+        db_session.remove()
+        snippet = Snippet.query.get(1)
+        assert snippet.raw_size == len('print 1')
+        assert snippet.render_state == database.RENDER_PENDING
+        rv = self.client.get('/snippet/view/1')
+        assert rv.status_code == 200
+        assert 'Old snippet' in rv.data
+
+    def test_migrate_legacy_renders(self):
+        database.add_missing_columns(database.db_engine)
+        assert database.migrate_legacy_renders(db_session,
+                                               batch_size=1) == 1
+        assert database.migrate_legacy_renders(db_session) == 0
+        snippet = Snippet.query.get(1)
+        assert snippet.render_state == RENDER_DONE
+        assert snippet.snippet_formatted == '<div class="source">old html</div>'
+        assert snippet.blob.digest == \
+            highlighting.render_digest(u'print 1', 'python')
+        assert 'old html' in self.client.get('/snippet/view/1').data
+
+    def test_migrate_legacy_text_renders_unguessed(self):
+        """
+        This test checks that a legacy plain text render isn't stored under
+        the digest of the lexer guessing would pick, where new snippets in
+        that language would find it.
+        """
+        source = u'#!/usr/bin/env python\nprint 1\n'
+        database.db_engine.execute(
+            "INSERT INTO snippets VALUES (2, 'Old text', 'text', 1, ?, "
+            "'<div class=\"source\">plain</div>', '2012-01-01 00:00:00')",
+            source)
+        database.add_missing_columns(database.db_engine)
+        highlighting.configure(guess=True)
+        try:
+            assert highlighting.render_digest(source, 'text') == \
+                highlighting.render_digest(source, 'python')
+            assert database.migrate_legacy_renders(db_session) == 2
+            blob = Snippet.query.get(2).blob
+            assert blob.digest == highlighting.lexer_digest(
+                highlighting.lexer_name('text'), source)
+            assert database.find_blob_id(
+                db_session, highlighting.render_digest(source, 'python')) \
+                is None
+        finally:
+            highlighting.configure()
+
+class PoolMetricsTestCase(unittest.TestCase):
+
+    def test_checkout_metrics(self):
+        engine = create_engine('sqlite://', poolclass=TimedQueuePool,
+                               pool_size=1, max_overflow=1)
+        instrument_pool(engine, 'test')
+        first = engine.connect()
+        second = engine.connect()
+        assert metrics.gauge('db_pool_checked_out', engine='test') == 2
+        assert metrics.gauge('db_pool_overflow', engine='test') == 1
+        assert metrics.timing('db_pool_wait_seconds', engine='test')[0] == 2
+        first.close()
+        second.close()
+        assert metrics.gauge('db_pool_checked_out', engine='test') == 0
+
+class GreenAppTestCase(unittest.TestCase):
+
+    def test_only_read_routes(self):
+        try:
+            import gevent
+        except ImportError:
+            raise SkipTest('gevent is not installed')
+        from pasteapp.green import create_green_app
+        app = create_green_app(abspath('config_testing.py'))
+        client = app.test_client()
+        with app.test_request_context():
+            init_db()
+            try:
+                assert client.get('/').status_code == 200
+                assert client.get('/search?q=x').status_code == 200
+                assert client.get('/login').status_code == 404
+            finally:
+                clear_db()
+
+class GreenServingTestCase(TestCase):
+    """
+    The green app's routing and highlighting, installed on a normal app so
+    gevent isn't needed.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(GreenServingTestCase, self).__init__(*args, **kwargs)
+        serve_green(self.app, self.run_in_thread)
+
+    def run_in_thread(self, func, args):
+        self.highlighted.append(func)
+        return func(*args)
+
+    def setUp(self):
+        super(GreenServingTestCase, self).setUp()
+        # Left unrendered, so only the views below highlight it.
+        db_session.add(Snippet('Green', 'python', 1, 'x = 1\ny = 2\n'))
+        db_session.commit()
+        self.highlighted = []
+
+    def test_only_read_routes(self):
+        assert self.client.get('/snippet/new').status_code == 404
+        assert self.client.get('/login').status_code == 404
+        rv = self.client.get('/snippet/raw/1')
+        assert rv.data == 'x = 1\ny = 2\n'
+
+    def test_inline_highlights_run_in_thread(self):
+        assert self.client.get('/snippet/view/1').status_code == 200
+        assert self.highlighted == []
+        for query in ('linenos=1', 'style=monokai', 'lines=1-1'):
+            rv = self.client.get('/snippet/view/1?' + query)
+            assert rv.status_code == 200
+        assert self.highlighted == [render] * 3
+
+    def test_lazy_render_runs_in_thread(self):
+        self.app.config['RENDER_MODE'] = 'lazy'
+        assert self.client.get('/snippet/view/1').status_code == 200
+        assert self.highlighted == [render]
+
 class AboutPageTestCase(TestCase):
 
     def test_about_page_rendering(self):
@@ -244,6 +1240,104 @@ class LoginPageTestCase(TestCase):
         rv = self.login('test_user', 'wrong')
         assert msg in rv.data
 
+    def test_login_throttled_after_failures(self):
+        # A long window so the count can't roll over mid-test.
+        username_throttle.configure(limit=3, window=3600)
+        try:
+            for i in range(3):
+                rv = self.login('test_user', 'wrong')
+                assert rv.status_code == 200
+            rv = self.login('test_user', 'password')
+            assert rv.status_code == 429
+            assert 'Retry-After' in rv.headers
+            rv = self.login('other_user', 'password')
+            assert rv.status_code == 200
+        finally:
+            username_throttle.configure(limit=10)
+
+    def test_login_throttled_per_address(self):
+        ip_throttle.configure(limit=2, window=3600)
+        try:
+            for i in range(2):
+                rv = self.login('test_user', 'wrong')
+                assert rv.status_code == 200
+            rv = self.login('test_user', 'password')
+            assert rv.status_code == 429
+        finally:
+            ip_throttle.configure(limit=30)
+
+    def test_throttle_counts_atomically(self):
+        throttle = AttemptThrottle('test')
+        throttle.configure(limit=50, window=3600)
+        results = []
+        def attempt():
+            for i in range(10):
+                results.append(throttle.hit('key'))
+        threads = [threading.Thread(target=attempt) for i in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert results.count(True) == 50
+        assert throttle.exceeded('key')
+
+    def test_login_pool_saturated(self):
+        hash_pool.configure(workers=1, queue_limit=0, rounds=4)
+        hash_pool._slots.acquire()
+        try:
+            rv = self.login('test_user', 'password')
+            assert rv.status_code == 429
+        finally:
+            hash_pool.configure(rounds=4)
+
+    def test_login_pool_saturated_by_another_worker(self):
+        hash_pool.configure(workers=1, queue_limit=0, rounds=4)
+        started = multiprocessing.Event()
+        release = multiprocessing.Event()
+        def hold_slot():
+            started.set()
+            release.wait(10)
+        worker = multiprocessing.Process(target=hash_pool.run,
+                                         args=(hold_slot,))
+        worker.start()
+        try:
+            assert started.wait(10)
+            rv = self.login('test_user', 'password')
+            assert rv.status_code == 429
+        finally:
+            release.set()
+            worker.join(10)
+            hash_pool.configure(rounds=4)
+        assert 'You have logged in successfully.' in \
+            self.login('test_user', 'password').data
+
+    def test_login_hash_timeout(self):
+        hash_pool.configure(timeout=0.01, rounds=4)
+        release = threading.Event()
+        hash_pool._get_pool().apply_async(release.wait)
+        hash_pool._get_pool().apply_async(release.wait)
+        try:
+            rv = self.login('test_user', 'password')
+            assert rv.status_code == 429
+        finally:
+            release.set()
+            hash_pool.configure(rounds=4)
+
+    def test_login_rehashes_password(self):
+        """
+        This test checks that a password hashed with an old cost factor is
+        rehashed with BCRYPT_ROUNDS on the next successful login.
+        """
+        user = User.query.filter(User.username == 'test_user').first()
+        user.password = hash_password('password', 5)
+        db_session.commit()
+        db_session.remove()
+        self.login('test_user', 'password')
+        user = User.query.filter(User.username == 'test_user').first()
+        assert hash_rounds(user.password) == 4
+        rv = self.login('test_user', 'password')
+        assert 'You have logged in successfully.' in rv.data
+
     def test_logout_not_logged_in(self):
         msg = 'Logged out successfully'
         rv = self.logout()
@@ -264,6 +1358,42 @@ class LoginPageTestCase(TestCase):
         rv = self.client.get('/dashboard', follow_redirects=True)
         assert 'Your Overview' in rv.data
 
+    def add_snippets(self, count):
+        for i in range(count):
+            db_session.add(Snippet('Snippet %d' % i, 'text', 1, 'text'))
+        recount_snippets(db_session)
+        db_session.commit()
+
+    def test_dashboard_keyset_pages(self):
+        """
+        This test checks that the dashboard pages through snippets using
+        the id of the last snippet shown.
+        """
+        self.add_snippets(12)
+        self.login('test_user', 'password')
+        rv = self.client.get('/dashboard')
+        assert 'Total pastes: 12' in rv.data
+        assert 'Snippet 11' in rv.data
+        assert '/dashboard?after=3' in rv.data
+        assert 'Previous' not in rv.data
+        rv = self.client.get('/dashboard?after=3')
+        assert 'Snippet 1<' in rv.data
+        assert 'Snippet 2<' not in rv.data
+        assert '/dashboard?before=2' in rv.data
+        assert 'Next' not in rv.data
+        rv = self.client.get('/dashboard?before=2')
+        assert 'Snippet 11' in rv.data
+        assert 'Previous' not in rv.data
+
+    def test_dashboard_numbered_pages(self):
+        self.add_snippets(12)
+        self.login('test_user', 'password')
+        rv = self.client.get('/dashboard/2')
+        assert 'Snippet 0<' in rv.data
+        assert '/dashboard/1' in rv.data
+        rv = self.client.get('/dashboard/3')
+        assert rv.status_code == 404
+
 class SnippetTestCase(TestCase):
 
     def create_snippet(self, title, language, raw_content, redirect=True):
@@ -322,3 +1452,248 @@ class SnippetTestCase(TestCase):
         self.login('test_user', 'password')
         rv = self.create_snippet('', 'scheme', '(list 1 2 3)')
         assert msg in rv.data
+
+    def test_create_snippet_too_long(self):
+        self.app.config['SNIPPET_MAX_LENGTH'] = 10
+        msg = 'Snippets can be at most 10 characters long.'
+        self.login('test_user', 'password')
+        rv = self.create_snippet('Long', 'text', 'x' * 11)
+        assert msg in rv.data
+        assert Snippet.query.count() == 0
+
+    def test_create_snippet_request_too_large(self):
+        self.app.config['MAX_CONTENT_LENGTH'] = 100
+        self.login('test_user', 'password')
+        rv = self.create_snippet('Huge', 'text', 'x' * 200)
+        assert rv.status_code == 413
+        assert 'at most' in rv.data
+
+    def test_view_chunked_snippet(self):
+        """
+        This test checks that snippets over the chunk threshold skip the
+        render queue and are shown a page of lines at a time.
+        """
+        self.app.config['SNIPPET_CHUNK_THRESHOLD'] = 100
+        self.app.config['SNIPPET_LINES_PER_PAGE'] = 10
+        self.app.config['STREAM_CHUNK_SIZE'] = 16
+        source = ''.join("x = %d\n" % i for i in range(25))
+        self.login('test_user', 'password')
+        self.create_snippet('Chunked', 'python', source)
+        assert Snippet.query.first().render_state == RENDER_CHUNKED
+        assert SnippetBlob.query.count() == 0
+        rv = self.client.get('/snippet/view/1')
+        assert 'Lines 1 to 10' in rv.data
+        assert '/snippet/view/1?lines=11-20' in rv.data
+        assert '>9<' in rv.data and '>10<' not in rv.data
+        rv = self.client.get('/snippet/view/1?lines=21-30')
+        assert 'Lines 21 to 30' in rv.data
+        assert '/snippet/view/1?lines=11-20' in rv.data
+        assert '?lines=31-40' not in rv.data
+        assert '>24<' in rv.data and '>19<' not in rv.data
+        assert rv.headers['ETag'].endswith('-lines=21-30"')
+
+    def test_create_snippet_rendered(self):
+        """
+        This test checks that the snippet is highlighted by the render queue
+        once it has been created.
+        """
+        self.login('test_user', 'password')
+        self.create_snippet('Python', 'python', "print 'hello world'")
+        snippet = Snippet.query.first()
+        assert snippet.render_state == RENDER_DONE
+        assert "class=\"source\"" in snippet.snippet_formatted
+
+    def test_failed_writeback_keeps_queue_running(self):
+        """
+        This test checks that a render whose write-back fails leaves the
+        snippet pending without stopping the pool's result thread, so later
+        renders are still written back.
+        """
+        db_session.add_all([Snippet('One', 'python', 1, 'x = 1'),
+                            Snippet('Two', 'python', 1, 'x = 2')])
+        db_session.commit()
+        errors = metrics.counter('render_writeback_errors')
+        stored = []
+        def store_render(snippet_id, digest, formatted, state):
+            if not stored:
+                stored.append(None)
+                raise OperationalError('UPDATE', {}, 'database is locked')
+            stored.append(snippet_id)
+        # pasteapp.render_queue the attribute is the queue, not the module.
+        module = sys.modules['pasteapp.render_queue']
+        original = module.store_render
+        module.store_render = store_render
+        render_queue.configure(processes=1)
+        try:
+            render_queue.submit(Snippet.query.get(1))
+            render_queue.submit(Snippet.query.get(2))
+            # Not join(), which never returns once the result thread is gone.
+            deadline = time.time() + 10
+            while len(stored) < 2 and time.time() < deadline:
+                time.sleep(0.01)
+        finally:
+            render_queue.configure(processes=0)
+            module.store_render = original
+        assert stored == [None, 2]
+        assert metrics.counter('render_writeback_errors') == errors + 1
+
+    def test_view_pending_snippet(self):
+        """
+        This test checks that a snippet which hasn't been rendered yet is
+        shown as escaped plain text.
+        """
+        snippet = Snippet('Pending', 'html', 1, '<b>bold</b>')
+        db_session.add(snippet)
+        db_session.commit()
+        rv = self.client.get('/snippet/view/%d' % snippet.id)
+        assert '&lt;b&gt;bold&lt;/b&gt;' in rv.data
+
+    def test_render_metrics(self):
+        count = metrics.timing('render_seconds', lexer='lua')[0]
+        self.login('test_user', 'password')
+        self.create_snippet('Lua', 'lua', 'print("hi")')
+        assert metrics.timing('render_seconds', lexer='lua')[0] == count + 1
+        assert metrics.gauge('render_queue_depth') == 0
+
+    def test_snippet_count_maintained(self):
+        self.login('test_user', 'password')
+        self.create_snippet('One', 'python', "print 1")
+        self.create_snippet('Two', 'python', "print 2")
+        assert User.query.get(1).snippet_count == 2
+
+    def test_duplicate_snippets_share_render(self):
+        """
+        This test checks that identical snippets reuse the same rendered
+        HTML rather than each storing a copy.
+        """
+        hits = metrics.counter('render_cache_hits')
+        self.login('test_user', 'password')
+        self.create_snippet('First', 'python', "print 'duplicate'")
+        self.create_snippet('Second', 'python', "print 'duplicate'")
+        self.create_snippet('Third', 'ruby', "print 'duplicate'")
+        first, second, third = Snippet.query.order_by(Snippet.id).all()
+        assert first.blob_id == second.blob_id
+        assert first.blob_id != third.blob_id
+        assert second.is_rendered
+        assert SnippetBlob.query.count() == 2
+        # The copy took its near-duplicate's blob without being rendered.
+        assert second.duplicate_of == first.id
+        assert metrics.counter('render_cache_hits') == hits
+
+    def test_view_snippet_conditional(self):
+        """
+        This test checks that a rendered snippet can be revalidated with its
+        etag and gets a 304 response.
+        """
+        self.login('test_user', 'password')
+        self.create_snippet('Cached', 'python', "print 'cached'")
+        rv = self.client.get('/snippet/view/1')
+        etag = rv.headers['ETag']
+        assert rv.headers['Last-Modified']
+        rv = self.client.get('/snippet/view/1',
+                             headers={'If-None-Match': etag})
+        assert rv.status_code == 304
+        assert rv.data == ''
+
+    def test_view_snippet_revalidated_without_highlighting(self):
+        self.login('test_user', 'password')
+        self.create_snippet('Cached', 'python', "print 'cached'\n" * 3)
+        etags = {}
+        for query in ('linenos=1', 'lines=2-3'):
+            etags[query] = self.client.get('/snippet/view/1?' + query) \
+                               .headers['ETag']
+        render_cache.clear()
+        module = sys.modules['pasteapp.views.frontend']
+        highlight = module.highlight
+        def fail(*args):
+            raise AssertionError('highlighted a revalidated snippet')
+        module.highlight = fail
+        try:
+            for query, etag in etags.items():
+                rv = self.client.get('/snippet/view/1?' + query,
+                                     headers={'If-None-Match': etag})
+                assert rv.status_code == 304
+        finally:
+            module.highlight = highlight
+
+    def test_view_pending_snippet_not_cached(self):
+        snippet = Snippet('Pending', 'python', 1, "print 'pending'")
+        db_session.add(snippet)
+        db_session.commit()
+        rv = self.client.get('/snippet/view/1')
+        assert 'Last-Modified' not in rv.headers
+        render_queue.submit(Snippet.query.get(1))
+        rv = self.client.get('/snippet/view/1',
+                             headers={'If-None-Match': rv.headers['ETag']})
+        assert rv.status_code == 200
+        assert "class=\"source\"" in rv.data
+
+    def test_view_large_snippet_streamed(self):
+        """
+        This test checks that snippets over the stream threshold are sent in
+        chunks and still come out whole.
+        """
+        self.app.config['STREAM_THRESHOLD'] = 100
+        self.app.config['STREAM_CHUNK_SIZE'] = 64
+        source = ''.join("print 'line %d'\n" % i for i in range(50))
+        self.login('test_user', 'password')
+        self.create_snippet('Large', 'python', source)
+        rv = self.client.get('/snippet/view/1')
+        assert rv.is_streamed
+        expected = SnippetBlob.query.first().formatted
+        assert expected in rv.data
+        assert 'Large' in rv.data
+
+    def test_raw_snippet(self):
+        self.app.config['STREAM_CHUNK_SIZE'] = 4
+        snippet = Snippet('Raw', 'html', 1, '<p>raw text</p>')
+        db_session.add(snippet)
+        db_session.commit()
+        rv = self.client.get('/snippet/raw/1')
+        assert rv.mimetype == 'text/plain'
+        assert rv.data == '<p>raw text</p>'
+
+    def test_raw_snippet_missing(self):
+        rv = self.client.get('/snippet/raw/42')
+        assert rv.status_code == 404
+
+    def test_raw_snippet_deflate(self):
+        """
+        This test checks that clients accepting deflate get the stored
+        compressed bytes directly.
+        """
+        self.app.config['STREAM_CHUNK_SIZE'] = 5
+        snippet = Snippet('Raw', 'text', 1, 'compressed ' * 20)
+        db_session.add(snippet)
+        db_session.commit()
+        rv = self.client.get('/snippet/raw/1',
+                             headers={'Accept-Encoding': 'gzip, deflate'})
+        assert rv.headers['Content-Encoding'] == 'deflate'
+        assert zlib.decompress(rv.data) == 'compressed ' * 20
+
+    def test_lazy_rendering(self):
+        """
+        This test checks that in lazy mode snippets are only highlighted
+        when they are first viewed.
+        """
+        self.app.config['RENDER_MODE'] = 'lazy'
+        self.login('test_user', 'password')
+        self.create_snippet('Lazy', 'python', "print 'lazy'", redirect=False)
+        assert SnippetBlob.query.count() == 0
+        misses = metrics.counter('on_demand_render_misses')
+        rv = self.client.get('/snippet/view/1')
+        assert "class=\"source\"" in rv.data
+        self.client.get('/snippet/view/1')
+        assert metrics.counter('on_demand_render_misses') == misses + 1
+
+    def test_view_snippet_options(self):
+        self.login('test_user', 'password')
+        self.create_snippet('Options', 'python', "print 'options'")
+        rv = self.client.get('/snippet/view/1')
+        assert 'linenos' in rv.data
+        rv = self.client.get('/snippet/view/1?linenos=0')
+        assert 'linenos' not in rv.data
+        rv = self.client.get('/snippet/view/1?style=monokai')
+        assert 'style="' in rv.data
+        rv = self.client.get('/snippet/view/1?style=no-such-style')
+        assert 'style="' not in rv.data